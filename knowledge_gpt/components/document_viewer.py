@@ -0,0 +1,41 @@
+import streamlit as st
+
+from knowledge_gpt.core.parsing import File
+from knowledge_gpt.ui import get_page_fragments
+
+PAGES_PER_VIEW = 5
+
+# Session state keys shared with the sources list in main.py
+VIEWER_PAGE_KEY = "viewer_page"
+SHOW_FULL_DOC_KEY = "show_full_doc"
+
+
+def jump_to_page(page: int):
+    """Opens the document viewer at the given page.
+    Meant to be used as an on_click callback."""
+    st.session_state[SHOW_FULL_DOC_KEY] = True
+    st.session_state[VIEWER_PAGE_KEY] = page
+
+
+def document_viewer(file: File):
+    """Shows a window of pages of the parsed document. Only the visible
+    pages are sent to the browser."""
+    fragments = get_page_fragments(file.id, file.docs)
+    num_pages = len(fragments)
+
+    # Clamp a page that was set for a previously uploaded file
+    page = min(max(st.session_state.get(VIEWER_PAGE_KEY, 1), 1), num_pages)
+    st.session_state[VIEWER_PAGE_KEY] = page
+
+    with st.expander("Document", expanded=True):
+        st.number_input(
+            f"Page (of {num_pages})",
+            min_value=1,
+            max_value=num_pages,
+            step=1,
+            key=VIEWER_PAGE_KEY,
+        )
+        start, end = page - 1, page - 1 + PAGES_PER_VIEW
+        window = fragments[start:end]
+        # Hack to get around st.markdown rendering LaTeX
+        st.markdown(f"<p>{'<p><hr/></p>'.join(window)}</p>", unsafe_allow_html=True)
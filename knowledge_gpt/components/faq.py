@@ -27,8 +27,10 @@ To speed up the indexing process, you can use a paid API key.
 ## What do the numbers mean under each source?
 For a PDF document, you will see a citation number like this: 3-12. 
 The first number is the page number and the second number is 
-the chunk number on that page. For DOCS and TXT documents, 
-the first number is set to 1 and the second number is the chunk number.
+the chunk number on that page. For DOCX documents, the first number 
+is the page as last laid out by Word (or the section if the document 
+has no page breaks). For TXT documents, the first number is set to 1 
+except for very large files, which are split into parts.
 
 ## Are the answers 100% accurate?
 No, the answers are not 100% accurate. KnowledgeGPT uses GPT-3 to generate
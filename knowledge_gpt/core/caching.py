@@ -1,10 +1,30 @@
+from functools import wraps
+from io import BytesIO
+from typing import Callable, List
+import os
+
 import streamlit as st
 from streamlit.runtime.caching.hashing import HashFuncsDict
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 
 import knowledge_gpt.core.parsing as parsing
 import knowledge_gpt.core.chunking as chunking
 import knowledge_gpt.core.embedding as embedding
-from knowledge_gpt.core.parsing import File
+from knowledge_gpt.core.embedding import FolderIndex
+from knowledge_gpt.core.index_pool import IndexPool
+from knowledge_gpt.core.jobs import IndexingJob, IndexingJobManager
+from knowledge_gpt.core.parsing import File, Upload, content_hash
+from knowledge_gpt.core.usage import UsageLedger
+
+# Memory budget of the indexes shared by all sessions, and where indexes that
+# do not fit are spilled (a temporary directory by default)
+INDEX_POOL_MB = int(os.environ.get("INDEX_POOL_MB", 1024))
+INDEX_POOL_SPILL_DIR = os.environ.get("INDEX_POOL_SPILL_DIR")
+
+# File the token usage of uploads and queries is appended to (not written by
+# default), and how often
+USAGE_LOG_PATH = os.environ.get("USAGE_LOG_PATH")
+USAGE_FLUSH_SECONDS = float(os.environ.get("USAGE_FLUSH_SECONDS", 60))
 
 
 def file_hash_func(file: File) -> str:
@@ -12,6 +32,59 @@ def file_hash_func(file: File) -> str:
     return file.id
 
 
+def upload_hash_func(file: BytesIO) -> str:
+    """Get a unique hash for an uploaded file. The hash is reused as the
+    id of the File parsed from it."""
+    with Upload.from_file(file) as upload:
+        return upload.id
+
+
+def index_key(files: List[File], *args, **kwargs) -> str:
+    """Get a unique hash for the index of files built with the given arguments"""
+    key = repr(([file.id for file in files], args, sorted(kwargs.items())))
+    return content_hash(key.encode("utf-8"))
+
+
+@st.cache_resource(show_spinner=False)
+def get_index_pool() -> IndexPool:
+    """Get the index pool shared by all sessions"""
+    return IndexPool(max_bytes=INDEX_POOL_MB * 2**20, spill_dir=INDEX_POOL_SPILL_DIR)
+
+
+@st.cache_resource(show_spinner=False)
+def get_indexing_jobs() -> IndexingJobManager:
+    """Get the indexing job manager shared by all sessions"""
+    return IndexingJobManager(pool=get_index_pool(), usage_ledger=get_usage_ledger())
+
+
+@st.cache_resource(show_spinner=False)
+def get_usage_ledger() -> UsageLedger:
+    """Get the usage ledger shared by all sessions"""
+    return UsageLedger(path=USAGE_LOG_PATH, flush_interval=USAGE_FLUSH_SECONDS)
+
+
+def embed_files_in_background(
+    files: List[File], embedding: str, vector_store: str, **kwargs
+) -> IndexingJob:
+    """Starts indexing files in the background, or returns the job that is
+    already indexing them (possibly for another session)."""
+    key = index_key(files, embedding=embedding, vector_store=vector_store, **kwargs)
+    return get_indexing_jobs().submit(key, files, embedding, vector_store, **kwargs)
+
+
+def pool_index(embed_files: Callable[..., FolderIndex]) -> Callable[..., FolderIndex]:
+    """Caches the indexes returned by embed_files in the index pool"""
+
+    @wraps(embed_files)
+    def pooled_embed_files(files: List[File], *args, **kwargs) -> FolderIndex:
+        return get_index_pool().get_or_create(
+            index_key(files, *args, **kwargs),
+            lambda: embed_files(files, *args, **kwargs),
+        )
+
+    return pooled_embed_files
+
+
 @st.cache_data(show_spinner=False)
 def bootstrap_caching():
     """Patch module functions with caching"""
@@ -24,10 +97,15 @@ def bootstrap_caching():
     ]
     file_hash_funcs: HashFuncsDict = {cls: file_hash_func for cls in file_subtypes}
 
-    parsing.read_file = st.cache_data(show_spinner=False)(parsing.read_file)
+    upload_hash_funcs: HashFuncsDict = {
+        BytesIO: upload_hash_func,
+        UploadedFile: upload_hash_func,
+    }
+
+    parsing.read_file = st.cache_data(show_spinner=False, hash_funcs=upload_hash_funcs)(
+        parsing.read_file
+    )
     chunking.chunk_file = st.cache_data(show_spinner=False, hash_funcs=file_hash_funcs)(
         chunking.chunk_file
     )
-    embedding.embed_files = st.cache_data(
-        show_spinner=False, hash_funcs=file_hash_funcs
-    )(embedding.embed_files)
+    embedding.embed_files = pool_index(embedding.embed_files)
@@ -1,6 +1,7 @@
 from langchain.docstore.document import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from knowledge_gpt.core.parsing import File
+from knowledge_gpt.core.usage import get_encoding
 
 
 def chunk_file(
@@ -9,26 +10,33 @@ def chunk_file(
     """Chunks each document in a file into smaller documents
     according to the specified chunk size and overlap
     where the size is determined by the number of tokens for the specified model.
+    The number of tokens of each chunk is stored in its metadata as token_count,
+    so that it does not have to be counted again when building prompts.
     """
+    text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        model_name=model_name,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+    )
+    encoding = get_encoding(model_name)
 
     # split each document into chunks
     chunked_docs = []
     for doc in file.docs:
-        text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-            model_name=model_name,
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-        )
-
         chunks = text_splitter.split_text(doc.page_content)
+        token_counts = [
+            len(tokens)
+            for tokens in encoding.encode_ordinary_batch(chunks)  # type: ignore
+        ]
 
-        for i, chunk in enumerate(chunks):
+        for i, (chunk, token_count) in enumerate(zip(chunks, token_counts)):
             doc = Document(
                 page_content=chunk,
                 metadata={
                     "page": doc.metadata.get("page", 1),
                     "chunk": i + 1,
                     "source": f"{doc.metadata.get('page', 1)}-{i + 1}",
+                    "token_count": token_count,
                 },
             )
             chunked_docs.append(doc)
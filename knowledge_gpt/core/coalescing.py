@@ -0,0 +1,202 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Set, Tuple
+
+from langchain.embeddings.base import Embeddings
+from pydantic import BaseModel
+
+
+class CoalescerStats(BaseModel):
+    queries: int = 0
+    # Requests sent to the wrapped embeddings
+    batches: int = 0
+    cache_hits: int = 0
+
+
+class _Batch:
+    def __init__(self):
+        self.futures: Dict[str, Future] = {}
+        self.full = threading.Event()
+
+
+class CoalescingEmbeddings(Embeddings):
+    """Wraps embeddings so that queries embedded concurrently (e.g. by
+    different sessions) are sent in one request. The first query of a batch
+    waits up to window seconds for more queries, or until max_batch distinct
+    queries arrived, then embeds them all and hands each caller its vector.
+    The vectors of the last cache_size queries are kept, so that repeated
+    queries are not embedded again.
+
+    Documents are embedded by the wrapped embeddings as is.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        window: float = 0.01,
+        max_batch: int = 32,
+        cache_size: int = 1024,
+    ):
+        self.embeddings = embeddings
+        self.window = window
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self._init_state()
+
+    def _init_state(self):
+        self.stats = CoalescerStats()
+        self._cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._batch: Optional[_Batch] = None
+        # Batches embedded on event loops, referenced until they are done
+        self._tasks: Set[asyncio.Task] = set()
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        for key in ["stats", "_cache", "_batch", "_tasks", "_lock"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_query_requested(text)[0]
+
+    def embed_query_requested(self, text: str) -> Tuple[List[float], bool]:
+        """Embeds a query like embed_query, also returning whether it was
+        requested from the wrapped embeddings on behalf of this caller
+        (rather than served from the cache or shared with an identical
+        query), i.e. whether this caller should be charged for it"""
+        future, batch, requested = self._join(text)
+        if batch is not None:
+            try:
+                batch.full.wait(self.window)
+                self._close_batch(batch)
+                texts = list(batch.futures)
+                try:
+                    # Queries and documents are embedded the same way by the
+                    # supported embeddings, so a batch of queries is one
+                    # request
+                    vectors = self.embeddings.embed_documents(texts)
+                except Exception as e:
+                    self._fail_batch(batch, e)
+                else:
+                    self._resolve_batch(batch, texts, vectors)
+            finally:
+                self._abandon_batch(batch)
+
+        return list(future.result()), requested
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_query_requested(text))[0]
+
+    async def aembed_query_requested(self, text: str) -> Tuple[List[float], bool]:
+        """Async version of embed_query_requested, batched with the queries embedded
+        concurrently by other threads and coroutines. Batches opened by a
+        coroutine are embedded in a task of their own, so that cancelling
+        that caller (e.g. on a timeout) only stops it waiting, not the
+        request of the others. They are sent with the async client of the
+        wrapped embeddings, or on a worker thread if they do not have one."""
+        future, batch, requested = self._join(text)
+        if batch is not None:
+            task = asyncio.ensure_future(self._aembed_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        # Shielded so that a cancelled caller does not cancel the future
+        # other callers of the same query wait for
+        vector = await asyncio.shield(asyncio.wrap_future(future))
+        return list(vector), requested
+
+    async def _aembed_batch(self, batch: _Batch):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, batch.full.wait, self.window)
+            self._close_batch(batch)
+            texts = list(batch.futures)
+            try:
+                try:
+                    vectors = await self.embeddings.aembed_documents(texts)
+                except NotImplementedError:
+                    vectors = await loop.run_in_executor(
+                        None, self.embeddings.embed_documents, texts
+                    )
+            except Exception as e:
+                self._fail_batch(batch, e)
+            else:
+                self._resolve_batch(batch, texts, vectors)
+        finally:
+            self._abandon_batch(batch)
+
+    def _join(self, text: str) -> Tuple[Future, Optional[_Batch], bool]:
+        """Adds a query to the open batch, opening one if there is none.
+        Returns the future of its vector, the batch if the caller opened it
+        and so must embed it, and whether the query was added to the batch
+        by this caller. Cached queries get a resolved future."""
+        with self._lock:
+            self.stats.queries += 1
+            if text in self._cache:
+                self._cache.move_to_end(text)
+                self.stats.cache_hits += 1
+                future: Future = Future()
+                future.set_result(self._cache[text])
+                return future, None, False
+
+            batch = self._batch
+            leader = batch is None
+            if batch is None:
+                batch = self._batch = _Batch()
+
+            # Identical queries in the same batch share one vector
+            future = batch.futures.get(text)  # type: ignore
+            requested = future is None
+            if future is None:
+                future = batch.futures[text] = Future()
+            if len(batch.futures) >= self.max_batch:
+                batch.full.set()
+                self._batch = None
+
+        return future, batch if leader else None, requested
+
+    def _close_batch(self, batch: _Batch):
+        """Stops queries from joining a batch"""
+        with self._lock:
+            if self._batch is batch:
+                self._batch = None
+
+    def _resolve_batch(
+        self, batch: _Batch, texts: List[str], vectors: List[List[float]]
+    ):
+        with self._lock:
+            self.stats.batches += 1
+            for text, vector in zip(texts, vectors):
+                self._cache[text] = vector
+                self._cache.move_to_end(text)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        for text, vector in zip(texts, vectors):
+            batch.futures[text].set_result(vector)
+
+    def _fail_batch(self, batch: _Batch, error: BaseException):
+        for future in batch.futures.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def _abandon_batch(self, batch: _Batch):
+        """Fails the queries left in a batch that stopped before it was
+        embedded (e.g. its thread was interrupted or its event loop closed),
+        so that the other callers do not wait forever"""
+        batch.full.set()
+        self._close_batch(batch)
+        self._fail_batch(batch, RuntimeError("The batch of queries was not embedded."))
@@ -0,0 +1,162 @@
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+
+from knowledge_gpt.core.embedding import aembed_documents, aembed_query
+from knowledge_gpt.core.ranking import normalize_rows
+from knowledge_gpt.core.usage import estimate_tokens
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+WORD = re.compile(r"\w+")
+
+# Words that say nothing about the relevance of a sentence
+STOP_WORDS = set(
+    "a an and are as at be by can do does for from how in is it of on or the "
+    "this that to was what when where which who why will with".split()
+)
+
+
+def split_sentences(text: str) -> List[str]:
+    """Splits text into sentences (and lines)"""
+    return [
+        sentence.strip() for sentence in SENTENCE_END.split(text) if sentence.strip()
+    ]
+
+
+def lexical_scores(query: str, sentences: List[str]) -> np.ndarray:
+    """Scores sentences by the fraction of the query's words they contain"""
+    query_words = set(WORD.findall(query.lower())) - STOP_WORDS
+    if not query_words:
+        return np.zeros(len(sentences))
+    return np.array(
+        [
+            len(query_words.intersection(WORD.findall(sentence.lower())))
+            for sentence in sentences
+        ]
+    ) / len(query_words)
+
+
+def score_sentences(
+    query: str,
+    sentences: List[str],
+    query_vector: Optional[np.ndarray] = None,
+    vectors: Optional[List[List[float]]] = None,
+) -> np.ndarray:
+    """Scores sentences by the cosine similarity of their vectors to the
+    query's if they are given, and by lexical_scores otherwise"""
+    if query_vector is None or vectors is None:
+        return lexical_scores(query, sentences)
+    return normalize_rows(np.array(vectors, dtype=np.float32)) @ normalize_rows(
+        query_vector
+    )
+
+
+def split_documents(docs: List[Document]) -> Tuple[List[str], List[int]]:
+    """Returns the sentences of docs and the number of the doc of each"""
+    sentences: List[str] = []
+    doc_numbers: List[int] = []
+    for number, doc in enumerate(docs):
+        for sentence in split_sentences(doc.page_content):
+            sentences.append(sentence)
+            doc_numbers.append(number)
+    return sentences, doc_numbers
+
+
+def keep_sentences(
+    docs: List[Document],
+    sentences: List[str],
+    doc_numbers: List[int],
+    scores: np.ndarray,
+    token_budget: int,
+    count_tokens: Callable[[str], int] = estimate_tokens,
+) -> List[Document]:
+    """Keeps the best scoring sentences up to token_budget tokens in total,
+    dropping those that score 0 or less. Returns one document per document
+    with kept sentences, in the same order and with the same metadata (and
+    so sources) except for the token count of the whole chunk, whose
+    sentences are in their original order.
+    """
+    # The ranking of the documents breaks ties, so that sentences of more
+    # relevant documents are kept first
+    order = np.lexsort((np.array(doc_numbers), -scores))
+    kept = np.zeros(len(sentences), dtype=bool)
+    used = 0
+    for i in order:
+        if scores[i] <= 0 and kept.any():
+            break
+        tokens = count_tokens(sentences[i])
+        if used + tokens > token_budget and kept.any():
+            continue
+        kept[i] = True
+        used += tokens
+
+    kept_sentences: Dict[int, List[str]] = {}
+    for i in np.flatnonzero(kept):
+        kept_sentences.setdefault(doc_numbers[i], []).append(sentences[i])
+
+    return [
+        Document(
+            page_content=" ".join(kept_sentences[number]),
+            metadata={k: v for k, v in doc.metadata.items() if k != "token_count"},
+        )
+        for number, doc in enumerate(docs)
+        if number in kept_sentences
+    ]
+
+
+def compress_documents(
+    query: str,
+    docs: List[Document],
+    token_budget: int = 800,
+    embeddings: Optional[Embeddings] = None,
+    count_tokens: Callable[[str], int] = estimate_tokens,
+    query_vector: Optional[np.ndarray] = None,
+) -> List[Document]:
+    """Keeps only the sentences of docs most relevant to the query, up to
+    token_budget tokens in total (see keep_sentences). Sentences are scored
+    by the cosine similarity of their embeddings if embeddings are given
+    (all sentences being embedded in one request), and by the words they
+    share with the query otherwise. The query is only embedded if its
+    query_vector (e.g. from the search) is not given.
+    """
+    sentences, doc_numbers = split_documents(docs)
+    if not sentences:
+        return []
+
+    vectors: Optional[List[List[float]]] = None
+    if embeddings is not None:
+        if query_vector is None:
+            query_vector = np.array(embeddings.embed_query(query), dtype=np.float32)
+        vectors = embeddings.embed_documents(sentences)
+    scores = score_sentences(query, sentences, query_vector, vectors)
+    return keep_sentences(
+        docs, sentences, doc_numbers, scores, token_budget, count_tokens
+    )
+
+
+async def acompress_documents(
+    query: str,
+    docs: List[Document],
+    token_budget: int = 800,
+    embeddings: Optional[Embeddings] = None,
+    count_tokens: Callable[[str], int] = estimate_tokens,
+    query_vector: Optional[np.ndarray] = None,
+) -> List[Document]:
+    """Async version of compress_documents"""
+    sentences, doc_numbers = split_documents(docs)
+    if not sentences:
+        return []
+
+    vectors: Optional[List[List[float]]] = None
+    if embeddings is not None:
+        if query_vector is None:
+            vector = await aembed_query(embeddings, query)
+            query_vector = np.array(vector, dtype=np.float32)
+        vectors = await aembed_documents(embeddings, sentences)
+    scores = score_sentences(query, sentences, query_vector, vectors)
+    return keep_sentences(
+        docs, sentences, doc_numbers, scores, token_budget, count_tokens
+    )
@@ -5,18 +5,60 @@ from langchain.embeddings.base import Embeddings
 from langchain.embeddings.fake import FakeEmbeddings as FakeEmbeddingsBase
 from langchain.chat_models.fake import FakeListChatModel
 from typing import Optional
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
+import asyncio
+import time
 
 
 class FakeChatModel(FakeListChatModel):
+    # Seconds to wait per call, to simulate the latency of a provider
+    latency: float = 0.0
+
     def __init__(self, **kwargs):
         responses = ["The answer is 42. SOURCES: 1, 2, 3, 4"]
         super().__init__(responses=responses, **kwargs)
 
+    def _next_response(self) -> str:
+        # Cycle through the responses so that the model can be called any
+        # number of times
+        response = self.responses[self.i % len(self.responses)]
+        self.i += 1
+        return response
+
+    def _call(self, *args: Any, **kwargs: Any) -> str:
+        time.sleep(self.latency)
+        return self._next_response()
+
+    async def _agenerate(self, *args: Any, **kwargs: Any) -> ChatResult:
+        # Waits without blocking the event loop, like an async client
+        await asyncio.sleep(self.latency)
+        message = AIMessage(content=self._next_response())
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
 
 class FakeEmbeddings(FakeEmbeddingsBase):
+    # Seconds to wait per call, to simulate the latency of a provider
+    latency: float = 0.0
+
     def __init__(self, **kwargs):
         super().__init__(size=4, **kwargs)
 
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return super().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self.latency)
+        return super().embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency)
+        return super().embed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        await asyncio.sleep(self.latency)
+        return super().embed_query(text)
+
 
 class FakeVectorStore(VectorStore):
     """Fake vector store for testing purposes."""
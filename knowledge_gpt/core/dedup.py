@@ -0,0 +1,144 @@
+import re
+import zlib
+from hashlib import blake2b
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain.docstore.document import Document
+from pydantic import BaseModel
+
+# Mersenne prime 2^31 - 1. Shingle hashes and the permutation coefficients are
+# kept below it so that a * x + b fits in a uint64 without overflowing.
+_PRIME = np.uint64((1 << 31) - 1)
+
+# Max number of (shingle, permutation) hash values computed at once
+_BATCH_SIZE = 1 << 21
+
+
+class DedupResult(BaseModel):
+    docs: List[Document]
+    num_duplicates: int
+
+    @property
+    def ratio(self) -> float:
+        """Fraction of the input documents that were duplicates"""
+        total = len(self.docs) + self.num_duplicates
+        return self.num_duplicates / total if total else 0.0
+
+
+def normalize_text(text: str) -> str:
+    """Lowercases a string and collapses all whitespace"""
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def shingle_hashes(text: str, size: int = 5) -> np.ndarray:
+    """Hashes the word n-grams of a normalized string"""
+    words = text.split(" ")
+    shingles = [" ".join(gram) for gram in zip(*[words[k:] for k in range(size)])]
+    if not shingles:
+        shingles = [text]
+    return np.unique(
+        np.fromiter(
+            (zlib.crc32(s.encode("utf-8")) for s in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        % _PRIME
+    )
+
+
+def minhash_signatures(
+    shingles: List[np.ndarray], num_perm: int = 64, seed: int = 1
+) -> np.ndarray:
+    """Computes the MinHash signature (num_perm values) of each set of
+    shingle hashes. Sets are processed in batches, with the permutations of
+    all shingles in a batch computed as one matrix.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, int(_PRIME), size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, int(_PRIME), size=num_perm, dtype=np.uint64)
+
+    signatures = np.empty((len(shingles), num_perm), dtype=np.uint64)
+    start = 0
+    while start < len(shingles):
+        end, rows = start, 0
+        while end < len(shingles) and (rows == 0 or rows * num_perm < _BATCH_SIZE):
+            rows += len(shingles[end])
+            end += 1
+
+        batch = np.concatenate(shingles[start:end])
+        hashed = (batch[:, None] * a + b) % _PRIME
+        sizes = [len(s) for s in shingles[start:end]]
+        offsets = np.cumsum([0] + sizes[:-1])
+        signatures[start:end] = np.minimum.reduceat(hashed, offsets, axis=0)
+        start = end
+
+    return signatures
+
+
+def deduplicate_docs(
+    docs: List[Document],
+    threshold: float = 0.8,
+    num_perm: int = 64,
+    bands: int = 16,
+) -> DedupResult:
+    """Removes exact and near-duplicate documents, keeping the first
+    occurrence. Near-duplicates are found with MinHash and banded LSH, and
+    confirmed when the estimated Jaccard similarity of their shingles is at
+    least the threshold. Each kept document lists the locations of its
+    duplicates in metadata["duplicates"] so that citations still resolve.
+    Documents with duplicates are copied before being annotated, so the
+    input documents are left untouched.
+    """
+    normalized = [normalize_text(doc.page_content) for doc in docs]
+    signatures = minhash_signatures(
+        [shingle_hashes(text) for text in normalized], num_perm=num_perm
+    )
+
+    exact: Dict[bytes, int] = {}
+    buckets: Dict[bytes, List[int]] = {}
+    # Kept documents by their index in docs
+    unique_docs: Dict[int, Document] = {}
+
+    for i, (doc, text) in enumerate(zip(docs, normalized)):
+        digest = blake2b(text.encode("utf-8"), digest_size=16).digest()
+        original: Optional[int] = exact.get(digest)
+
+        band_keys = [
+            bytes([band]) + rows.tobytes()
+            for band, rows in enumerate(signatures[i].reshape(bands, -1))
+        ]
+        if original is None:
+            candidates = {j for key in band_keys for j in buckets.get(key, [])}
+            for j in sorted(candidates):
+                if np.mean(signatures[i] == signatures[j]) >= threshold:
+                    original = j
+                    break
+
+        if original is not None:
+            kept = unique_docs[original]
+            if kept is docs[original]:
+                kept = unique_docs[original] = Document(
+                    page_content=kept.page_content,
+                    metadata={
+                        **kept.metadata,
+                        "duplicates": list(kept.metadata.get("duplicates", [])),
+                    },
+                )
+            kept.metadata["duplicates"].append(
+                {
+                    key: doc.metadata[key]
+                    for key in ("file_id", "file_name", "page", "source")
+                    if key in doc.metadata
+                }
+            )
+            continue
+
+        exact[digest] = i
+        for key in band_keys:
+            buckets.setdefault(key, []).append(i)
+        unique_docs[i] = doc
+
+    return DedupResult(
+        docs=list(unique_docs.values()), num_duplicates=len(docs) - len(unique_docs)
+    )
@@ -1,20 +1,78 @@
 from langchain.vectorstores import VectorStore
-from knowledge_gpt.core.parsing import File
+from knowledge_gpt.core.parsing import File, content_hash
 from langchain.vectorstores.faiss import FAISS
 from langchain.embeddings import OpenAIEmbeddings
 from langchain.embeddings.base import Embeddings
-from typing import List, Type
+from typing import Dict, List, Type, Tuple, Optional
 from langchain.docstore.document import Document
+from pydantic import BaseModel
+import numpy as np
+import asyncio
+import copy
+from collections import OrderedDict
+import logging
+import threading
+from functools import partial
 from knowledge_gpt.core.debug import FakeVectorStore, FakeEmbeddings
+from knowledge_gpt.core.coalescing import CoalescingEmbeddings
+from knowledge_gpt.core.dedup import deduplicate_docs
+from knowledge_gpt.core.sharding import ShardedVectorStore
+from knowledge_gpt.core.usage import TokenCounter, count_tokens, model_name
+from knowledge_gpt.core.ranking import (
+    adaptive_k,
+    cutoff_reason,
+    maximal_marginal_relevance_scores,
+    normalize_rows,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class SearchFilter(BaseModel):
+    """Restricts a search to some of the files and pages of a folder"""
+
+    file_ids: Optional[List[str]] = None
+    # File extensions, e.g. ["pdf", "docx"]
+    file_types: Optional[List[str]] = None
+    # First and last page, inclusive
+    pages: Optional[Tuple[int, int]] = None
 
 
 class FolderIndex:
     """Index for a collection of files (a folder)"""
 
-    def __init__(self, files: List[File], index: VectorStore):
+    def __init__(self, files: List[File], index: VectorStore, dedup_ratio: float = 0):
         self.name: str = "default"
         self.files = files
         self.index: VectorStore = index
+        # Fraction of chunks that were not embedded because they were duplicates
+        self.dedup_ratio = dedup_ratio
+        # Guards the vector store while documents are added in the background
+        self._lock = threading.RLock()
+        # Ids of the vectors of each file and their pages, sorted by page,
+        # so that filtered searches only look at a page range of the files
+        self._file_vectors: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["_lock"]
+        # The embeddings hold the user's API key, which must not be written
+        # to disk with the index. They are reattached with attach_embeddings.
+        if isinstance(self.index, FAISS):
+            state["index"] = copy.copy(self.index)
+            state["index"].embedding_function = None
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def attach_embeddings(self, embeddings: Embeddings):
+        """Sets the embeddings of the queries of an unpickled index"""
+        if isinstance(self.index, ShardedVectorStore):
+            self.index.embedding = embeddings
+        elif isinstance(self.index, FAISS):
+            self.index.embedding_function = embeddings.embed_query
 
     @staticmethod
     def _combine_files(files: List[File]) -> List[Document]:
@@ -29,46 +87,573 @@ class FolderIndex:
 
         return all_texts
 
+    @classmethod
+    def _combine_and_deduplicate(
+        cls, files: List[File], deduplicate: bool
+    ) -> Tuple[List[Document], float]:
+        """Combines the documents of files and optionally drops duplicates.
+        Returns the documents to embed and the fraction that was dropped."""
+
+        all_docs = cls._combine_files(files)
+        if not deduplicate:
+            return all_docs, 0.0
+
+        result = deduplicate_docs(all_docs)
+        return result.docs, result.ratio
+
+    def _register_documents(self, docs: List[Document], first_id: int):
+        """Records the file and page of each vector, including the locations
+        of the duplicates it stands for. Vector ids are consecutive from
+        first_id, in the order the documents were added to the vector store.
+        """
+        added: Dict[str, Tuple[List[int], List[int]]] = {}
+        for vector_id, doc in enumerate(docs, first_id):
+            for location in [doc.metadata, *doc.metadata.get("duplicates", [])]:
+                ids, pages = added.setdefault(location.get("file_id", ""), ([], []))
+                ids.append(vector_id)
+                pages.append(location.get("page", 1))
+
+        empty = np.array([], dtype=np.int64)
+        for file_id, (ids, pages) in added.items():
+            old_ids, old_pages = self._file_vectors.get(file_id, (empty, empty))
+            all_ids = np.concatenate([old_ids, np.array(ids, dtype=np.int64)])
+            all_pages = np.concatenate([old_pages, np.array(pages, dtype=np.int64)])
+            order = np.argsort(all_pages, kind="stable")
+            # Replaced rather than updated, so searches need no lock to read
+            self._file_vectors[file_id] = (all_ids[order], all_pages[order])
+
+    def add_documents(self, docs: List[Document], embeddings: Embeddings):
+        """Embeds documents and adds them to the index. Safe to call while
+        the index is being searched."""
+        texts = [doc.page_content for doc in docs]
+        metadatas = [doc.metadata for doc in docs]
+
+        if isinstance(self.index, ShardedVectorStore):
+            # Shards are locked and embed the documents themselves
+            self.index.add_texts(texts, metadatas)
+            return
+
+        if not isinstance(self.index, FAISS):
+            with self._lock:
+                first_id = len(getattr(self.index, "texts", []))
+                self.index.add_texts(texts, metadatas)
+                self._register_documents(docs, first_id)
+            return
+
+        # Only adding the vectors blocks searches, not embedding them
+        vectors = embeddings.embed_documents(texts)
+        with self._lock:
+            first_id = self.index.index.ntotal
+            self.index.add_embeddings(zip(texts, vectors), metadatas)
+            self._register_documents(docs, first_id)
+
+    def _filter_file_ids(self, search_filter: SearchFilter) -> List[str]:
+        """Returns the ids of the files that match a filter"""
+        file_ids = search_filter.file_ids or [file.id for file in self.files]
+        if search_filter.file_types is None:
+            return file_ids
+
+        file_types = {file_type.lower() for file_type in search_filter.file_types}
+        file_names = {file.id: file.name for file in self.files}
+        return [
+            file_id
+            for file_id in file_ids
+            if file_names.get(file_id, "").rsplit(".", 1)[-1].lower() in file_types
+        ]
+
+    def filter_vector_ids(self, search_filter: SearchFilter) -> np.ndarray:
+        """Returns the ids of the vectors that match a filter. Only the
+        page range of the selected files is looked at."""
+        matches = []
+        for file_id in self._filter_file_ids(search_filter):
+            if file_id not in self._file_vectors:
+                continue
+            ids, pages = self._file_vectors[file_id]
+            if search_filter.pages is not None:
+                first, last = search_filter.pages
+                start = np.searchsorted(pages, first, side="left")
+                end = np.searchsorted(pages, last, side="right")
+                ids = ids[start:end]
+            matches.append(ids)
+
+        return np.unique(np.concatenate(matches)) if matches else np.array([], int)
+
+    def search_by_vector(
+        self,
+        query_vector: np.ndarray,
+        k: int,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> Tuple[np.ndarray, List[Document], np.ndarray]:
+        """Returns the (L2) distances, documents and vectors of the k nearest
+        documents to a query vector. Only for FAISS indexes. With a
+        search_filter, only the vectors of the matching files and pages are
+        searched."""
+        vector_ids = None
+        if search_filter is not None:
+            vector_ids = self.filter_vector_ids(search_filter)
+
+        with self._lock:
+            if vector_ids is None:
+                distances, ids = self.index.index.search(query_vector[None, :], k)
+                distances, ids = distances[0][ids[0] != -1], ids[0][ids[0] != -1]
+            else:
+                # Brute force over the selected vectors only, with the same
+                # distance as the index
+                candidates = self.index.index.reconstruct_batch(vector_ids)
+                distances = ((candidates - query_vector) ** 2).sum(axis=1)
+                top = np.argsort(distances, kind="stable")[:k]
+                distances, ids = distances[top], vector_ids[top]
+            if len(ids) == 0:
+                return distances, [], np.empty((0, len(query_vector)), np.float32)
+
+            vectors = self.index.index.reconstruct_batch(ids)
+            docs = [
+                self.index.docstore.search(self.index.index_to_docstore_id[i])
+                for i in ids
+            ]
+        return distances, docs, vectors  # type: ignore
+
+    def _has_vectors(self) -> bool:
+        """Whether the vector store can be searched by vector"""
+        return isinstance(self.index, (FAISS, ShardedVectorStore))
+
+    def _embed_query(
+        self, query: str, counter: Optional[TokenCounter] = None
+    ) -> np.ndarray:
+        embeddings = self.embeddings
+        requested = True
+        if isinstance(embeddings, CoalescingEmbeddings):
+            vector, requested = embeddings.embed_query_requested(query)
+        elif isinstance(self.index, ShardedVectorStore):
+            vector = self.index.embedding.embed_query(query)
+        else:
+            vector = self.index.embedding_function(query)  # type: ignore
+        if requested:
+            self._count_query(query, counter)
+        return np.array(vector, dtype=np.float32)
+
+    def _count_query(self, query: str, counter: Optional[TokenCounter]):
+        """Adds the tokens of embedding a query to counter"""
+        if counter is not None:
+            model = model_name(self.embeddings)
+            counter.add(embedding_tokens=count_tokens(query, model))
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        """The embeddings of the queries, if the index keeps them"""
+        if isinstance(self.index, ShardedVectorStore):
+            return self.index.embedding
+        # FAISS keeps the embed_query method of its embeddings
+        embeddings = getattr(
+            getattr(self.index, "embedding_function", None), "__self__", None
+        )
+        return embeddings if isinstance(embeddings, Embeddings) else None
+
+    async def _aembed_query(
+        self, query: str, counter: Optional[TokenCounter] = None
+    ) -> np.ndarray:
+        embeddings = self.embeddings
+        requested = True
+        if isinstance(embeddings, CoalescingEmbeddings):
+            vector, requested = await embeddings.aembed_query_requested(query)
+        elif embeddings is not None:
+            vector = await aembed_query(embeddings, query)
+        else:
+            loop = asyncio.get_running_loop()
+            vector = await loop.run_in_executor(
+                None, self.index.embedding_function, query  # type: ignore
+            )
+        if requested:
+            self._count_query(query, counter)
+        return np.array(vector, dtype=np.float32)
+
+    def _nearest(
+        self,
+        query_vector: np.ndarray,
+        fetch_k: int,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> Tuple[List[Document], np.ndarray]:
+        """Returns the fetch_k nearest documents to a query vector with
+        their vectors"""
+        if isinstance(self.index, ShardedVectorStore):
+            if search_filter is not None:
+                # Shards do not know the file names, so file types are
+                # resolved to file ids here
+                search_filter = SearchFilter(
+                    file_ids=self._filter_file_ids(search_filter),
+                    pages=search_filter.pages,
+                )
+            _, docs, vectors = self.index.search_by_vector(
+                query_vector, fetch_k, search_filter
+            )
+        else:
+            _, docs, vectors = self.search_by_vector(
+                query_vector, fetch_k, search_filter
+            )
+        return docs, vectors
+
+    def _filter_documents(
+        self, docs: List[Document], search_filter: Optional[SearchFilter]
+    ) -> List[Document]:
+        """Drops the documents that do not match a filter, for vector stores
+        that cannot be searched by vector ids"""
+        if search_filter is None:
+            return docs
+
+        file_ids = set(self._filter_file_ids(search_filter))
+        first, last = search_filter.pages or (-np.inf, np.inf)
+        return [
+            doc
+            for doc in docs
+            if doc.metadata.get("file_id") in file_ids
+            and first <= doc.metadata.get("page", 1) <= last
+        ]
+
+    @staticmethod
+    def _rerank(
+        query_vector: np.ndarray,
+        docs: List[Document],
+        vectors: np.ndarray,
+        k: int,
+        lambda_mult: float,
+        min_k: int,
+        relevance_ratio: float,
+    ) -> List[Document]:
+        """Selects docs with MMR and adaptive k. The returned docs are copies
+        whose metadata["ranking"] records their relevance, MMR score and rank,
+        and why the results were cut where they were."""
+        selected, mmr_scores = maximal_marginal_relevance_scores(
+            query_vector, vectors, k, lambda_mult
+        )
+        relevance = normalize_rows(vectors[selected]) @ normalize_rows(query_vector)
+        keep = adaptive_k(relevance, min_k=min_k, relevance_ratio=relevance_ratio)
+        cutoff = cutoff_reason(relevance, keep, k, min_k, relevance_ratio)
+
+        ranked = []
+        for rank, i in enumerate(selected):
+            ranking = dict(
+                rank=rank + 1,
+                relevance=float(relevance[rank]),
+                mmr_score=mmr_scores[rank],
+                cutoff=cutoff,
+            )
+            logger.debug(
+                "%s %s: %s",
+                "kept" if rank < keep else "dropped",
+                docs[i].metadata.get("source"),
+                ranking,
+            )
+            if rank < keep:
+                ranked.append(
+                    Document(
+                        page_content=docs[i].page_content,
+                        metadata={**docs[i].metadata, "ranking": ranking},
+                    )
+                )
+        return ranked
+
+    def search(
+        self,
+        query: str,
+        k: int = 5,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.7,
+        min_k: int = 2,
+        relevance_ratio: float = 0.9,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> List[Document]:
+        """Retrieves up to k documents for a query. The fetch_k nearest
+        documents are re-ranked with maximal marginal relevance so that near
+        identical chunks do not crowd out the rest, and results much less
+        relevant than the best one are dropped (keeping at least min_k).
+        Falls back to a plain similarity search for other vector stores.
+
+        With a search_filter, only the vectors of the matching files and pages
+        are searched.
+        """
+        docs, _ = self.search_with_vector(
+            query, k, fetch_k, lambda_mult, min_k, relevance_ratio, search_filter
+        )
+        return docs
+
+    def search_with_vector(
+        self,
+        query: str,
+        k: int = 5,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.7,
+        min_k: int = 2,
+        relevance_ratio: float = 0.9,
+        search_filter: Optional[SearchFilter] = None,
+        counter: Optional[TokenCounter] = None,
+    ) -> Tuple[List[Document], Optional[np.ndarray]]:
+        """Like search, but also returns the vector of the query (None for
+        vector stores that embed queries themselves), so that it is not
+        embedded again. The tokens of embedding the query are added to
+        counter, unless its vector was already known (see
+        CoalescingEmbeddings)."""
+        if not self._has_vectors():
+            self._count_query(query, counter)
+            with self._lock:
+                docs = self.index.similarity_search(query, k=k)
+            return self._filter_documents(docs, search_filter), None
+
+        query_vector = self._embed_query(query, counter)
+        docs, vectors = self._nearest(query_vector, max(fetch_k, k), search_filter)
+        docs = self._rerank(
+            query_vector, docs, vectors, k, lambda_mult, min_k, relevance_ratio
+        )
+        return docs, query_vector
+
+    async def asearch(
+        self,
+        query: str,
+        k: int = 5,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.7,
+        min_k: int = 2,
+        relevance_ratio: float = 0.9,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> List[Document]:
+        """Async version of search. The query is embedded with the async
+        client of the embeddings, if they have one, and the index is searched
+        on a worker thread."""
+        docs, _ = await self.asearch_with_vector(
+            query, k, fetch_k, lambda_mult, min_k, relevance_ratio, search_filter
+        )
+        return docs
+
+    async def asearch_with_vector(
+        self,
+        query: str,
+        k: int = 5,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.7,
+        min_k: int = 2,
+        relevance_ratio: float = 0.9,
+        search_filter: Optional[SearchFilter] = None,
+        counter: Optional[TokenCounter] = None,
+    ) -> Tuple[List[Document], Optional[np.ndarray]]:
+        """Async version of search_with_vector"""
+        loop = asyncio.get_running_loop()
+        if not self._has_vectors():
+            search = partial(
+                self.search_with_vector,
+                query,
+                k=k,
+                search_filter=search_filter,
+                counter=counter,
+            )
+            return await loop.run_in_executor(None, search)
+
+        query_vector = await self._aembed_query(query, counter)
+        # Searching (or waiting for the shards) would block the event loop,
+        # e.g. on the index lock while documents are added in the background
+        nearest = partial(self._nearest, query_vector, max(fetch_k, k), search_filter)
+        docs, vectors = await loop.run_in_executor(None, nearest)
+        docs = self._rerank(
+            query_vector, docs, vectors, k, lambda_mult, min_k, relevance_ratio
+        )
+        return docs, query_vector
+
     @classmethod
     def from_files(
-        cls, files: List[File], embeddings: Embeddings, vector_store: Type[VectorStore]
+        cls,
+        files: List[File],
+        embeddings: Embeddings,
+        vector_store: Type[VectorStore],
+        deduplicate: bool = True,
     ) -> "FolderIndex":
-        """Creates an index from files."""
+        """Creates an index from files. Duplicate chunks (e.g. repeated
+        headers and disclaimers) are embedded only once if deduplicate is set.
+        """
 
-        all_docs = cls._combine_files(files)
+        all_docs, dedup_ratio = cls._combine_and_deduplicate(files, deduplicate)
+
+        return cls.from_documents(
+            files=files,
+            docs=all_docs,
+            embeddings=embeddings,
+            vector_store=vector_store,
+            dedup_ratio=dedup_ratio,
+        )
+
+    @classmethod
+    def from_documents(
+        cls,
+        files: List[File],
+        docs: List[Document],
+        embeddings: Embeddings,
+        vector_store: Type[VectorStore],
+        dedup_ratio: float = 0,
+    ) -> "FolderIndex":
+        """Creates an index of files from (some of) their documents."""
 
         index = vector_store.from_documents(
-            documents=all_docs,
+            documents=docs,
             embedding=embeddings,
         )
 
-        return cls(files=files, index=index)
+        folder_index = cls(files=files, index=index, dedup_ratio=dedup_ratio)
+        folder_index._register_documents(docs, first_id=0)
+        return folder_index
+
+    @classmethod
+    async def afrom_files(
+        cls,
+        files: List[File],
+        embeddings: Embeddings,
+        vector_store: Type[VectorStore],
+        deduplicate: bool = True,
+        batch_size: int = 128,
+        max_concurrency: int = 4,
+    ) -> "FolderIndex":
+        """Async version of from_files. The documents are embedded in batches
+        of batch_size, with at most max_concurrency requests in flight."""
+        loop = asyncio.get_running_loop()
+        docs, dedup_ratio = await loop.run_in_executor(
+            None, cls._combine_and_deduplicate, files, deduplicate
+        )
+
+        if not issubclass(vector_store, FAISS):
+            # Other vector stores embed the documents themselves
+            build = partial(
+                cls.from_documents,
+                files=files,
+                docs=docs,
+                embeddings=embeddings,
+                vector_store=vector_store,
+                dedup_ratio=dedup_ratio,
+            )
+            return await loop.run_in_executor(None, build)
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def embed(texts: List[str]) -> List[List[float]]:
+            async with semaphore:
+                return await aembed_documents(embeddings, texts)
+
+        texts = [doc.page_content for doc in docs]
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            end = start + batch_size
+            batches.append(texts[start:end])
+        results = await asyncio.gather(*(embed(batch) for batch in batches))
+        vectors = [vector for result in results for vector in result]
+
+        index = FAISS.from_embeddings(
+            list(zip(texts, vectors)),
+            embeddings,
+            metadatas=[doc.metadata for doc in docs],
+        )
+        folder_index = cls(files=files, index=index, dedup_ratio=dedup_ratio)
+        folder_index._register_documents(docs, first_id=0)
+        return folder_index
+
+
+async def aembed_documents(
+    embeddings: Embeddings, texts: List[str]
+) -> List[List[float]]:
+    """Embeds documents with the async client of the embeddings, or on a
+    worker thread if they do not have one"""
+    try:
+        return await embeddings.aembed_documents(texts)
+    except NotImplementedError:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, embeddings.embed_documents, texts)
+
+
+async def aembed_query(embeddings: Embeddings, text: str) -> List[float]:
+    """Embeds a query with the async client of the embeddings, or on a
+    worker thread if they do not have one"""
+    try:
+        return await embeddings.aembed_query(text)
+    except NotImplementedError:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, embeddings.embed_query, text)
 
 
 def embed_files(
-    files: List[File], embedding: str, vector_store: str, **kwargs
+    files: List[File],
+    embedding: str,
+    vector_store: str,
+    deduplicate: bool = True,
+    **kwargs,
 ) -> FolderIndex:
     """Embeds a collection of files and stores them in a FolderIndex."""
 
+    return FolderIndex.from_files(
+        files=files,
+        embeddings=get_embeddings(embedding, **kwargs),
+        vector_store=get_vector_store(vector_store),
+        deduplicate=deduplicate,
+    )
+
+
+async def aembed_files(
+    files: List[File],
+    embedding: str,
+    vector_store: str,
+    deduplicate: bool = True,
+    batch_size: int = 128,
+    max_concurrency: int = 4,
+    **kwargs,
+) -> FolderIndex:
+    """Async version of embed_files, embedding batches concurrently."""
+
+    return await FolderIndex.afrom_files(
+        files=files,
+        embeddings=get_embeddings(embedding, **kwargs),
+        vector_store=get_vector_store(vector_store),
+        deduplicate=deduplicate,
+        batch_size=batch_size,
+        max_concurrency=max_concurrency,
+    )
+
+
+# Embeddings are shared by all the indexes with the same settings, so that
+# the queries of different sessions can be embedded together. The settings
+# include the API key, so they are keyed by a hash, and only the embeddings
+# of the most recently used settings are kept.
+MAX_COALESCING_EMBEDDINGS = 64
+_coalescing_embeddings: "OrderedDict[str, CoalescingEmbeddings]" = OrderedDict()
+_coalescing_lock = threading.Lock()
+
+
+def get_embeddings(embedding: str, coalesce: bool = True, **kwargs) -> Embeddings:
+    """Returns the embeddings with the given name. If coalesce is set,
+    concurrent query embeddings are batched into one request."""
     supported_embeddings: dict[str, Type[Embeddings]] = {
         "openai": OpenAIEmbeddings,
         "debug": FakeEmbeddings,
     }
+
+    if embedding not in supported_embeddings:
+        raise NotImplementedError(f"Embedding {embedding} not supported.")
+
+    if not coalesce:
+        return supported_embeddings[embedding](**kwargs)
+
+    key = content_hash(repr((embedding, sorted(kwargs.items()))).encode("utf-8"))
+    with _coalescing_lock:
+        if key not in _coalescing_embeddings:
+            _coalescing_embeddings[key] = CoalescingEmbeddings(
+                supported_embeddings[embedding](**kwargs)
+            )
+            while len(_coalescing_embeddings) > MAX_COALESCING_EMBEDDINGS:
+                _coalescing_embeddings.popitem(last=False)
+        _coalescing_embeddings.move_to_end(key)
+        return _coalescing_embeddings[key]
+
+
+def get_vector_store(vector_store: str) -> Type[VectorStore]:
     supported_vector_stores: dict[str, Type[VectorStore]] = {
         "faiss": FAISS,
         "debug": FakeVectorStore,
+        "sharded": ShardedVectorStore,
     }
 
-    if embedding in supported_embeddings:
-        _embeddings = supported_embeddings[embedding](**kwargs)
-    else:
-        raise NotImplementedError(f"Embedding {embedding} not supported.")
-
     if vector_store in supported_vector_stores:
-        _vector_store = supported_vector_stores[vector_store]
-    else:
-        raise NotImplementedError(f"Vector store {vector_store} not supported.")
+        return supported_vector_stores[vector_store]
 
-    return FolderIndex.from_files(
-        files=files, embeddings=_embeddings, vector_store=_vector_store
-    )
+    raise NotImplementedError(f"Vector store {vector_store} not supported.")
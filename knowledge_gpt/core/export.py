@@ -0,0 +1,189 @@
+import json
+from typing import Dict, Iterator, List, Type
+
+import faiss
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.faiss import FAISS
+
+from knowledge_gpt.core.embedding import FolderIndex
+from knowledge_gpt.core.parsing import DocxFile, File, PdfFile, TxtFile
+
+# Key of the index settings in the schema metadata
+METADATA_KEY = b"knowledge_gpt"
+
+# Columns stored as is in the metadata of the documents
+METADATA_COLUMNS = ["file_id", "file_name", "page", "chunk", "source", "token_count"]
+
+FILE_TYPES: Dict[str, Type[File]] = {"pdf": PdfFile, "docx": DocxFile, "txt": TxtFile}
+
+
+def chunk_schema(dimensions: int) -> pa.Schema:
+    """Schema of exported chunks, one row per vector in the index"""
+    return pa.schema(
+        [
+            ("file_id", pa.string()),
+            ("file_name", pa.string()),
+            ("page", pa.int32()),
+            ("chunk", pa.int32()),
+            ("source", pa.string()),
+            ("text", pa.string()),
+            ("token_count", pa.int32()),
+            # JSON list of the locations of the chunks deduplicated into this one
+            ("duplicates", pa.string()),
+            ("embedding", pa.list_(pa.float32(), dimensions)),
+        ]
+    )
+
+
+def iter_record_batches(
+    folder_index: FolderIndex, batch_size: int = 4096
+) -> Iterator[pa.RecordBatch]:
+    """Yields the chunks and vectors of a FAISS index in batches, in the
+    order of their vector ids. Only one batch of vectors is held at a time.
+    """
+    if not isinstance(folder_index.index, FAISS):
+        raise NotImplementedError("Only FAISS indexes can be exported.")
+
+    store = folder_index.index
+    schema = chunk_schema(store.index.d)
+    with folder_index._lock:
+        total = store.index.ntotal
+
+    for start in range(0, total, batch_size):
+        end = min(start + batch_size, total)
+        with folder_index._lock:
+            vectors = store.index.reconstruct_n(start, end - start)
+            docs = [
+                store.docstore.search(store.index_to_docstore_id[i])
+                for i in range(start, end)
+            ]
+        texts = [doc.page_content for doc in docs]  # type: ignore
+        metadatas = [doc.metadata for doc in docs]  # type: ignore
+
+        def column(key: str) -> list:
+            return [metadata.get(key) for metadata in metadatas]
+
+        duplicates = [
+            json.dumps(metadata["duplicates"]) if "duplicates" in metadata else None
+            for metadata in metadatas
+        ]
+        embeddings = pa.FixedSizeListArray.from_arrays(
+            pa.array(vectors.astype(np.float32, copy=False).ravel()), store.index.d
+        )
+        yield pa.RecordBatch.from_arrays(
+            [
+                pa.array(column("file_id"), pa.string()),
+                pa.array(column("file_name"), pa.string()),
+                pa.array(column("page"), pa.int32()),
+                pa.array(column("chunk"), pa.int32()),
+                pa.array(column("source"), pa.string()),
+                pa.array(texts, pa.string()),
+                pa.array(column("token_count"), pa.int32()),
+                pa.array(duplicates, pa.string()),
+                embeddings,
+            ],
+            schema=schema,
+        )
+
+
+def export_index(folder_index: FolderIndex, path: str, row_group_size: int = 4096):
+    """Writes the chunks and vectors of a FAISS index to a Parquet file,
+    one row group at a time."""
+    if not isinstance(folder_index.index, FAISS):
+        raise NotImplementedError("Only FAISS indexes can be exported.")
+
+    schema = chunk_schema(folder_index.index.index.d).with_metadata(
+        {
+            METADATA_KEY: json.dumps(
+                {"name": folder_index.name, "dedup_ratio": folder_index.dedup_ratio}
+            )
+        }
+    )
+    with pq.ParquetWriter(path, schema) as writer:
+        for batch in iter_record_batches(folder_index, batch_size=row_group_size):
+            writer.write_batch(batch, row_group_size=row_group_size)
+
+
+def index_from_table(table: pa.Table, embeddings: Embeddings) -> FolderIndex:
+    """Builds a FolderIndex from exported chunks without embedding them.
+    The vectors are read from the embedding column without copying, and
+    embeddings is only used to embed queries."""
+    vectors = _embedding_matrix(table.column("embedding"))
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+
+    columns = table.drop(["embedding"]).to_pydict()
+    docs: List[Document] = []
+    for i in range(table.num_rows):
+        metadata = {
+            key: columns[key][i]
+            for key in METADATA_COLUMNS
+            if columns[key][i] is not None
+        }
+        if columns["duplicates"][i] is not None:
+            metadata["duplicates"] = json.loads(columns["duplicates"][i])
+        docs.append(Document(page_content=columns["text"][i], metadata=metadata))
+
+    store = FAISS(
+        embedding_function=embeddings.embed_query,
+        index=index,
+        docstore=InMemoryDocstore({str(i): doc for i, doc in enumerate(docs)}),
+        index_to_docstore_id={i: str(i) for i in range(len(docs))},
+    )
+
+    settings = json.loads((table.schema.metadata or {}).get(METADATA_KEY, b"{}"))
+    folder_index = FolderIndex(
+        files=_files_from_documents(docs),
+        index=store,
+        dedup_ratio=settings.get("dedup_ratio", 0),
+    )
+    folder_index.name = settings.get("name", folder_index.name)
+    folder_index._register_documents(docs, first_id=0)
+    return folder_index
+
+
+def import_index(path: str, embeddings: Embeddings) -> FolderIndex:
+    """Reads a FolderIndex exported with export_index. The file is memory
+    mapped, so the vectors are only copied once, into the FAISS index."""
+    table = pq.read_table(path, memory_map=True)
+    return index_from_table(table, embeddings)
+
+
+def _embedding_matrix(column: pa.ChunkedArray) -> np.ndarray:
+    """Returns the vectors of a fixed size list column as a matrix, without
+    copying if the column is in one chunk and has no nulls."""
+    array = column.combine_chunks() if column.num_chunks != 1 else column.chunk(0)
+    dimensions = array.type.list_size
+    values = array.flatten().to_numpy(zero_copy_only=array.null_count == 0)
+    return np.ascontiguousarray(values.reshape(-1, dimensions), dtype=np.float32)
+
+
+def _files_from_documents(docs: List[Document]) -> List[File]:
+    """Rebuilds the files of exported chunks, including the chunks that were
+    deduplicated, so that sources can be looked up in them."""
+    files: Dict[str, File] = {}
+
+    def add(location: dict, text: str):
+        file_id = location.get("file_id", "")
+        if file_id not in files:
+            name = location.get("file_name", file_id)
+            file_type = FILE_TYPES.get(name.rsplit(".", 1)[-1].lower(), TxtFile)
+            files[file_id] = file_type(name=name, id=file_id)
+        metadata = {k: v for k, v in location.items() if k != "duplicates"}
+        files[file_id].docs.append(Document(page_content=text, metadata=metadata))
+
+    for doc in docs:
+        add(doc.metadata, doc.page_content)
+        for location in doc.metadata.get("duplicates", []):
+            add(location, doc.page_content)
+
+    for file in files.values():
+        file.docs.sort(
+            key=lambda doc: (doc.metadata.get("page", 1), doc.metadata.get("chunk", 0))
+        )
+    return list(files.values())
@@ -0,0 +1,156 @@
+import atexit
+import pickle
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.faiss import FAISS
+from pydantic import BaseModel
+
+from knowledge_gpt.core.embedding import FolderIndex
+from knowledge_gpt.core.sharding import ShardedVectorStore
+
+
+def index_size(folder_index: FolderIndex) -> int:
+    """Estimates the memory in bytes used by a FolderIndex in this process:
+    its vectors and the text of its documents. The vectors and documents of
+    sharded indexes are held by the shard processes and are not counted.
+    """
+    size = sum(
+        len(doc.page_content) for file in folder_index.files for doc in file.docs
+    )
+
+    store = folder_index.index
+    if isinstance(store, FAISS):
+        size += store.index.ntotal * store.index.d * 4  # float32 vectors
+        size += sum(
+            len(doc.page_content)
+            for doc in getattr(store.docstore, "_dict", {}).values()
+        )
+    else:
+        size += sum(len(text) for text in getattr(store, "texts", []))
+    return size
+
+
+class PoolStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+    spills: int = 0
+    reloads: int = 0
+
+
+class IndexPool:
+    """Keeps FolderIndexes in memory up to max_bytes. When the budget is
+    exceeded, the least recently used indexes are spilled to spill_dir and
+    loaded back the next time they are requested. The most recently used
+    index is always kept in memory, even if it alone exceeds the budget.
+    Sharded indexes are never spilled, since their vectors are held by the
+    shard workers and spilling them would copy them into this process.
+    Sharded indexes that lost documents with a worker are dropped on get,
+    so that they are built again.
+
+    Spill files are deleted once loaded back, and when the pool is closed
+    or the process exits. They do not contain the embeddings (and so the
+    API keys) of the indexes, which are kept in memory and reattached.
+    """
+
+    def __init__(self, max_bytes: int, spill_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        # A temporary spill directory is removed with its files on close
+        self._temporary_dir = spill_dir is None
+        self.spill_dir = Path(spill_dir or tempfile.mkdtemp(prefix="knowledge_gpt_"))
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        self.stats = PoolStats()
+        self._indexes: "OrderedDict[str, Tuple[FolderIndex, int]]" = OrderedDict()
+        self._spilled: Dict[str, Tuple[Path, Optional[Embeddings]]] = {}
+        self._lock = threading.RLock()
+        atexit.register(self.close)
+
+    @property
+    def memory_usage(self) -> int:
+        """Total size in bytes of the indexes held in memory"""
+        with self._lock:
+            return sum(size for _, size in self._indexes.values())
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._indexes.keys() | self._spilled.keys())
+
+    def get(self, key: str) -> Optional[FolderIndex]:
+        """Returns the index stored under key, loading it from disk if it was
+        spilled, or None if there is no such index."""
+        with self._lock:
+            if key in self._indexes:
+                folder_index = self._indexes[key][0]
+                if isinstance(folder_index.index, ShardedVectorStore) and (
+                    folder_index.index.lost_shards
+                ):
+                    # Dropped so that the index is built again
+                    del self._indexes[key]
+                    self.stats.misses += 1
+                    return None
+                self._indexes.move_to_end(key)
+                self.stats.hits += 1
+                return folder_index
+
+            if key not in self._spilled:
+                self.stats.misses += 1
+                return None
+
+            path, embeddings = self._spilled.pop(key)
+            with open(path, "rb") as f:
+                folder_index = pickle.load(f)
+            path.unlink()
+            if embeddings is not None:
+                folder_index.attach_embeddings(embeddings)
+            self.stats.reloads += 1
+            self._add(key, folder_index)
+            return folder_index
+
+    def put(self, key: str, folder_index: FolderIndex):
+        """Stores an index under key"""
+        with self._lock:
+            self._add(key, folder_index)
+
+    def get_or_create(self, key: str, create: Callable[[], FolderIndex]) -> FolderIndex:
+        """Returns the index stored under key, or creates and stores it"""
+        folder_index = self.get(key)
+        if folder_index is None:
+            folder_index = create()
+            self.put(key, folder_index)
+        return folder_index
+
+    def _add(self, key: str, folder_index: FolderIndex):
+        self._indexes[key] = (folder_index, index_size(folder_index))
+        self._indexes.move_to_end(key)
+
+        while self.memory_usage > self.max_bytes:
+            evicted_key = next(
+                (
+                    k
+                    for k, (index, _) in self._indexes.items()
+                    if k != key and not isinstance(index.index, ShardedVectorStore)
+                ),
+                None,
+            )
+            if evicted_key is None:
+                break
+            evicted, _ = self._indexes.pop(evicted_key)
+            path = self.spill_dir / f"{evicted_key}.pkl"
+            with open(path, "wb") as f:
+                pickle.dump(evicted, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self._spilled[evicted_key] = (path, evicted.embeddings)
+            self.stats.spills += 1
+
+    def close(self):
+        """Deletes the spill files"""
+        with self._lock:
+            for path, _ in self._spilled.values():
+                path.unlink(missing_ok=True)
+            self._spilled.clear()
+            if self._temporary_dir:
+                shutil.rmtree(self.spill_dir, ignore_errors=True)
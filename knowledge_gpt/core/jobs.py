@@ -0,0 +1,181 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from langchain.docstore.document import Document
+from knowledge_gpt.core.embedding import FolderIndex, get_embeddings, get_vector_store
+from knowledge_gpt.core.index_pool import IndexPool
+from knowledge_gpt.core.parsing import File
+from knowledge_gpt.core.usage import UsageLedger, model_name, upload_usage
+
+
+class IndexingJob:
+    """Embeds the documents of files in batches. The index is available
+    (and can be queried) as soon as the first, smaller batch is embedded,
+    and grows as the job progresses. The usage of the documents that were
+    embedded is recorded in the usage ledger, if there is one."""
+
+    def __init__(
+        self,
+        files: List[File],
+        embedding: str,
+        vector_store: str,
+        deduplicate: bool = True,
+        first_batch_size: int = 16,
+        batch_size: int = 128,
+        usage_ledger: Optional[UsageLedger] = None,
+        **kwargs,
+    ):
+        self.files = files
+        self.embedding = embedding
+        self.vector_store = vector_store
+        self.deduplicate = deduplicate
+        self.first_batch_size = first_batch_size
+        self.batch_size = batch_size
+        self.usage_ledger = usage_ledger
+        self.kwargs = kwargs
+
+        self.total = 0
+        self.done = 0
+        self.folder_index: Optional[FolderIndex] = None
+        self.error: Optional[Exception] = None
+        self._finished = threading.Event()
+
+    @classmethod
+    def from_index(cls, folder_index: FolderIndex) -> "IndexingJob":
+        """Creates a finished job for an existing index"""
+        job = cls(files=folder_index.files, embedding="", vector_store="")
+        job.folder_index = folder_index
+        job._finished.set()
+        return job
+
+    @property
+    def finished(self) -> bool:
+        return self._finished.is_set()
+
+    @property
+    def progress(self) -> float:
+        """Fraction of the documents that were embedded"""
+        if self.total == 0:
+            return 1.0 if self.finished else 0.0
+        return self.done / self.total
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Waits until the job is finished. Returns False on timeout."""
+        return self._finished.wait(timeout)
+
+    def run(self):
+        embedded: List[Document] = []
+        try:
+            embeddings = get_embeddings(self.embedding, **self.kwargs)
+            vector_store = get_vector_store(self.vector_store)
+            docs, dedup_ratio = FolderIndex._combine_and_deduplicate(
+                self.files, self.deduplicate
+            )
+            self.total = len(docs)
+
+            start, end = 0, self.first_batch_size
+            while start < len(docs):
+                batch = docs[start:end]
+                if self.folder_index is None:
+                    self.folder_index = FolderIndex.from_documents(
+                        files=self.files,
+                        docs=batch,
+                        embeddings=embeddings,
+                        vector_store=vector_store,
+                        dedup_ratio=dedup_ratio,
+                    )
+                else:
+                    self.folder_index.add_documents(batch, embeddings)
+                embedded.extend(batch)
+                self.done += len(batch)
+                start, end = end, end + self.batch_size
+        except Exception as e:
+            self.error = e
+        finally:
+            if embedded:
+                self._record_usage(embedded, model_name(embeddings))
+            self._finished.set()
+
+    def _record_usage(self, embedded: List[Document], embedding_model: str):
+        """Records the usage of the embedded documents, per file"""
+        if self.usage_ledger is None:
+            return
+        for file in self.files:
+            docs = [doc for doc in embedded if doc.metadata.get("file_id") == file.id]
+            if docs:
+                self.usage_ledger.record(upload_usage(file, embedding_model, docs))
+
+
+class IndexingJobManager:
+    """Runs indexing jobs on a pool of worker threads. Jobs are identified
+    by a key (e.g. a hash of the file ids and embedding settings), so that
+    sessions indexing the same files share one job. Finished indexes are
+    handed over to the index pool, if there is one.
+    """
+
+    def __init__(
+        self,
+        pool: Optional[IndexPool] = None,
+        max_workers: int = 4,
+        usage_ledger: Optional[UsageLedger] = None,
+    ):
+        self.pool = pool
+        self.usage_ledger = usage_ledger
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="indexing"
+        )
+        self._jobs: Dict[str, IndexingJob] = {}
+        self._lock = threading.Lock()
+        self.jobs_started = 0
+
+    def submit(
+        self,
+        key: str,
+        files: List[File],
+        embedding: str,
+        vector_store: str,
+        **kwargs,
+    ) -> IndexingJob:
+        """Returns the job for key, starting it if there is no job in
+        progress and no finished index in the pool. Failed jobs are retried.
+        The lock only guards the jobs, since getting an index from the pool
+        and putting it there may read or write spilled indexes.
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.error is None:
+                return job
+
+        if self.pool is not None:
+            folder_index = self.pool.get(key)
+            if folder_index is not None:
+                return IndexingJob.from_index(folder_index)
+
+        with self._lock:
+            # Another session may have started the job in the meantime
+            job = self._jobs.get(key)
+            if job is not None and job.error is None:
+                return job
+
+            job = IndexingJob(
+                files,
+                embedding,
+                vector_store,
+                usage_ledger=self.usage_ledger,
+                **kwargs,
+            )
+            self._jobs[key] = job
+            self.jobs_started += 1
+            self._executor.submit(self._run, key, job)
+            return job
+
+    def _run(self, key: str, job: IndexingJob):
+        job.run()
+        if job.error is not None or self.pool is None or job.folder_index is None:
+            return
+        # The job is found in the jobs until its index is in the pool
+        self.pool.put(key, job.folder_index)
+        with self._lock:
+            if self._jobs.get(key) is job:
+                del self._jobs[key]
@@ -1,11 +1,19 @@
-from io import BytesIO
-from typing import List, Any, Optional
+from collections import OrderedDict
+from concurrent.futures import Executor
+from io import BytesIO, UnsupportedOperation
+from typing import List, Any, Optional, Iterator, BinaryIO, Union, Tuple
+import asyncio
+import codecs
+import mmap
+import os
 import re
+import threading
+import zipfile
+from xml.etree.ElementTree import iterparse
 
-import docx2txt
 from langchain.docstore.document import Document
 import fitz
-from hashlib import md5
+from hashlib import blake2b
 
 from abc import abstractmethod, ABC
 from copy import deepcopy
@@ -57,20 +65,230 @@ def strip_consecutive_newlines(text: str) -> str:
     return re.sub(r"\s*\n\s*", "\n", text)
 
 
+def new_content_hash() -> blake2b:
+    """Returns a hash object for file contents. BLAKE2b is faster than md5
+    on 64-bit machines."""
+    return blake2b(digest_size=16)
+
+
+def content_hash(data: Union[bytes, memoryview, mmap.mmap]) -> str:
+    """Returns a hash of the contents of a file"""
+    file_hash = new_content_hash()
+    file_hash.update(data)
+    return file_hash.hexdigest()
+
+
+class Upload:
+    """The bytes of an uploaded file. They are read once and shared by the
+    parsers, the File id and the cache key, without copying except for
+    memory-mapped PDFs (see PdfFile). Memory-mapped files are unmapped by
+    close(), or when used as a context manager."""
+
+    def __init__(self, name: str, data: Union[bytes, mmap.mmap]):
+        self.name = name
+        self.data = data
+        self._id: Optional[str] = None
+
+    @property
+    def view(self) -> memoryview:
+        return memoryview(self.data)
+
+    @property
+    def id(self) -> str:
+        """The content hash of the upload, computed at most once"""
+        if self._id is None:
+            self._id = content_hash(self.data)
+        return self._id
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self) -> "Upload":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self) -> BinaryIO:
+        """Returns a seekable stream over the bytes"""
+        if isinstance(self.data, bytes):
+            # Shares the buffer of the bytes object
+            return BytesIO(self.data)
+        self.data.seek(0)
+        return self.data  # type: ignore
+
+    @classmethod
+    def from_file(cls, file: BytesIO) -> "Upload":
+        """Gets the Upload for a file object. Files backed by a file
+        descriptor are memory-mapped, other streams are read once. The
+        Uploads of the last Streamlit uploads are kept by file id, so that
+        later calls (e.g. from the cache key and the parser) reuse them.
+        """
+        file_id = upload_key(file)
+        if file_id is not None:
+            with _uploads_lock:
+                upload = _uploads.get(file_id)
+                if upload is not None:
+                    _uploads.move_to_end(file_id)
+                    return upload
+
+        try:
+            fileno = file.fileno()
+        except (AttributeError, OSError, UnsupportedOperation):
+            fileno = None
+
+        data: Union[bytes, mmap.mmap]
+        if fileno is not None and os.fstat(fileno).st_size > 0:
+            data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        elif isinstance(file, BytesIO):
+            # getvalue() does not copy the buffer of an unmodified BytesIO
+            data = file.getvalue()
+        else:
+            file.seek(0)
+            data = file.read()
+
+        upload = cls(name=file.name, data=data)
+        # Memory-mapped uploads are closed by their callers, so they are
+        # not shared
+        if file_id is not None and not isinstance(data, mmap.mmap):
+            with _uploads_lock:
+                _uploads[file_id] = upload
+                while len(_uploads) > MAX_CACHED_UPLOADS:
+                    _uploads.popitem(last=False)
+        return upload
+
+
+def upload_key(file: BytesIO) -> Optional[str]:
+    """The id Streamlit gave an uploaded file, if it is one. The id is
+    file_id (a str) since Streamlit 1.28 and id (an int) before."""
+    file_id = getattr(file, "file_id", None)
+    if file_id is None:
+        file_id = getattr(file, "id", None)
+    return None if file_id is None else str(file_id)
+
+
+# Uploads of Streamlit files (which have an id) read recently
+MAX_CACHED_UPLOADS = 16
+_uploads: "OrderedDict[str, Upload]" = OrderedDict()
+_uploads_lock = threading.Lock()
+
+
+# Namespace of the WordprocessingML elements in word/document.xml
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def iter_docx_pages(
+    stream: BinaryIO, page_size: int
+) -> Iterator[Tuple[int, str, Optional[str]]]:
+    """Incrementally parses word/document.xml of a .docx file and yields
+    (page number, text, heading) for each page. Pages end at page breaks
+    (rendered or explicit) and section breaks, or at the first paragraph
+    end after page_size characters. The heading is the one in effect at
+    the start of the page (or the one the page opens with), otherwise the
+    first heading on the page.
+    Parsed elements are cleared so memory does not grow with the document.
+    """
+    with zipfile.ZipFile(stream) as docx, docx.open("word/document.xml") as xml:
+        page = 1
+        lines: List[str] = []  # finished paragraphs of the current page
+        size = 0
+        parts: List[str] = []  # text of the current paragraph so far
+        heading: Optional[str] = None
+        page_heading: Optional[str] = None
+        is_heading = False
+        depth = 0
+        body = None
+
+        def flush_page() -> Iterator[Tuple[int, str, Optional[str]]]:
+            nonlocal page, lines, size, page_heading
+            text = strip_consecutive_newlines("\n".join(lines)).strip()
+            # Consecutive breaks (e.g. a page break and the rendered break
+            # Word writes after it) end one page
+            if text:
+                yield page, text, page_heading
+                page += 1
+            lines, size, page_heading = [], 0, heading
+
+        for event, elem in iterparse(xml, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if elem.tag == f"{W}body":
+                    body = elem
+                elif elem.tag == f"{W}lastRenderedPageBreak":
+                    # The text before the break belongs to the previous page
+                    lines.append("".join(parts))
+                    parts = []
+                    yield from flush_page()
+                continue
+
+            depth -= 1
+            tag = elem.tag
+            if tag == f"{W}t":
+                parts.append(elem.text or "")
+            elif tag == f"{W}tab":
+                parts.append("\t")
+            elif tag in (f"{W}br", f"{W}cr"):
+                if elem.get(f"{W}type") == "page":
+                    lines.append("".join(parts))
+                    parts = []
+                    yield from flush_page()
+                else:
+                    parts.append("\n")
+            elif tag == f"{W}pStyle":
+                style = elem.get(f"{W}val", "")
+                is_heading = style.startswith("Heading") or style == "Title"
+            elif tag == f"{W}p":
+                text = "".join(parts).strip()
+                parts = []
+                if is_heading and text:
+                    heading = text
+                    if page_heading is None or size == 0:
+                        page_heading = heading
+                is_heading = False
+                lines.append(text)
+                size += len(text)
+                # A sectPr in the paragraph properties ends a section
+                section_end = elem.find(f"{W}pPr/{W}sectPr") is not None
+                elem.clear()
+                if section_end or size >= page_size:
+                    yield from flush_page()
+
+            if depth == 2 and body is not None:
+                # Drop finished top-level elements (paragraphs, tables)
+                body.clear()
+
+        lines.append("".join(parts))
+        yield from flush_page()
+
+
 class DocxFile(File):
+    # Max number of characters in a page when the document has no breaks
+    page_size = 100_000
+
     @classmethod
     def from_bytes(cls, file: BytesIO) -> "DocxFile":
-        text = docx2txt.process(file)
-        text = strip_consecutive_newlines(text)
-        doc = Document(page_content=text.strip())
-        doc.metadata["source"] = "p-1"
-        return cls(name=file.name, id=md5(file.read()).hexdigest(), docs=[doc])
+        docs = []
+        with Upload.from_file(file) as upload:
+            for page, text, heading in iter_docx_pages(upload.open(), cls.page_size):
+                doc = Document(page_content=text)
+                doc.metadata["page"] = page
+                doc.metadata["source"] = f"p-{page}"
+                if heading is not None:
+                    doc.metadata["heading"] = heading
+                docs.append(doc)
+            return cls(name=upload.name, id=upload.id, docs=docs)
 
 
 class PdfFile(File):
     @classmethod
     def from_bytes(cls, file: BytesIO) -> "PdfFile":
-        pdf = fitz.open(stream=file.read(), filetype="pdf")  # type: ignore
+        with Upload.from_file(file) as upload:
+            # PyMuPDF only accepts bytes streams, so memory-mapped files are
+            # copied (which also keeps the data after the file is unmapped)
+            data = upload.data if isinstance(upload.data, bytes) else upload.data[:]
+            name, id = upload.name, upload.id
+        pdf = fitz.open(stream=data, filetype="pdf")  # type: ignore
         docs = []
         for i, page in enumerate(pdf):
             text = page.get_text(sort=True)
@@ -79,21 +297,99 @@ class PdfFile(File):
             doc.metadata["page"] = i + 1
             doc.metadata["source"] = f"p-{i+1}"
             docs.append(doc)
-        # file.read() mutates the file object, which can affect caching
-        # so we need to reset the file pointer to the beginning
-        file.seek(0)
-        return cls(name=file.name, id=md5(file.read()).hexdigest(), docs=docs)
+        return cls(name=name, id=id, docs=docs)
+
+
+def iter_blocks(data: memoryview, block_size: int) -> Iterator[memoryview]:
+    """Yields zero-copy slices of at most block_size bytes"""
+    for start in range(0, len(data), block_size):
+        yield data[start : start + block_size]
+
+
+def iter_text_pages(
+    blocks: Iterator[Union[bytes, memoryview]],
+    page_size: int,
+    encoding: str = "utf-8",
+) -> Iterator[str]:
+    """Incrementally decodes blocks of bytes, strips consecutive newlines
+    and yields pages of at most page_size characters, split on newlines
+    (or else spaces) where possible.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    # Whitespace at the end of a block is held back until the next block,
+    # since a run of whitespace may continue across the boundary
+    carry = ""
+    buffer = ""
+
+    def normalize(text: str, final: bool) -> str:
+        nonlocal carry
+        text = carry + text
+        if final:
+            carry = ""
+            return strip_consecutive_newlines(text)
+        stripped = text.rstrip()
+        carry = text[len(stripped) :]
+        return strip_consecutive_newlines(stripped)
+
+    def split_pages(final: bool) -> Iterator[str]:
+        nonlocal buffer
+        start = 0
+        # Until the last block, wait for more than a page, so that whether
+        # the page is followed by a separator is known
+        while len(buffer) - start > page_size or (final and start < len(buffer)):
+            end = start + page_size
+            cut = -1
+            if len(buffer) > end:
+                # A separator right after the page also ends it
+                cut = buffer.rfind("\n", start, end + 1)
+                if cut <= start:
+                    cut = buffer.rfind(" ", start, end + 1)
+            if cut <= start:
+                cut = min(end, len(buffer))
+            page = buffer[start:cut].strip()
+            start = cut
+            if page:
+                yield page
+        buffer = buffer[start:]
+
+    for block in blocks:
+        buffer += normalize(decoder.decode(block), final=False)
+        yield from split_pages(final=False)
+
+    buffer += normalize(decoder.decode(b"", final=True), final=True)
+    yield from split_pages(final=True)
 
 
 class TxtFile(File):
+    # Bytes decoded at a time and the max number of characters in each
+    # synthetic page, so that very large files are never held as one string
+    block_size = 1 << 20
+    page_size = 100_000
+
     @classmethod
     def from_bytes(cls, file: BytesIO) -> "TxtFile":
-        text = file.read().decode("utf-8", errors="replace")
-        text = strip_consecutive_newlines(text)
-        file.seek(0)
-        doc = Document(page_content=text.strip())
-        doc.metadata["source"] = "p-1"
-        return cls(name=file.name, id=md5(file.read()).hexdigest(), docs=[doc])
+        with Upload.from_file(file) as upload:
+            # Hash in the same pass as decoding unless the hash is already known
+            file_hash = new_content_hash() if upload._id is None else None
+
+            def blocks() -> Iterator[memoryview]:
+                with upload.view as view:
+                    for block in iter_blocks(view, cls.block_size):
+                        if file_hash is not None:
+                            file_hash.update(block)
+                        yield block
+                        block.release()
+
+            docs = []
+            for i, text in enumerate(iter_text_pages(blocks(), cls.page_size)):
+                doc = Document(page_content=text)
+                doc.metadata["page"] = i + 1
+                doc.metadata["source"] = f"p-{i+1}"
+                docs.append(doc)
+
+            if file_hash is not None:
+                upload._id = file_hash.hexdigest()
+            return cls(name=upload.name, id=upload.id, docs=docs)
 
 
 def read_file(file: BytesIO) -> File:
@@ -106,3 +402,10 @@ def read_file(file: BytesIO) -> File:
         return TxtFile.from_bytes(file)
     else:
         raise NotImplementedError(f"File type {file.name.split('.')[-1]} not supported")
+
+
+async def aread_file(file: BytesIO, executor: Optional[Executor] = None) -> File:
+    """Async version of read_file. Parsing is CPU bound, so it runs on the
+    executor (the event loop's default one if None)."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, read_file, file)
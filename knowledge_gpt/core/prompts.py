@@ -29,3 +29,29 @@ FINAL ANSWER:"""
 STUFF_PROMPT = PromptTemplate(
     template=template, input_variables=["summaries", "question"]
 )
+
+## A much shorter template with a one-line example, for compressed excerpts
+short_template = """Answer the question using only the document excerpts below. End with a "SOURCES" section citing the minimal set of sources used, e.g. "SOURCES: 1-32". If the excerpts do not contain the answer, say that you do not have enough information and leave SOURCES empty.
+
+QUESTION: {question}
+=========
+{summaries}
+=========
+FINAL ANSWER:"""
+
+SHORT_STUFF_PROMPT = PromptTemplate(
+    template=short_template, input_variables=["summaries", "question"]
+)
+
+## Used to pull the relevant parts out of a group of excerpts before the final answer
+extract_template = """Use the following document excerpts to find the text that is relevant to answering the question. Return the relevant text verbatim, followed by a "SOURCES" section citing the sources it came from. If none of the excerpts are relevant, reply with NONE and nothing else.
+
+QUESTION: {question}
+=========
+{summaries}
+=========
+RELEVANT TEXT:"""
+
+EXTRACT_PROMPT = PromptTemplate(
+    template=extract_template, input_variables=["summaries", "question"]
+)
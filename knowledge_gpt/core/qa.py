@@ -1,15 +1,49 @@
-from typing import List
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import partial
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Generator,
+    List,
+    NamedTuple,
+    Optional,
+)
+from langchain.chains import LLMChain
+from langchain.chains.combine_documents.base import format_document
 from langchain.chains.qa_with_sources import load_qa_with_sources_chain
-from knowledge_gpt.core.prompts import STUFF_PROMPT
+from langchain.chains.qa_with_sources.stuff_prompt import EXAMPLE_PROMPT
+from knowledge_gpt.core.prompts import STUFF_PROMPT, SHORT_STUFF_PROMPT, EXTRACT_PROMPT
+from knowledge_gpt.core.compression import acompress_documents, compress_documents
+from langchain.embeddings.base import Embeddings
 from langchain.docstore.document import Document
-from knowledge_gpt.core.embedding import FolderIndex
+from knowledge_gpt.core.embedding import FolderIndex, SearchFilter
 from pydantic import BaseModel
 from langchain.chat_models.base import BaseChatModel
+from langchain.chains.combine_documents.base import BaseCombineDocumentsChain
+from knowledge_gpt.core.singleflight import SingleFlight
+from knowledge_gpt.core.usage import (
+    TokenCounter,
+    UsageLedger,
+    UsageRecord,
+    count_tokens,
+    model_name,
+    prompt_tokens,
+    query_usage,
+)
+from langchain.prompts import PromptTemplate
+
+# Identical questions asked at the same time share one answer
+_queries = SingleFlight()
 
 
 class AnswerWithSources(BaseModel):
     answer: str
     sources: List[Document]
+    # Tokens and estimated cost of the query
+    usage: Optional[UsageRecord] = None
 
 
 def query_folder(
@@ -17,6 +51,16 @@ def query_folder(
     folder_index: FolderIndex,
     llm: BaseChatModel,
     return_all: bool = False,
+    chain_type: str = "stuff",
+    max_concurrency: int = 4,
+    search_filter: Optional[SearchFilter] = None,
+    single_flight: bool = True,
+    compression: Optional[str] = None,
+    token_budget: int = 800,
+    embeddings: Optional[Embeddings] = None,
+    short_prompt: bool = False,
+    usage_ledger: Optional[UsageLedger] = None,
+    session_id: str = "",
 ) -> AnswerWithSources:
     """Queries a folder index for an answer.
 
@@ -26,30 +70,444 @@ def query_folder(
         return_all (bool): Whether to return all the documents from the embedding or
         just the sources for the answer.
         model (str): The model to use for the answer generation.
+        chain_type (str): "stuff" to answer from the few most relevant chunks, or
+        "map_reduce" to first extract the relevant text from many more chunks.
+        max_concurrency (int): Max number of concurrent extraction requests
+        for "map_reduce".
+        search_filter (SearchFilter): Only search these files and pages.
+        single_flight (bool): Whether concurrent calls with the same question
+        wait for one answer instead of each querying the model.
+        compression (str): None to send the excerpts to the model as they are,
+        "lexical" or "embedding" to only send their sentences most relevant to
+        the query, scored by shared words or by embedding similarity.
+        token_budget (int): Max number of tokens of the compressed excerpts.
+        embeddings (Embeddings): The embeddings for "embedding" compression,
+        those of the folder index by default.
+        short_prompt (bool): Whether to use a prompt with a shorter example.
+        usage_ledger (UsageLedger): Where the usage of the query is recorded.
+        Concurrent callers sharing one answer record it once, for the
+        session_id of the caller that queried the model.
+        session_id (str): The session the query is made for.
         **model_kwargs (Any): Keyword arguments for the model.
 
     Returns:
-        AnswerWithSources: The answer and the source documents.
+        AnswerWithSources: The answer, the source documents and the usage of
+        the query.
     """
+    kwargs = _query_kwargs(**locals())
+    if not single_flight:
+        return _query_folder(**kwargs)
+
+    return _queries.do(query_key(**kwargs), _query_folder, **kwargs)
+
+
+async def aquery_folder(
+    query: str,
+    folder_index: FolderIndex,
+    llm: BaseChatModel,
+    return_all: bool = False,
+    chain_type: str = "stuff",
+    max_concurrency: int = 4,
+    search_filter: Optional[SearchFilter] = None,
+    single_flight: bool = True,
+    compression: Optional[str] = None,
+    token_budget: int = 800,
+    embeddings: Optional[Embeddings] = None,
+    short_prompt: bool = False,
+    usage_ledger: Optional[UsageLedger] = None,
+    session_id: str = "",
+    timeout: Optional[float] = None,
+) -> AnswerWithSources:
+    """Async version of query_folder, using the async clients of the model
+    and embeddings. Raises asyncio.TimeoutError if there is no answer
+    within timeout seconds. A cancelled (or timed out) call cancels its
+    requests, unless other callers are waiting for the same answer.
+    """
+    kwargs = _query_kwargs(**locals())
+    if single_flight:
+        answer = _queries.ado(query_key(**kwargs), _aquery_folder, **kwargs)
+    else:
+        answer = _aquery_folder(**kwargs)
+    return await asyncio.wait_for(answer, timeout)
+
+
+def _query_kwargs(
+    compression: Optional[str],
+    embeddings: Optional[Embeddings],
+    single_flight: bool,
+    timeout: Optional[float] = None,
+    **kwargs: Any,
+) -> Dict[str, Any]:
+    """Checks the arguments of query_folder and returns those of the query"""
+    if compression not in [None, "lexical", "embedding"]:
+        raise NotImplementedError(f"Compression {compression} not supported.")
+    if embeddings is None:
+        embeddings = kwargs["folder_index"].embeddings
+    if compression == "embedding" and embeddings is None:
+        raise ValueError("Embedding compression needs embeddings.")
+    if kwargs["chain_type"] not in SEARCH_KWARGS:
+        raise NotImplementedError(f"Chain type {kwargs['chain_type']} not supported.")
+
+    return dict(compression=compression, embeddings=embeddings, **kwargs)
+
+
+def query_key(
+    query: str,
+    folder_index: FolderIndex,
+    llm: BaseChatModel,
+    return_all: bool,
+    search_filter: Optional[SearchFilter] = None,
+    usage_ledger: Optional[UsageLedger] = None,
+    session_id: str = "",
+    **options: Any,
+) -> tuple:
+    """Returns a key that is the same for queries that get the same answer.
+    Queries are compared case-insensitively and ignoring whitespace, and
+    regardless of the session they are made for."""
+    return (
+        id(folder_index),
+        " ".join(query.casefold().split()),
+        getattr(llm, "model_name", type(llm).__name__),
+        return_all,
+        search_filter.json() if search_filter is not None else None,
+        repr(sorted(options.items())),
+    )
+
+
+# How many chunks are retrieved for each chain type
+SEARCH_KWARGS: Dict[str, Dict[str, Any]] = {
+    "stuff": dict(k=5),
+    "map_reduce": dict(k=40, fetch_k=40, relevance_ratio=0),
+}
+
 
-    chain = load_qa_with_sources_chain(
-        llm=llm,
-        chain_type="stuff",
-        prompt=STUFF_PROMPT,
+def _answer_prompt(short_prompt: bool) -> PromptTemplate:
+    return SHORT_STUFF_PROMPT if short_prompt else STUFF_PROMPT
+
+
+def _answer_chain(llm: BaseChatModel, short_prompt: bool) -> BaseCombineDocumentsChain:
+    return load_qa_with_sources_chain(
+        llm=llm, chain_type="stuff", prompt=_answer_prompt(short_prompt)
     )
 
-    relevant_docs = folder_index.index.similarity_search(query, k=5)
-    result = chain(
-        {"input_documents": relevant_docs, "question": query}, return_only_outputs=True
+
+def _count_answer(
+    query: str,
+    input_docs: List[Document],
+    output: str,
+    llm: BaseChatModel,
+    short_prompt: bool,
+    counter: TokenCounter,
+):
+    """Counts the tokens of the answer request, from the token counts
+    stored on the input documents"""
+    model = model_name(llm)
+    counter.add(
+        prompt_tokens(_answer_prompt(short_prompt), input_docs, query, model),
+        count_tokens(output, model),
     )
+
+
+def _to_answer(
+    output: str,
+    relevant_docs: List[Document],
+    folder_index: FolderIndex,
+    llm: BaseChatModel,
+    return_all: bool,
+    counter: TokenCounter,
+) -> AnswerWithSources:
     sources = relevant_docs
 
     if not return_all:
-        sources = get_sources(result["output_text"], folder_index)
+        sources = get_sources(output, folder_index)
+
+    answer = output.split("SOURCES: ")[0]
+
+    # The query is accounted to the files its excerpts came from
+    file_ids = sorted(
+        {doc.metadata["file_id"] for doc in relevant_docs if "file_id" in doc.metadata}
+    )
+    usage = query_usage(
+        file_ids,
+        model=model_name(llm),
+        embedding_model=model_name(folder_index.embeddings),
+        counter=counter,
+    )
+
+    return AnswerWithSources(answer=answer, sources=sources, usage=usage)
+
+
+class _Call(NamedTuple):
+    """A request made by a step of a query, with the function that makes it
+    synchronously and the one that makes it asynchronously"""
+
+    sync: Callable[..., Any]
+    async_: Callable[..., Awaitable[Any]]
+    kwargs: Dict[str, Any]
+
+
+def _query_steps(
+    query: str,
+    folder_index: FolderIndex,
+    llm: BaseChatModel,
+    return_all: bool,
+    chain_type: str,
+    max_concurrency: int,
+    search_filter: Optional[SearchFilter],
+    compression: Optional[str],
+    token_budget: int,
+    embeddings: Optional[Embeddings],
+    short_prompt: bool,
+    usage_ledger: Optional[UsageLedger],
+    session_id: str,
+) -> Generator[_Call, Any, AnswerWithSources]:
+    """The steps of answering a query, shared by the sync and async
+    versions. Yields the requests to make and is sent their results, so
+    that only the requests differ between the versions."""
+    chain = _answer_chain(llm, short_prompt)
+    counter = TokenCounter()
+
+    relevant_docs, query_vector = yield _Call(
+        folder_index.search_with_vector,
+        folder_index.asearch_with_vector,
+        dict(
+            query=query,
+            search_filter=search_filter,
+            counter=counter,
+            **SEARCH_KWARGS[chain_type],
+        ),
+    )
+    input_docs = relevant_docs
+    if chain_type == "map_reduce":
+        input_docs = yield _Call(
+            extract_relevant_text,
+            aextract_relevant_text,
+            dict(
+                query=query,
+                docs=relevant_docs,
+                llm=llm,
+                max_concurrency=max_concurrency,
+                counter=counter,
+            ),
+        )
+
+    if compression is not None:
+        if embeddings is not folder_index.embeddings:
+            # The vector of the search is only comparable with the vectors
+            # of the same embeddings
+            query_vector = None
+        input_docs = yield _Call(
+            compress_documents,
+            acompress_documents,
+            dict(
+                query=query,
+                docs=input_docs,
+                token_budget=token_budget,
+                embeddings=embeddings if compression == "embedding" else None,
+                count_tokens=partial(count_tokens, model=model_name(llm)),
+                query_vector=query_vector,
+            ),
+        )
+
+    result = yield _Call(
+        chain,
+        chain.acall,
+        dict(
+            inputs={"input_documents": input_docs, "question": query},
+            return_only_outputs=True,
+        ),
+    )
+    output = result["output_text"]
+    _count_answer(query, input_docs, output, llm, short_prompt, counter)
+    answer = _to_answer(output, relevant_docs, folder_index, llm, return_all, counter)
+    if usage_ledger is not None and answer.usage is not None:
+        usage_ledger.record(answer.usage, session_id=session_id)
+    return answer
+
+
+def _query_folder(**kwargs: Any) -> AnswerWithSources:
+    steps = _query_steps(**kwargs)
+    try:
+        call = next(steps)
+        while True:
+            call = steps.send(call.sync(**call.kwargs))
+    except StopIteration as stop:
+        return stop.value
+
+
+async def _aquery_folder(**kwargs: Any) -> AnswerWithSources:
+    steps = _query_steps(**kwargs)
+    try:
+        call = next(steps)
+        while True:
+            call = steps.send(await call.async_(**call.kwargs))
+    except StopIteration as stop:
+        return stop.value
+
+
+def _group_documents(docs: List[Document], group_size: int) -> List[List[Document]]:
+    groups = []
+    for start in range(0, len(docs), group_size):
+        end = start + group_size
+        groups.append(docs[start:end])
+    return groups
+
+
+def _format_group(group: List[Document]) -> str:
+    return "\n\n".join(format_document(doc, EXAMPLE_PROMPT) for doc in group)
+
+
+def _parse_extract(
+    query: str,
+    group: List[Document],
+    output: str,
+    llm: BaseChatModel,
+    counter: Optional[TokenCounter],
+) -> Optional[Document]:
+    """Returns the relevant text extracted from a group of documents, with
+    the sources cited for it, or None if there was no relevant text. The
+    tokens of the request are added to counter if given."""
+    if counter is not None:
+        model = model_name(llm)
+        counter.add(
+            prompt_tokens(EXTRACT_PROMPT, group, query, model),
+            count_tokens(output, model),
+        )
+
+    output = output.strip()
+    if not output or output.upper().startswith("NONE"):
+        return None
+
+    text, _, cited = output.partition("SOURCES:")
+    group_sources = [doc.metadata["source"] for doc in group]
+    sources = [s.strip() for s in cited.split(",") if s.strip() in group_sources]
+    return Document(
+        page_content=text.strip(),
+        metadata={"source": ", ".join(sources or group_sources)},
+    )
+
+
+class _ExtractionSchedule:
+    """Decides when to extract from each group of documents: at most
+    max_concurrency requests are in flight, and no new requests are sent
+    once enough_evidence groups had relevant text. Shared by the sync and
+    async extraction, which only send the requests."""
+
+    def __init__(
+        self,
+        groups: List[List[Document]],
+        max_concurrency: int,
+        enough_evidence: Optional[int],
+    ):
+        self.groups = groups
+        self.max_concurrency = max_concurrency
+        self.enough_evidence = enough_evidence
+        self.extracts: List[Optional[Document]] = [None] * len(groups)
+        self.next_group = 0
+        self.in_flight = 0
+        self.found = 0
+
+    def start(self) -> List[int]:
+        """Returns the numbers of the groups to send requests for now"""
+        numbers = []
+        while (
+            self.next_group < len(self.groups)
+            and self.in_flight < self.max_concurrency
+            and (self.enough_evidence is None or self.found < self.enough_evidence)
+        ):
+            numbers.append(self.next_group)
+            self.next_group += 1
+            self.in_flight += 1
+        return numbers
+
+    def finish(self, number: int, extract: Optional[Document]):
+        """Records the result of the request for a group"""
+        self.in_flight -= 1
+        self.extracts[number] = extract
+        self.found += extract is not None
+
+    @property
+    def results(self) -> List[Document]:
+        """The extracts of the groups with relevant text, in order"""
+        return [doc for doc in self.extracts if doc is not None]
+
+
+def extract_relevant_text(
+    query: str,
+    docs: List[Document],
+    llm: BaseChatModel,
+    group_size: int = 4,
+    max_concurrency: int = 4,
+    enough_evidence: Optional[int] = 6,
+    counter: Optional[TokenCounter] = None,
+) -> List[Document]:
+    """Asks the LLM for the text relevant to the query in each group of
+    group_size documents, with at most max_concurrency requests in flight.
+    No new requests are sent once enough_evidence groups had relevant text.
+
+    Returns one document per group with relevant text, whose source lists
+    the sources cited for it. The tokens of the requests are added to
+    counter if given.
+    """
+    chain = LLMChain(llm=llm, prompt=EXTRACT_PROMPT)
+    schedule = _ExtractionSchedule(
+        _group_documents(docs, group_size), max_concurrency, enough_evidence
+    )
+
+    def extract(group: List[Document]) -> Optional[Document]:
+        output = chain.predict(question=query, summaries=_format_group(group))
+        return _parse_extract(query, group, output, llm, counter)
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        pending: Dict[Future, int] = {}
+        while True:
+            for number in schedule.start():
+                pending[executor.submit(extract, schedule.groups[number])] = number
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                schedule.finish(pending.pop(future), future.result())
+
+    return schedule.results
+
+
+async def aextract_relevant_text(
+    query: str,
+    docs: List[Document],
+    llm: BaseChatModel,
+    group_size: int = 4,
+    max_concurrency: int = 4,
+    enough_evidence: Optional[int] = 6,
+    counter: Optional[TokenCounter] = None,
+) -> List[Document]:
+    """Async version of extract_relevant_text. Requests still in flight
+    are cancelled if the call is."""
+    chain = LLMChain(llm=llm, prompt=EXTRACT_PROMPT)
+    schedule = _ExtractionSchedule(
+        _group_documents(docs, group_size), max_concurrency, enough_evidence
+    )
+
+    async def extract(group: List[Document]) -> Optional[Document]:
+        output = await chain.apredict(question=query, summaries=_format_group(group))
+        return _parse_extract(query, group, output, llm, counter)
 
-    answer = result["output_text"].split("SOURCES: ")[0]
+    pending: Dict[asyncio.Future, int] = {}
+    try:
+        while True:
+            for number in schedule.start():
+                task = asyncio.ensure_future(extract(schedule.groups[number]))
+                pending[task] = number
+            if not pending:
+                break
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                schedule.finish(pending.pop(task), task.result())
+    finally:
+        for task in pending:
+            task.cancel()
 
-    return AnswerWithSources(answer=answer, sources=sources)
+    return schedule.results
 
 
 def get_sources(answer: str, folder_index: FolderIndex) -> List[Document]:
@@ -0,0 +1,84 @@
+from typing import List, Tuple
+
+import numpy as np
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Scales each row of a matrix to unit length"""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def maximal_marginal_relevance(
+    query_vector: np.ndarray,
+    vectors: np.ndarray,
+    k: int = 5,
+    lambda_mult: float = 0.7,
+) -> List[int]:
+    """Greedily selects k rows of vectors that are similar to the query but
+    not to each other. Returns their indices in order of selection.
+    """
+    return maximal_marginal_relevance_scores(query_vector, vectors, k, lambda_mult)[0]
+
+
+def maximal_marginal_relevance_scores(
+    query_vector: np.ndarray,
+    vectors: np.ndarray,
+    k: int = 5,
+    lambda_mult: float = 0.7,
+) -> Tuple[List[int], List[float]]:
+    """Like maximal_marginal_relevance, but also returns the MMR score of
+    each selected row at the time it was selected.
+
+    Only the similarities to the selected rows are computed, and the max
+    similarity of every candidate to the selection is updated in one
+    vectorized step per selection.
+    """
+    if len(vectors) == 0 or k <= 0:
+        return [], []
+
+    vectors = normalize_rows(np.asarray(vectors, dtype=np.float32))
+    relevance = vectors @ normalize_rows(np.asarray(query_vector, dtype=np.float32))
+
+    max_similarity = np.zeros(len(vectors), dtype=np.float32)
+    available = np.ones(len(vectors), dtype=bool)
+    selected: List[int] = []
+    selected_scores: List[float] = []
+
+    for _ in range(min(k, len(vectors))):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        index = int(np.argmax(np.where(available, scores, -np.inf)))
+        selected.append(index)
+        selected_scores.append(float(scores[index]))
+        available[index] = False
+        np.maximum(max_similarity, vectors @ vectors[index], out=max_similarity)
+
+    return selected, selected_scores
+
+
+def adaptive_k(
+    relevance: np.ndarray, min_k: int = 2, relevance_ratio: float = 0.9
+) -> int:
+    """Returns how many of the ranked results to keep. The list is cut at
+    the first result less than relevance_ratio times as relevant as the best
+    one, but at least min_k results are kept.
+    """
+    if len(relevance) == 0:
+        return 0
+    relevance = np.asarray(relevance)
+    below = relevance < relevance_ratio * relevance.max()
+    keep = int(np.argmax(below)) if below.any() else len(relevance)
+    return min(max(keep, min_k), len(relevance))
+
+
+def cutoff_reason(
+    relevance: np.ndarray, keep: int, k: int, min_k: int, relevance_ratio: float
+) -> str:
+    """Explains why adaptive_k kept keep of the ranked results"""
+    if keep < len(relevance):
+        return f"relevance below {relevance_ratio:g} of the best"
+    if keep == min_k and keep > 0 and relevance[-1] < relevance_ratio * relevance.max():
+        return f"min_k={min_k}"
+    if keep < k:
+        return "no more candidates"
+    return f"k={k}"
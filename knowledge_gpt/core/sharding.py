@@ -0,0 +1,405 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import pickle
+import threading
+import uuid
+from multiprocessing.connection import Connection
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores import VectorStore
+
+if TYPE_CHECKING:
+    from knowledge_gpt.core.embedding import SearchFilter
+
+logger = logging.getLogger(__name__)
+
+INDEX_SHARDS = int(os.environ.get("INDEX_SHARDS", 4))
+
+# Forking a process that runs threads (e.g. the Streamlit server) can
+# deadlock, so shards are started from a fresh interpreter
+_context = multiprocessing.get_context("spawn")
+
+
+def _serve(conn: Connection):
+    """Main loop of a shard worker process. The worker holds a FAISS
+    FolderIndex per store of the documents routed to it, and answers
+    requests from the parent. The embeddings are sent with each batch of
+    documents to add."""
+    from langchain.vectorstores.faiss import FAISS
+
+    from knowledge_gpt.core.embedding import FolderIndex
+
+    indexes: Dict[str, FolderIndex] = {}
+
+    while True:
+        command, args = conn.recv()
+        if command == "close":
+            break
+        try:
+            result: Any = None
+            if command == "add":
+                store_id, docs, embedding = args
+                if store_id not in indexes:
+                    indexes[store_id] = FolderIndex.from_documents(
+                        files=[], docs=docs, embeddings=embedding, vector_store=FAISS
+                    )
+                else:
+                    indexes[store_id].add_documents(docs, embedding)
+            elif command == "search":
+                store_id, query_vector, k, search_filter = args
+                if store_id in indexes:
+                    result = indexes[store_id].search_by_vector(
+                        query_vector, k, search_filter
+                    )
+            elif command == "dump":
+                result = pickle.dumps(
+                    indexes.get(args), protocol=pickle.HIGHEST_PROTOCOL
+                )
+            elif command == "load":
+                store_id, dump = args
+                # Shards only search by vector, so they need no embeddings
+                folder_index = pickle.loads(dump)
+                if folder_index is not None:
+                    indexes[store_id] = folder_index
+            elif command == "drop":
+                indexes.pop(args, None)
+            else:
+                raise ValueError(f"Unknown shard command {command}")
+            conn.send((None, result))
+        except Exception as e:
+            conn.send((e, None))
+
+    conn.close()
+
+
+class ShardLostError(RuntimeError):
+    """Raised by a sharded store whose documents were lost with a worker
+    process that died (e.g. killed for running out of memory)"""
+
+
+class _Shard:
+    """Handle on a shard worker process. Requests are sent and received
+    under a lock so that concurrent searches do not read each other's
+    responses."""
+
+    def __init__(self):
+        self.conn, child_conn = _context.Pipe()
+        self.process = _context.Process(target=_serve, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.lock = threading.Lock()
+
+    def send(self, command: str, args: Any = None):
+        self.lock.acquire()
+        try:
+            self.conn.send((command, args))
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def recv(self) -> Any:
+        try:
+            error, result = self.conn.recv()
+        finally:
+            self.lock.release()
+        if error is not None:
+            raise error
+        return result
+
+    def close(self):
+        with self.lock:
+            if self.process.is_alive():
+                self.conn.send(("close", None))
+                self.process.join(timeout=5)
+        self.conn.close()
+
+
+# Worker processes shared by all the sharded stores of this process. Shard
+# number i of every store lives in worker i.
+_workers: List[_Shard] = []
+_workers_lock = threading.Lock()
+# Ids of the garbage collected stores whose documents are still to be
+# dropped from the workers. They are not dropped by __del__ itself, which
+# may run while the collecting thread holds a worker's lock.
+_collected_stores: List[str] = []
+
+
+def get_workers(num_shards: int) -> List[_Shard]:
+    """Returns the first num_shards shared workers, starting those that are
+    not running yet and replacing those that died. The documents of
+    collected stores are dropped first."""
+    with _workers_lock:
+        for i, worker in enumerate(_workers):
+            if not worker.process.is_alive():
+                logger.warning(
+                    "Shard worker %d (pid %s) died with exit code %s and was"
+                    " restarted. Sharded stores lose their documents in it.",
+                    i,
+                    worker.process.pid,
+                    worker.process.exitcode,
+                )
+                worker.conn.close()
+                _workers[i] = _Shard()
+        while _collected_stores:
+            store_id = _collected_stores.pop()
+            _scatter(_workers, {i: ("drop", store_id) for i in range(len(_workers))})
+        while len(_workers) < num_shards:
+            _workers.append(_Shard())
+        return _workers[:num_shards]
+
+
+@atexit.register
+def close_workers():
+    """Stops the shared workers"""
+    with _workers_lock:
+        for worker in _workers:
+            try:
+                worker.close()
+            except (OSError, ValueError):
+                pass
+        _workers.clear()
+
+
+def _scatter(shards: List[_Shard], requests: Dict[int, Tuple[str, Any]]) -> list:
+    """Sends requests (by shard number) to all the shards before waiting for
+    any response, so that the shards work in parallel. Returns the results
+    in the order of the requests."""
+    # Shards are always locked in the same order, so that concurrent
+    # scatters cannot deadlock
+    numbers = sorted(requests)
+    sent = []
+    try:
+        for number in numbers:
+            shards[number].send(*requests[number])
+            sent.append(number)
+    finally:
+        results = []
+        errors = []
+        for number in sent:
+            try:
+                results.append(shards[number].recv())
+            except Exception as e:
+                errors.append(e)
+    if errors:
+        raise errors[0]
+    return results
+
+
+class ShardedVectorStore(VectorStore):
+    """Vector store whose documents are partitioned by file across shard
+    worker processes, each with its own FAISS index and docstore. The
+    workers are shared by all sharded stores, so there are never more than
+    num_shards of them. Documents are embedded by the workers, so shards are
+    built in parallel. Searches embed the query once, send it to all the
+    shards at once and merge the nearest documents of each shard into a
+    global top k.
+
+    Workers that die are restarted empty. Stores that had documents in them
+    raise ShardLostError from then on, and list the shards in lost_shards.
+    """
+
+    def __init__(self, embedding: Embeddings, num_shards: int = INDEX_SHARDS):
+        self.embedding = embedding
+        self.store_id = uuid.uuid4().hex
+        self.num_shards = num_shards
+        # The workers holding documents of this store, by shard number
+        self._workers: Dict[int, _Shard] = {}
+        # Number of documents of this store in each shard
+        self.num_docs = [0] * num_shards
+        # All the chunks of a file are stored in the same shard
+        self.file_shards: Dict[str, int] = {}
+        # Shards with chunks kept in place of duplicate chunks of a file,
+        # which are stored under the id of another file
+        self.duplicate_shards: Dict[str, Set[int]] = {}
+
+    @property
+    def shards(self) -> List[_Shard]:
+        return get_workers(self.num_shards)
+
+    @property
+    def lost_shards(self) -> List[int]:
+        """Numbers of the shards whose documents of this store were lost"""
+        return self._lost_shards(self.shards)
+
+    def _lost_shards(self, shards: List[_Shard]) -> List[int]:
+        return sorted(
+            i for i, worker in self._workers.items() if worker is not shards[i]
+        )
+
+    def _live_shards(self) -> List[_Shard]:
+        """Returns the workers, or raises ShardLostError if some documents
+        of this store were lost"""
+        shards = self.shards
+        lost = self._lost_shards(shards)
+        if lost:
+            logger.error("Sharded store %s lost shards %s", self.store_id, lost)
+            raise ShardLostError(
+                f"The documents of shards {lost} of the index were lost when"
+                " their worker process died. The index must be rebuilt."
+            )
+        return shards
+
+    def __getstate__(self) -> dict:
+        """Pickling copies the documents of the store from the workers, so
+        only pickle sharded stores to move them elsewhere"""
+        dumps = _scatter(
+            self._live_shards(),
+            {i: ("dump", self.store_id) for i in range(len(self))},
+        )
+        # The embeddings are not pickled, like those of FAISS indexes (see
+        # FolderIndex.attach_embeddings)
+        return {
+            "file_shards": self.file_shards,
+            "duplicate_shards": self.duplicate_shards,
+            "num_docs": self.num_docs,
+            "dumps": dumps,
+        }
+
+    def __setstate__(self, state: dict):
+        self.embedding = None  # type: ignore
+        self.store_id = uuid.uuid4().hex
+        self.num_shards = len(state["dumps"])
+        self.num_docs = state["num_docs"]
+        self.file_shards = state["file_shards"]
+        self.duplicate_shards = state["duplicate_shards"]
+        shards = self.shards
+        _scatter(
+            shards,
+            {
+                i: ("load", (self.store_id, dump))
+                for i, dump in enumerate(state["dumps"])
+            },
+        )
+        self._workers = dict(enumerate(shards))
+
+    def __len__(self) -> int:
+        return self.num_shards
+
+    def __del__(self):
+        if hasattr(self, "store_id"):
+            _collected_stores.append(self.store_id)
+
+    def close(self):
+        """Drops the documents of the store from the workers"""
+        try:
+            shards = self.shards
+            _scatter(shards, {i: ("drop", self.store_id) for i in range(len(shards))})
+        except (OSError, ValueError, EOFError):
+            pass
+        self._workers.clear()
+
+    def _assign_shard(self, file_id: str) -> int:
+        """Returns the shard of a file. New files go to the shard with the
+        fewest documents of this store."""
+        if file_id not in self.file_shards:
+            self.file_shards[file_id] = min(
+                range(self.num_shards), key=lambda i: self.num_docs[i]
+            )
+        return self.file_shards[file_id]
+
+    def _search_shards(self, file_ids: List[str]) -> List[int]:
+        """Returns the shards with chunks of the files, including the chunks
+        kept in place of their duplicates"""
+        numbers: Set[int] = set()
+        for file_id in file_ids:
+            if file_id in self.file_shards:
+                numbers.add(self.file_shards[file_id])
+            numbers.update(self.duplicate_shards.get(file_id, set()))
+        return sorted(numbers)
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        """Embeds and adds texts to the shards of their files.
+        Returns the number of the shard of each text."""
+        shards = self._live_shards()
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+
+        batches: Dict[int, List[Document]] = {}
+        numbers = []
+        for text, metadata in zip(texts, metadatas):
+            number = self._assign_shard(metadata.get("file_id", ""))
+            batches.setdefault(number, []).append(
+                Document(page_content=text, metadata=metadata)
+            )
+            numbers.append(str(number))
+            self.num_docs[number] += 1
+            for duplicate in metadata.get("duplicates", []):
+                self.duplicate_shards.setdefault(
+                    duplicate.get("file_id", ""), set()
+                ).add(number)
+
+        _scatter(
+            shards,
+            {
+                number: ("add", (self.store_id, docs, self.embedding))
+                for number, docs in batches.items()
+            },
+        )
+        self._workers.update((number, shards[number]) for number in batches)
+        return numbers
+
+    def search_by_vector(
+        self,
+        query_vector: np.ndarray,
+        k: int,
+        search_filter: Optional["SearchFilter"] = None,
+    ) -> Tuple[np.ndarray, List[Document], np.ndarray]:
+        """Returns the distances, documents and vectors of the k nearest
+        documents across all shards. The filter must list the file ids to
+        search, if any, so that only the shards of those files are asked."""
+        shards = self._live_shards()
+        numbers: Iterable[int] = range(self.num_shards)
+        if search_filter is not None and search_filter.file_ids is not None:
+            numbers = self._search_shards(search_filter.file_ids)
+
+        results = _scatter(
+            shards,
+            {
+                i: ("search", (self.store_id, query_vector, k, search_filter))
+                for i in numbers
+            },
+        )
+        results = [result for result in results if result is not None]
+        if not results:
+            return (
+                np.empty(0, np.float32),
+                [],
+                np.empty((0, len(query_vector)), np.float32),
+            )
+
+        distances = np.concatenate([result[0] for result in results])
+        docs = [doc for result in results for doc in result[1]]
+        vectors = np.concatenate([result[2] for result in results])
+
+        top = np.argsort(distances, kind="stable")[:k]
+        return distances[top], [docs[i] for i in top], vectors[top]
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        query_vector = np.array(self.embedding.embed_query(query), dtype=np.float32)
+        _, docs, _ = self.search_by_vector(query_vector, k)
+        return docs
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        num_shards: int = INDEX_SHARDS,
+        **kwargs: Any,
+    ) -> "ShardedVectorStore":
+        store = cls(embedding, num_shards=num_shards)
+        store.add_texts(texts, metadatas)
+        return store
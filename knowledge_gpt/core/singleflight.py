@@ -0,0 +1,85 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one. While a call
+    is in flight, callers with the same key wait for it and get its result
+    (or its exception) instead of making the call again. Nothing is cached
+    once the call is finished.
+
+    Thread callers use do() and asyncio callers use ado(). They do not
+    share calls with each other.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, Future] = {}
+        self._tasks: Dict[Tuple[int, Hashable], asyncio.Task] = {}
+        self._waiters: Dict[Tuple[int, Hashable], int] = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self) -> int:
+        """Number of calls in flight"""
+        with self._lock:
+            return len(self._calls) + len(self._tasks)
+
+    def do(self, key: Hashable, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Calls fn(*args, **kwargs), unless a call with the same key is
+        already in flight, in which case its result is returned."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if future is None:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def ado(
+        self, key: Hashable, fn: Callable[..., Awaitable[T]], *args: Any, **kwargs: Any
+    ) -> T:
+        """Awaits fn(*args, **kwargs), unless a call with the same key is
+        already in flight on this event loop, in which case its result is
+        returned. A cancelled caller does not cancel the call for the
+        others; the call is only cancelled once all its callers are."""
+        task_key = (id(asyncio.get_running_loop()), key)
+        with self._lock:
+            task = self._tasks.get(task_key)
+            if task is None:
+                task = asyncio.ensure_future(fn(*args, **kwargs))
+                self._tasks[task_key] = task
+                self._waiters[task_key] = 0
+                task.add_done_callback(lambda _: self._forget(task_key, task))
+            self._waiters[task_key] += 1
+
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done():
+                with self._lock:
+                    self._waiters[task_key] -= 1
+                    if self._waiters[task_key] == 0:
+                        task.cancel()
+            raise
+
+    def _forget(self, task_key: Tuple[int, Hashable], task: asyncio.Task):
+        with self._lock:
+            if self._tasks.get(task_key) is task:
+                del self._tasks[task_key]
+                del self._waiters[task_key]
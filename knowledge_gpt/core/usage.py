@@ -0,0 +1,252 @@
+import atexit
+import threading
+import time
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+import tiktoken
+from langchain.docstore.document import Document
+from langchain.prompts.base import BasePromptTemplate
+from pydantic import BaseModel
+
+from knowledge_gpt.core.parsing import File
+
+# USD per 1000 (prompt, completion) tokens
+COSTS_PER_1K_TOKENS: Dict[str, Tuple[float, float]] = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-4": (0.03, 0.06),
+    "text-embedding-ada-002": (0.0001, 0.0),
+}
+
+# Tokens that the formatting of a document in a prompt ("Content: ...",
+# "SOURCES: ...") adds to it, besides its source
+DOCUMENT_OVERHEAD = 6
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough number of tokens in a text, at about 4 characters per token"""
+    return max(1, round(len(text) / 4))
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> Optional[tiktoken.Encoding]:
+    """Returns the tokenizer of a model, or None if tiktoken does not know
+    the model (e.g. the debug model)"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return None
+
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    """Number of tokens of a text for a model. Estimated from its length for
+    models tiktoken does not know."""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode_ordinary(text))
+
+
+@lru_cache(maxsize=64)
+def template_tokens(template: str, model: str) -> int:
+    """Number of tokens of a prompt template, counted once per model"""
+    return count_tokens(template, model)
+
+
+def document_tokens(doc: Document, model: str = "gpt-3.5-turbo") -> int:
+    """Number of tokens a document takes in a prompt, using the count stored
+    when it was chunked if there is one"""
+    tokens = doc.metadata.get("token_count")
+    if tokens is None:
+        tokens = count_tokens(doc.page_content, model)
+    source = str(doc.metadata.get("source", ""))
+    return tokens + count_tokens(source, model) + DOCUMENT_OVERHEAD
+
+
+def prompt_tokens(
+    prompt: BasePromptTemplate, docs: List[Document], question: str, model: str
+) -> int:
+    """Number of tokens of a question answering prompt with docs as its
+    summaries, from the token counts stored on the docs"""
+    template = prompt.format(summaries="", question="")
+    return (
+        template_tokens(template, model)
+        + count_tokens(question, model)
+        + sum(document_tokens(doc, model) for doc in docs)
+    )
+
+
+def model_name(model: Any) -> str:
+    """Name of the model of an LLM or embeddings, unwrapping embeddings
+    that wrap others (e.g. CoalescingEmbeddings)"""
+    if model is None:
+        return ""
+    while hasattr(model, "embeddings"):
+        model = model.embeddings
+    name = getattr(model, "model_name", None) or getattr(model, "model", None)
+    return name if isinstance(name, str) else type(model).__name__
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int = 0) -> float:
+    """Cost in USD of a request, or 0 for models without a known price"""
+    prompt_cost, completion_cost = COSTS_PER_1K_TOKENS.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_cost + completion_tokens * completion_cost) / 1000
+
+
+class TokenCounter:
+    """Adds up the tokens of the requests made for one query, which may be
+    sent from several threads"""
+
+    def __init__(self):
+        self.embedding_tokens = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._lock = threading.Lock()
+
+    def add(
+        self,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        embedding_tokens: int = 0,
+    ):
+        with self._lock:
+            self.embedding_tokens += embedding_tokens
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+
+class UsageRecord(BaseModel):
+    # "upload" or "query"
+    kind: str
+    # The model the record is rolled up under: the embeddings of uploads
+    # and the LLM of queries
+    model: str
+    file_ids: List[str]
+    embedding_model: str = ""
+    session_id: str = ""
+    timestamp: float = 0.0
+    embedding_tokens: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+
+
+class UsageTotals(BaseModel):
+    records: int = 0
+    embedding_tokens: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+
+    def add(self, record: UsageRecord):
+        self.records += 1
+        self.embedding_tokens += record.embedding_tokens
+        self.prompt_tokens += record.prompt_tokens
+        self.completion_tokens += record.completion_tokens
+        self.cost += record.cost
+
+
+def upload_usage(
+    file: File,
+    embedding_model: str = "text-embedding-ada-002",
+    docs: Optional[List[Document]] = None,
+) -> UsageRecord:
+    """Usage of embedding the chunks of a file (all of them by default, or
+    docs, e.g. those left after deduplication), from their token counts"""
+    if docs is None:
+        docs = file.docs
+    tokens = sum(
+        doc.metadata.get("token_count")
+        or count_tokens(doc.page_content, embedding_model)
+        for doc in docs
+    )
+    return UsageRecord(
+        kind="upload",
+        model=embedding_model,
+        file_ids=[file.id],
+        embedding_model=embedding_model,
+        embedding_tokens=tokens,
+        cost=estimate_cost(embedding_model, tokens),
+    )
+
+
+def query_usage(
+    file_ids: List[str],
+    model: str,
+    embedding_model: str,
+    counter: TokenCounter,
+) -> UsageRecord:
+    """Usage of a query: embedding the question (if it was not served from a
+    cache), and the prompt and completion tokens of all the requests to the
+    model"""
+    embedding_tokens = counter.embedding_tokens
+    return UsageRecord(
+        kind="query",
+        model=model,
+        file_ids=file_ids,
+        embedding_model=embedding_model,
+        embedding_tokens=embedding_tokens,
+        prompt_tokens=counter.prompt_tokens,
+        completion_tokens=counter.completion_tokens,
+        cost=estimate_cost(embedding_model, embedding_tokens)
+        + estimate_cost(model, counter.prompt_tokens, counter.completion_tokens),
+    )
+
+
+class UsageLedger:
+    """Keeps usage totals per file, session and model in memory. Records
+    are appended to a JSON lines file at path (if set) every flush_interval
+    seconds by a background thread, and when the ledger is closed or the
+    process exits.
+    """
+
+    def __init__(self, path: Optional[str] = None, flush_interval: float = 60):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.by_file: Dict[str, UsageTotals] = {}
+        self.by_session: Dict[str, UsageTotals] = {}
+        self.by_model: Dict[str, UsageTotals] = {}
+        self._pending: List[UsageRecord] = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        if path is not None:
+            threading.Thread(
+                target=self._flush_periodically, name="usage-ledger", daemon=True
+            ).start()
+            atexit.register(self.close)
+
+    def record(self, record: UsageRecord, session_id: Optional[str] = None):
+        """Adds a record to the totals of its files, session and model.
+        A query about several files counts towards each of them."""
+        if session_id is not None:
+            record = record.copy(update={"session_id": session_id})
+        if not record.timestamp:
+            record = record.copy(update={"timestamp": time.time()})
+
+        with self._lock:
+            for file_id in record.file_ids:
+                self.by_file.setdefault(file_id, UsageTotals()).add(record)
+            self.by_session.setdefault(record.session_id, UsageTotals()).add(record)
+            self.by_model.setdefault(record.model, UsageTotals()).add(record)
+            self._pending.append(record)
+
+    def _flush_periodically(self):
+        # Flushes even if no record arrives, so that records are not held
+        # back until the next one
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Stops the periodic flush and flushes the pending records"""
+        self._closed.set()
+        self.flush()
+
+    def flush(self):
+        """Appends the records since the last flush to the file"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if self.path is None or not pending:
+                return
+            with open(self.path, "a") as f:
+                for record in pending:
+                    f.write(record.json() + "\n")
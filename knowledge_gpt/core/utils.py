@@ -4,16 +4,39 @@ from langchain.docstore.document import Document
 
 from langchain.chat_models import ChatOpenAI
 from knowledge_gpt.core.debug import FakeChatModel
+from knowledge_gpt.core.usage import document_tokens, model_name
 from langchain.chat_models.base import BaseChatModel
 
+# Fraction of the max prompt length below which a prompt length estimated
+# from stored token counts is trusted
+PROMPT_LENGTH_MARGIN = 0.05
+
 
 def pop_docs_upto_limit(
     query: str, chain: StuffDocumentsChain, docs: List[Document], max_len: int
 ) -> List[Document]:
     """Pops documents from a list until the final prompt length is less
-    than the max length."""
-
-    token_count: int = chain.prompt_length(docs, question=query)  # type: ignore
+    than the max length. If all documents have a token count stored when
+    they were chunked, the prompt length is estimated from the counts, and
+    only computed exactly when the estimate is within a margin of the max
+    length."""
+
+    if docs and all("token_count" in doc.metadata for doc in docs):
+        model = model_name(chain.llm_chain.llm)  # type: ignore
+        doc_tokens = [document_tokens(doc, model) for doc in docs]
+        token_count: int = chain.prompt_length([], question=query)  # type: ignore
+        token_count += sum(doc_tokens)
+
+        while token_count > max_len and len(docs) > 0:
+            docs.pop()
+            token_count -= doc_tokens.pop()
+
+        # The formatting of the documents is only estimated, so prompts
+        # close to the limit are checked below
+        if token_count <= max_len * (1 - PROMPT_LENGTH_MARGIN):
+            return docs
+
+    token_count = chain.prompt_length(docs, question=query)  # type: ignore
 
     while token_count > max_len and len(docs) > 0:
         docs.pop()
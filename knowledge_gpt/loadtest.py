@@ -0,0 +1,255 @@
+"""Load generator for KnowledgeGPT in debug mode.
+
+Simulates concurrent sessions that upload a file, index it and ask
+questions, with the fake embeddings and chat model standing in for the
+providers. Sessions run as threads of one process, like Streamlit sessions.
+
+    python -m knowledge_gpt.loadtest --sessions 16 --questions 5 \\
+        --embedding-latency 0.05 --llm-latency 0.5
+"""
+
+import argparse
+import json
+import random
+import resource
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, List, Optional
+
+import numpy as np
+from pydantic import BaseModel
+
+from knowledge_gpt.core.chunking import chunk_file
+from knowledge_gpt.core.debug import FakeChatModel
+from knowledge_gpt.core.index_pool import IndexPool, PoolStats
+from knowledge_gpt.core.jobs import IndexingJobManager
+from knowledge_gpt.core.parsing import read_file
+from knowledge_gpt.core.qa import query_folder
+
+WORDS = (
+    "contract party payment term notice agreement liability revenue quarter "
+    "report growth risk policy data customer service product market cost"
+).split()
+
+
+class LatencyStats(BaseModel):
+    count: int
+    p50: float
+    p95: float
+    p99: float
+    max: float
+
+    @classmethod
+    def from_samples(cls, samples: List[float]) -> "LatencyStats":
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99]) if samples else (0, 0, 0)
+        return cls(
+            count=len(samples),
+            p50=p50,
+            p95=p95,
+            p99=p99,
+            max=max(samples, default=0),
+        )
+
+
+class LoadTestReport(BaseModel):
+    sessions: int
+    duration: float
+    # Completed operations per second, by operation
+    throughput: Dict[str, float]
+    latency: Dict[str, LatencyStats]
+    errors: int
+    first_error: Optional[str] = None
+    rss_growth_mb: float
+    traced_peak_mb: float
+    pool: Optional[PoolStats] = None
+    # Indexing jobs started, fewer than the uploads if sessions shared them
+    jobs_started: int = 0
+
+    def format(self) -> str:
+        lines = [
+            f"{self.sessions} sessions in {self.duration:.1f}s, {self.errors} errors",
+            f"{'operation':<10}{'count':>8}{'ops/s':>9}"
+            f"{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}",
+        ]
+        if self.first_error is not None:
+            lines.insert(1, f"first error: {self.first_error}")
+        for name, stats in self.latency.items():
+            lines.append(
+                f"{name:<10}{stats.count:>8}{self.throughput[name]:>9.2f}"
+                f"{stats.p50:>9.3f}{stats.p95:>9.3f}{stats.p99:>9.3f}{stats.max:>9.3f}"
+            )
+        lines.append(
+            f"memory: RSS +{self.rss_growth_mb:.1f} MB, "
+            f"traced peak {self.traced_peak_mb:.1f} MB"
+        )
+        if self.pool is not None:
+            lines.append(
+                f"index pool: {self.pool.hits} hits, {self.pool.misses} misses, "
+                f"{self.pool.spills} spills, {self.pool.reloads} reloads, "
+                f"{self.jobs_started} indexing jobs"
+            )
+        return "\n".join(lines)
+
+
+class Recorder:
+    """Collects the latency of operations from many threads"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.errors = 0
+        self.first_error: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+    def error(self, error: Optional[Exception] = None):
+        with self._lock:
+            self.errors += 1
+            if self.first_error is None and error is not None:
+                self.first_error = repr(error)
+
+
+def rss_bytes() -> int:
+    """Current resident set size, or the peak if it is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def make_document(number: int, pages: int, page_size: int = 3000) -> BytesIO:
+    """Returns a deterministic text file. The same number gives the same
+    content, so that sessions uploading it share its index."""
+    rng = random.Random(number)
+    text = "\n".join(
+        " ".join(rng.choice(WORDS) for _ in range(page_size // 7)) for _ in range(pages)
+    )
+    file = BytesIO(text.encode("utf-8"))
+    file.name = f"document-{number}.txt"
+    return file
+
+
+def run_session(
+    session: int,
+    recorder: Recorder,
+    manager: IndexingJobManager,
+    args: argparse.Namespace,
+):
+    """Uploads, indexes and queries one document, timing each step"""
+    try:
+        start = time.perf_counter()
+        file = read_file(make_document(session % args.documents, args.pages))
+        recorder.record("read", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        chunked_file = chunk_file(file, chunk_size=args.chunk_size, chunk_overlap=0)
+        recorder.record("chunk", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        job = manager.submit(
+            chunked_file.id,
+            [chunked_file],
+            embedding="debug",
+            vector_store=args.vector_store,
+            latency=args.embedding_latency,
+        )
+        job.wait()
+        if job.error is not None:
+            raise job.error
+        recorder.record("index", time.perf_counter() - start)
+
+        llm = FakeChatModel(latency=args.llm_latency)
+        for _ in range(args.questions):
+            start = time.perf_counter()
+            query_folder(
+                query="What is the payment term?",
+                folder_index=job.folder_index,  # type: ignore
+                llm=llm,
+                chain_type=args.chain_type,
+            )
+            recorder.record("query", time.perf_counter() - start)
+    except Exception as e:
+        recorder.error(e)
+
+
+def run_load_test(args: argparse.Namespace) -> LoadTestReport:
+    """Runs args.sessions sessions concurrently and reports on them"""
+    recorder = Recorder()
+    pool = IndexPool(max_bytes=args.pool_mb * 1024 * 1024)
+    manager = IndexingJobManager(pool=pool, max_workers=args.index_workers)
+
+    tracemalloc.start()
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        for session in range(args.sessions):
+            executor.submit(run_session, session, recorder, manager, args)
+
+    duration = time.perf_counter() - start
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return LoadTestReport(
+        sessions=args.sessions,
+        duration=duration,
+        throughput={
+            name: len(samples) / duration for name, samples in recorder.samples.items()
+        },
+        latency={
+            name: LatencyStats.from_samples(samples)
+            for name, samples in recorder.samples.items()
+        },
+        errors=recorder.errors,
+        first_error=recorder.first_error,
+        rss_growth_mb=(rss_bytes() - rss_before) / 1024 / 1024,
+        traced_peak_mb=traced_peak / 1024 / 1024,
+        pool=pool.stats,
+        jobs_started=manager.jobs_started,
+    )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Simulates concurrent KnowledgeGPT sessions in debug mode."
+    )
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument(
+        "--documents",
+        type=int,
+        default=2,
+        help="Number of distinct documents. Sessions uploading the same "
+        "document share its index.",
+    )
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--questions", type=int, default=3)
+    parser.add_argument("--chunk-size", type=int, default=300)
+    parser.add_argument(
+        "--chain-type", choices=["stuff", "map_reduce"], default="stuff"
+    )
+    parser.add_argument("--vector-store", choices=["faiss", "debug"], default="faiss")
+    parser.add_argument("--embedding-latency", type=float, default=0.0)
+    parser.add_argument("--llm-latency", type=float, default=0.0)
+    parser.add_argument("--index-workers", type=int, default=4)
+    parser.add_argument("--pool-mb", type=int, default=1024)
+    parser.add_argument("--json", action="store_true", help="Print a JSON report")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    report = run_load_test(args)
+    if args.json:
+        print(json.dumps(report.dict(), indent=2))
+    else:
+        print(report.format())
+
+
+if __name__ == "__main__":
+    main()
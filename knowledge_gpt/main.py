@@ -1,20 +1,31 @@
+import time
+
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 from knowledge_gpt.components.sidebar import sidebar
+from knowledge_gpt.components.document_viewer import (
+    document_viewer,
+    jump_to_page,
+    SHOW_FULL_DOC_KEY,
+)
 
 from knowledge_gpt.ui import (
-    wrap_doc_in_html,
     is_query_valid,
     is_file_valid,
     is_open_ai_key_valid,
     display_file_read_error,
 )
 
-from knowledge_gpt.core.caching import bootstrap_caching
+from knowledge_gpt.core.caching import (
+    bootstrap_caching,
+    embed_files_in_background,
+    get_usage_ledger,
+)
 
 from knowledge_gpt.core.parsing import read_file
 from knowledge_gpt.core.chunking import chunk_file
-from knowledge_gpt.core.embedding import embed_files
+from knowledge_gpt.core.embedding import SearchFilter
 from knowledge_gpt.core.qa import query_folder
 from knowledge_gpt.core.utils import get_llm
 
@@ -32,6 +43,10 @@ st.header("📖KnowledgeGPT")
 # Enable caching for expensive functions
 bootstrap_caching()
 
+usage_ledger = get_usage_ledger()
+ctx = get_script_run_ctx()
+session_id = ctx.session_id if ctx is not None else ""
+
 sidebar()
 
 openai_api_key = st.session_state.get("OPENAI_API_KEY")
@@ -52,9 +67,21 @@ uploaded_file = st.file_uploader(
 
 model: str = st.selectbox("Model", options=MODEL_LIST)  # type: ignore
 
-with st.expander("Advanced Options"):
+advanced_options = st.expander("Advanced Options")
+
+with advanced_options:
     return_all_chunks = st.checkbox("Show all chunks retrieved from vector search")
-    show_full_doc = st.checkbox("Show parsed contents of the document")
+    map_reduce = st.checkbox(
+        "Look for the answer in many more chunks",
+        help="Slower, but better for questions about the whole document",
+    )
+    compress = st.checkbox(
+        "Only send the most relevant sentences to the model",
+        help="Faster and cheaper, but the model sees less context",
+    )
+    show_full_doc = st.checkbox(
+        "Show parsed contents of the document", key=SHOW_FULL_DOC_KEY
+    )
 
 
 if not uploaded_file:
@@ -70,17 +97,53 @@ chunked_file = chunk_file(file, chunk_size=300, chunk_overlap=0)
 if not is_file_valid(file):
     st.stop()
 
+num_pages = max(doc.metadata.get("page", 1) for doc in file.docs)
+search_filter = None
+
+if num_pages > 1:
+    with advanced_options:
+        pages = st.slider("Pages to search", 1, num_pages, (1, num_pages))
+    if pages != (1, num_pages):
+        search_filter = SearchFilter(pages=pages)
+
 
 if not is_open_ai_key_valid(openai_api_key, model):
     st.stop()
 
 
-with st.spinner("Indexing document... This may take a while⏳"):
-    folder_index = embed_files(
-        files=[chunked_file],
-        embedding=EMBEDDING if model != "debug" else "debug",
-        vector_store=VECTOR_STORE if model != "debug" else "debug",
-        openai_api_key=openai_api_key,
+# Indexing runs in the background, so the first pages can be queried while
+# the rest of the document is being indexed
+indexing_job = embed_files_in_background(
+    files=[chunked_file],
+    embedding=EMBEDDING if model != "debug" else "debug",
+    vector_store=VECTOR_STORE if model != "debug" else "debug",
+    openai_api_key=openai_api_key,
+)
+
+if indexing_job.error is not None or (
+    indexing_job.finished and indexing_job.folder_index is None
+):
+    st.error(f"Error indexing document: {indexing_job.error}")
+    st.stop()
+
+if not indexing_job.finished:
+    st.progress(
+        indexing_job.progress,
+        text=f"Indexing document... {indexing_job.done}/{indexing_job.total} chunks."
+        " You can already ask questions about the indexed part⏳",
+    )
+
+if indexing_job.folder_index is None:
+    # Nothing to query yet
+    time.sleep(0.5)
+    st.experimental_rerun()
+
+folder_index = indexing_job.folder_index
+
+if folder_index.dedup_ratio > 0:
+    st.caption(
+        f"{folder_index.dedup_ratio:.0%} of the document was repeated text"
+        " and was indexed only once."
     )
 
 with st.form(key="qa_form"):
@@ -89,33 +152,61 @@ with st.form(key="qa_form"):
 
 
 if show_full_doc:
-    with st.expander("Document"):
-        # Hack to get around st.markdown rendering LaTeX
-        st.markdown(f"<p>{wrap_doc_in_html(file.docs)}</p>", unsafe_allow_html=True)
+    document_viewer(file)
 
 
 if submit:
     if not is_query_valid(query):
         st.stop()
 
-    # Output Columns
-    answer_col, sources_col = st.columns(2)
-
     llm = get_llm(model=model, openai_api_key=openai_api_key, temperature=0)
     result = query_folder(
         folder_index=folder_index,
         query=query,
         return_all=return_all_chunks,
         llm=llm,
+        chain_type="map_reduce" if map_reduce else "stuff",
+        search_filter=search_filter,
+        compression="lexical" if compress else None,
+        short_prompt=compress,
+        usage_ledger=usage_ledger,
+        session_id=session_id,
     )
+    # Keep the answer around so that jumping to a source (which reruns the
+    # script) does not clear it
+    st.session_state["last_answer"] = (file.id, result)
+
+
+last_answer = st.session_state.get("last_answer")
+
+if last_answer is not None and last_answer[0] == file.id:
+    result = last_answer[1]
+
+    # Output Columns
+    answer_col, sources_col = st.columns(2)
 
     with answer_col:
         st.markdown("#### Answer")
         st.markdown(result.answer)
+        if result.usage is not None:
+            tokens = result.usage.prompt_tokens + result.usage.completion_tokens
+            st.caption(f"{tokens} tokens, about ${result.usage.cost:.4f}")
 
     with sources_col:
         st.markdown("#### Sources")
-        for source in result.sources:
+        for i, source in enumerate(result.sources):
             st.markdown(source.page_content)
-            st.markdown(source.metadata["source"])
+            st.button(
+                source.metadata["source"],
+                key=f"source_{i}",
+                help="Show this page in the document viewer",
+                on_click=jump_to_page,
+                args=(source.metadata.get("page", 1),),
+            )
             st.markdown("---")
+
+
+if not indexing_job.finished:
+    # Refresh the progress until the document is fully indexed
+    time.sleep(1)
+    st.experimental_rerun()
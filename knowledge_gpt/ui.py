@@ -1,4 +1,5 @@
 from typing import List
+from html import escape
 import streamlit as st
 from langchain.docstore.document import Document
 from knowledge_gpt.core.parsing import File
@@ -9,13 +10,18 @@ from typing import NoReturn
 logger = get_logger(__name__)
 
 
-def wrap_doc_in_html(docs: List[Document]) -> str:
-    """Wraps each page in document separated by newlines in <p> tags"""
-    text = [doc.page_content for doc in docs]
-    if isinstance(text, list):
-        # Add horizontal rules between pages
-        text = "\n<hr/>\n".join(text)
-    return "".join([f"<p>{line}</p>" for line in text.split("\n")])
+def wrap_page_in_html(doc: Document) -> str:
+    """Wraps each line of a single page in <p> tags"""
+    return "".join([f"<p>{escape(line)}</p>" for line in doc.page_content.split("\n")])
+
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def get_page_fragments(file_id: str, _docs: List[Document]) -> List[str]:
+    """Precomputes the HTML of every page in a file. Cached per file id
+    (the docs themselves are not hashed) and shared across sessions
+    without copying.
+    """
+    return [wrap_page_in_html(doc) for doc in _docs]
 
 
 def is_query_valid(query: str) -> bool:
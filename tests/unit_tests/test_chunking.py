@@ -35,6 +35,8 @@ def test_chunk_file_single_page_no_overlap(single_page_file):
     assert chunked_file.docs[0].metadata["source"] == "1-1"
     assert chunked_file.docs[1].metadata["source"] == "1-2"
 
+    assert all(0 < doc.metadata["token_count"] <= 6 for doc in chunked_file.docs)
+
 
 def test_chunk_file_multi_page_no_overlap(multi_page_file):
     chunked_file = chunk_file(multi_page_file, chunk_size=10, chunk_overlap=0)
@@ -0,0 +1,171 @@
+import asyncio
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import pytest
+from langchain.embeddings.base import Embeddings
+
+from knowledge_gpt.core import embedding
+from knowledge_gpt.core.coalescing import CoalescingEmbeddings
+from knowledge_gpt.core.embedding import get_embeddings
+
+
+class CountingEmbeddings(Embeddings):
+    """Embeds a text as its length and records the requests"""
+
+    def __init__(self, fail: bool = False):
+        self.requests: List[List[str]] = []
+        self.fail = fail
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self._lock:
+            self.requests.append(texts)
+        if self.fail:
+            raise ValueError("rate limited")
+        return [[float(len(text))] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def embed_concurrently(embeddings: Embeddings, queries: List[str]) -> List[List[float]]:
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        return list(executor.map(embeddings.embed_query, queries))
+
+
+def test_concurrent_queries_embedded_in_one_request():
+    counting = CountingEmbeddings()
+    embeddings = CoalescingEmbeddings(counting, window=0.2)
+    queries = ["a", "bb", "ccc", "dddd", "bb"]
+
+    vectors = embed_concurrently(embeddings, queries)
+
+    assert vectors == [[1.0], [2.0], [3.0], [4.0], [2.0]]
+    assert len(counting.requests) == 1
+    assert sorted(counting.requests[0]) == ["a", "bb", "ccc", "dddd"]
+    assert embeddings.stats.batches == 1
+
+
+def test_full_batch_sent_without_waiting():
+    counting = CountingEmbeddings()
+    embeddings = CoalescingEmbeddings(counting, window=10, max_batch=2)
+
+    vectors = embed_concurrently(embeddings, ["a", "bb"])
+
+    assert vectors == [[1.0], [2.0]]
+    assert counting.requests and len(counting.requests[0]) == 2
+
+
+def test_cached_queries_not_embedded_again():
+    counting = CountingEmbeddings()
+    embeddings = CoalescingEmbeddings(counting, window=0, cache_size=1)
+
+    embeddings.embed_query("a")
+    embeddings.embed_query("a")
+    embeddings.embed_query("bb")
+    embeddings.embed_query("a")
+
+    assert counting.requests == [["a"], ["bb"], ["a"]]
+    assert embeddings.stats.cache_hits == 1
+
+
+def test_only_requested_queries_are_charged():
+    counting = CountingEmbeddings()
+    embeddings = CoalescingEmbeddings(counting, window=0.2)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(embeddings.embed_query_requested, ["a", "a"]))
+
+    # Identical queries of a batch share one request, charged to one caller
+    assert sorted(requested for _, requested in results) == [False, True]
+    assert embeddings.embed_query_requested("a") == ([1.0], False)
+    assert asyncio.run(embeddings.aembed_query_requested("bb")) == ([2.0], True)
+    assert asyncio.run(embeddings.aembed_query_requested("bb")) == ([2.0], False)
+
+
+def test_errors_propagate_to_all_callers():
+    embeddings = CoalescingEmbeddings(CountingEmbeddings(fail=True), window=0.1)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(embeddings.embed_query, q) for q in ["a", "b"]]
+        for future in futures:
+            with pytest.raises(ValueError):
+                future.result()
+
+
+def test_get_embeddings_shares_coalescer():
+    first = get_embeddings("debug")
+    second = get_embeddings("debug")
+
+    assert isinstance(first, CoalescingEmbeddings)
+    assert first is second
+    assert isinstance(pickle.loads(pickle.dumps(first)), CoalescingEmbeddings)
+    assert not isinstance(get_embeddings("debug", coalesce=False), CoalescingEmbeddings)
+
+
+def test_get_embeddings_keeps_recent_settings_by_hash(monkeypatch):
+    monkeypatch.setattr(embedding, "MAX_COALESCING_EMBEDDINGS", 2)
+    for key in ["sk-1", "sk-2", "sk-3"]:
+        get_embeddings("debug", openai_api_key=key)
+
+    assert len(embedding._coalescing_embeddings) == 2
+    assert not any("sk-" in key for key in embedding._coalescing_embeddings)
+
+
+def test_interrupted_leader_releases_other_callers():
+    class InterruptedEmbeddings(CountingEmbeddings):
+        def embed_documents(self, texts: List[str]) -> List[List[float]]:
+            raise KeyboardInterrupt
+
+    embeddings = CoalescingEmbeddings(InterruptedEmbeddings(), window=0.2)
+    errors = []
+
+    def leader():
+        try:
+            embeddings.embed_query("a")
+        except KeyboardInterrupt as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    while embeddings._batch is None:
+        pass
+    with pytest.raises(RuntimeError):
+        embeddings.embed_query("b")
+    thread.join()
+
+    assert len(errors) == 1
+
+
+def test_async_queries_are_coalesced():
+    counting = CountingEmbeddings()
+    embeddings = CoalescingEmbeddings(counting, window=0.2)
+
+    async def embed_all() -> List[List[float]]:
+        return await asyncio.gather(
+            *[embeddings.aembed_query(query) for query in ["a", "bb", "ccc"]]
+        )
+
+    assert asyncio.run(embed_all()) == [[1.0], [2.0], [3.0]]
+    assert counting.requests == [["a", "bb", "ccc"]]
+    assert asyncio.run(embeddings.aembed_query("a")) == [1.0]
+    assert embeddings.stats.cache_hits == 1
+
+
+def test_cancelled_leader_does_not_fail_the_batch():
+    counting = CountingEmbeddings()
+    embeddings = CoalescingEmbeddings(counting, window=0.2)
+
+    async def embed_both() -> List[float]:
+        leader = asyncio.ensure_future(embeddings.aembed_query("a"))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(embeddings.aembed_query("bb"))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(embed_both()) == [2.0]
+    assert counting.requests == [["a", "bb"]]
@@ -0,0 +1,94 @@
+import numpy as np
+from langchain.docstore.document import Document
+
+from knowledge_gpt.core.compression import (
+    compress_documents,
+    estimate_tokens,
+    split_sentences,
+)
+from .test_embedding import LookupEmbeddings
+
+DOCS = [
+    Document(
+        page_content="The weather was nice. Payment is due within 30 days.\n"
+        "Late payment incurs a fee.",
+        metadata={"source": "1-1"},
+    ),
+    Document(
+        page_content="The office is in Berlin. It has a garden.",
+        metadata={"source": "2-1"},
+    ),
+]
+
+
+def test_split_sentences():
+    assert split_sentences("One. Two?  Three!\nFour\n\n") == [
+        "One.",
+        "Two?",
+        "Three!",
+        "Four",
+    ]
+
+
+def test_lexical_compression_keeps_relevant_sentences_and_sources():
+    docs = compress_documents("When is the payment due?", DOCS, token_budget=20)
+
+    assert [doc.page_content for doc in docs] == [
+        "Payment is due within 30 days. Late payment incurs a fee."
+    ]
+    assert docs[0].metadata["source"] == "1-1"
+
+
+def test_compression_respects_budget():
+    budget = estimate_tokens("Payment is due within 30 days.")
+
+    docs = compress_documents("When is the payment due?", DOCS, token_budget=budget)
+
+    assert [doc.page_content for doc in docs] == ["Payment is due within 30 days."]
+
+
+def test_embedding_compression():
+    embeddings = LookupEmbeddings(
+        {
+            "Where is the office?": [1.0, 0.0],
+            "The weather was nice.": [0.0, 1.0],
+            "Payment is due within 30 days.": [0.1, 1.0],
+            "Late payment incurs a fee.": [0.2, 1.0],
+            "The office is in Berlin.": [1.0, 0.1],
+            "It has a garden.": [0.8, 0.3],
+        }
+    )
+
+    docs = compress_documents(
+        "Where is the office?", DOCS, token_budget=14, embeddings=embeddings
+    )
+
+    assert [doc.page_content for doc in docs] == [
+        "The office is in Berlin. It has a garden."
+    ]
+    assert docs[0].metadata["source"] == "2-1"
+
+
+def test_embedding_compression_reuses_the_query_vector():
+    # The query is not in the table, so embedding it would fail
+    embeddings = LookupEmbeddings(
+        {
+            "The weather was nice.": [0.0, 1.0],
+            "Payment is due within 30 days.": [0.1, 1.0],
+            "Late payment incurs a fee.": [0.2, 1.0],
+            "The office is in Berlin.": [1.0, 0.1],
+            "It has a garden.": [0.8, 0.3],
+        }
+    )
+
+    docs = compress_documents(
+        "Where is the office?",
+        DOCS,
+        token_budget=14,
+        embeddings=embeddings,
+        query_vector=np.array([1.0, 0.0], dtype=np.float32),
+    )
+
+    assert [doc.page_content for doc in docs] == [
+        "The office is in Berlin. It has a garden."
+    ]
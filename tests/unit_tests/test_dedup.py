@@ -0,0 +1,86 @@
+import numpy as np
+from langchain.docstore.document import Document
+
+from knowledge_gpt.core.dedup import (
+    deduplicate_docs,
+    minhash_signatures,
+    shingle_hashes,
+)
+from knowledge_gpt.core.embedding import FolderIndex
+from knowledge_gpt.core.debug import FakeEmbeddings, FakeVectorStore
+from .fake_file import FakeFile
+
+DISCLAIMER = (
+    "This document is confidential and intended solely for the use of the "
+    "individual or entity to whom it is addressed. If you have received it in "
+    "error please notify the sender immediately and delete it from your system."
+)
+
+
+def test_minhash_signatures_match_per_set_computation():
+    """Batched signatures should equal signatures computed one set at a time."""
+    shingles = [shingle_hashes(text) for text in ["a b c d e f", "x", "a b c d e g"]]
+
+    batched = minhash_signatures(shingles)
+    single = np.vstack([minhash_signatures([s]) for s in shingles])
+
+    assert np.array_equal(batched, single)
+
+
+def test_exact_and_near_duplicates_removed():
+    docs = [
+        Document(page_content=DISCLAIMER, metadata={"file_id": "1", "source": "1-1"}),
+        Document(page_content="Revenue grew by 12% in the third quarter."),
+        Document(
+            page_content=DISCLAIMER.upper(), metadata={"file_id": "2", "source": "1-1"}
+        ),
+        Document(
+            page_content=DISCLAIMER.replace("system.", "systems."),
+            metadata={"file_id": "3", "source": "4-2"},
+        ),
+    ]
+
+    result = deduplicate_docs(docs)
+
+    assert [doc.page_content for doc in result.docs] == [
+        DISCLAIMER,
+        "Revenue grew by 12% in the third quarter.",
+    ]
+    assert result.num_duplicates == 2
+    assert result.ratio == 0.5
+    assert result.docs[0].metadata["duplicates"] == [
+        {"file_id": "2", "source": "1-1"},
+        {"file_id": "3", "source": "4-2"},
+    ]
+    # The input documents are not annotated, so deduplicating them again
+    # gives the same result
+    assert "duplicates" not in docs[0].metadata
+    assert deduplicate_docs(docs).docs[0].metadata == result.docs[0].metadata
+
+
+def test_different_docs_kept():
+    docs = [
+        Document(page_content=f"Clause {i}: the party shall pay {i * 100} dollars.")
+        for i in range(20)
+    ]
+    docs.append(Document(page_content="Completely unrelated text about the weather."))
+
+    result = deduplicate_docs(docs, threshold=0.9)
+
+    assert len(result.docs) == len(docs)
+    assert result.ratio == 0
+
+
+def test_folder_index_embeds_duplicates_once():
+    files = [
+        FakeFile(name="a.pdf", id="1", docs=[Document(page_content=DISCLAIMER)]),
+        FakeFile(name="b.pdf", id="2", docs=[Document(page_content=DISCLAIMER)]),
+    ]
+
+    folder_index = FolderIndex.from_files(
+        files, embeddings=FakeEmbeddings(), vector_store=FakeVectorStore
+    )
+
+    assert folder_index.index.texts == [DISCLAIMER]  # type: ignore
+    assert folder_index.dedup_ratio == 0.5
+    assert len(folder_index.files[1].docs) == 1
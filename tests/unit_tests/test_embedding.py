@@ -1,9 +1,33 @@
-from knowledge_gpt.core.embedding import FolderIndex, embed_files
+import asyncio
+import threading
+import time
+from knowledge_gpt.core.embedding import (
+    FolderIndex,
+    SearchFilter,
+    aembed_files,
+    embed_files,
+)
 from .fake_file import FakeFile
 from langchain.docstore.document import Document
 from knowledge_gpt.core.parsing import File
-from knowledge_gpt.core.debug import FakeVectorStore
+from knowledge_gpt.core.debug import FakeVectorStore, FakeEmbeddings
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.faiss import FAISS
 from typing import List
+import pickle
+
+
+class LookupEmbeddings(Embeddings):
+    """Embeddings looked up from a fixed table, for deterministic tests"""
+
+    def __init__(self, vectors: dict[str, List[float]]):
+        self.vectors = vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.vectors[text] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.vectors[text]
 
 
 def test_combining_files():
@@ -74,3 +98,258 @@ def test_embed_fake_embedding_vector_store():
     assert folder_index.index.texts[3] == "4"
     assert folder_index.index.texts[0] == folder_index.files[0].docs[0].page_content
     assert folder_index.index.texts[1] == folder_index.files[0].docs[1].page_content
+
+
+def test_search_reranks_and_drops_irrelevant_docs():
+    """Tests that near duplicate and irrelevant chunks are not retrieved."""
+
+    embeddings = LookupEmbeddings(
+        {
+            "query": [1.0, 0.0, 0.0],
+            "a": [1.0, 0.05, 0.0],
+            "a again": [1.0, 0.06, 0.0],
+            "b": [0.9, 0.0, 0.3],
+            "unrelated": [0.0, 0.0, 1.0],
+        }
+    )
+    files: List[File] = [
+        FakeFile(
+            name="file1",
+            id="1",
+            docs=[
+                Document(page_content=text)
+                for text in ["a", "a again", "b", "unrelated"]
+            ],
+        )
+    ]
+
+    folder_index = FolderIndex.from_files(
+        files, embeddings=embeddings, vector_store=FAISS, deduplicate=False
+    )
+    docs = folder_index.search("query", k=2, lambda_mult=0.5, min_k=1)
+    assert [doc.page_content for doc in docs] == ["a", "b"]
+
+    docs = folder_index.search("query", k=4, lambda_mult=0.5, min_k=1)
+    assert [doc.page_content for doc in docs] == ["a", "b", "a again"]
+
+    # The selection can be inspected in the metadata of the results
+    rankings = [doc.metadata["ranking"] for doc in docs]
+    assert [ranking["rank"] for ranking in rankings] == [1, 2, 3]
+    assert rankings[0]["relevance"] > rankings[1]["relevance"]
+    assert rankings[0]["mmr_score"] > rankings[1]["mmr_score"]
+    assert rankings[0]["cutoff"] == "relevance below 0.9 of the best"
+    assert "ranking" not in files[0].docs[0].metadata
+
+
+def test_add_documents_to_faiss_index():
+    """Tests that documents added later are searchable and survive pickling."""
+
+    embeddings = LookupEmbeddings(
+        {"query": [1.0, 0.0], "a": [0.0, 1.0], "b": [1.0, 0.1]}
+    )
+    files: List[File] = [
+        FakeFile(name="file1", id="1", docs=[Document(page_content="a")])
+    ]
+    folder_index = FolderIndex.from_files(
+        files, embeddings=embeddings, vector_store=FAISS
+    )
+
+    folder_index.add_documents([Document(page_content="b")], embeddings)
+    folder_index = pickle.loads(pickle.dumps(folder_index))
+    folder_index.attach_embeddings(embeddings)
+
+    docs = folder_index.search("query", k=1, min_k=1)
+    assert [doc.page_content for doc in docs] == ["b"]
+
+
+def test_filtered_search():
+    """Tests that filtered searches only return the selected files and pages."""
+
+    embeddings = LookupEmbeddings(
+        {
+            "query": [1.0, 0.0],
+            "a1": [1.0, 0.0],
+            "a2": [0.9, 0.1],
+            "b1": [1.0, 0.01],
+            "b2": [0.0, 1.0],
+        }
+    )
+    files: List[File] = [
+        FakeFile(
+            name="a.pdf",
+            id="a",
+            docs=[
+                Document(page_content="a1", metadata={"page": 1}),
+                Document(page_content="a2", metadata={"page": 2}),
+            ],
+        ),
+        FakeFile(
+            name="b.txt",
+            id="b",
+            docs=[
+                Document(page_content="b1", metadata={"page": 1}),
+                Document(page_content="b2", metadata={"page": 2}),
+            ],
+        ),
+    ]
+    folder_index = FolderIndex.from_files(
+        files, embeddings=embeddings, vector_store=FAISS
+    )
+
+    def search(**kwargs) -> List[str]:
+        docs = folder_index.search(
+            "query", k=4, min_k=4, search_filter=SearchFilter(**kwargs)
+        )
+        return [doc.page_content for doc in docs]
+
+    assert search(file_ids=["b"]) == ["b1", "b2"]
+    assert search(file_types=["pdf"]) == ["a1", "a2"]
+    assert search(pages=(2, 2)) == ["a2", "b2"]
+    assert search(file_ids=["a"], pages=(2, 5)) == ["a2"]
+    assert search(file_ids=["unknown"]) == []
+
+
+def test_filter_vector_ids_includes_duplicates():
+    files: List[File] = [
+        FakeFile(
+            name="a.pdf",
+            id="a",
+            docs=[Document(page_content="same", metadata={"page": 3})],
+        ),
+        FakeFile(
+            name="b.pdf",
+            id="b",
+            docs=[
+                Document(page_content="other", metadata={"page": 1}),
+                Document(page_content="same", metadata={"page": 7}),
+            ],
+        ),
+    ]
+    folder_index = FolderIndex.from_files(
+        files, embeddings=FakeEmbeddings(), vector_store=FAISS
+    )
+
+    assert folder_index.filter_vector_ids(SearchFilter(file_ids=["b"])).tolist() == [
+        0,
+        1,
+    ]
+    assert folder_index.filter_vector_ids(
+        SearchFilter(file_ids=["b"], pages=(7, 7))
+    ).tolist() == [0]
+
+
+def test_filter_vector_ids_after_adding_earlier_pages():
+    file = FakeFile(
+        name="a.pdf",
+        id="a",
+        docs=[
+            Document(page_content=f"page {page}", metadata={"page": page})
+            for page in [4, 5, 1, 2, 3]
+        ],
+    )
+    docs = FolderIndex._combine_files([file])
+    folder_index = FolderIndex.from_documents(
+        files=[file], docs=docs[:2], embeddings=FakeEmbeddings(), vector_store=FAISS
+    )
+    folder_index.add_documents(docs[2:], FakeEmbeddings())
+
+    ids, pages = folder_index._file_vectors["a"]
+    assert pages.tolist() == [1, 2, 3, 4, 5]
+    assert folder_index.filter_vector_ids(SearchFilter(pages=(2, 4))).tolist() == [
+        0,
+        3,
+        4,
+    ]
+
+
+def test_aembed_files_in_concurrent_batches():
+    class AsyncLookupEmbeddings(LookupEmbeddings):
+        def __init__(self, vectors: dict[str, List[float]]):
+            super().__init__(vectors)
+            self.in_flight = 0
+            self.max_in_flight = 0
+
+        async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.01)
+            self.in_flight -= 1
+            return self.embed_documents(texts)
+
+        async def aembed_query(self, text: str) -> List[float]:
+            return self.embed_query(text)
+
+    texts = [str(i) for i in range(10)]
+    embeddings = AsyncLookupEmbeddings(
+        {text: [1.0, float(i)] for i, text in enumerate(texts + ["query"])}
+    )
+    files: List[File] = [
+        FakeFile(
+            name="file.pdf",
+            id="1",
+            docs=[Document(page_content=text) for text in texts],
+        )
+    ]
+
+    folder_index = asyncio.run(
+        FolderIndex.afrom_files(
+            files, embeddings, FAISS, batch_size=3, max_concurrency=2
+        )
+    )
+
+    assert embeddings.max_in_flight == 2
+    assert folder_index.index.index.ntotal == 10  # type: ignore
+    sync_results = folder_index.search("0", k=3, min_k=3)
+    async_results = asyncio.run(folder_index.asearch("0", k=3, min_k=3))
+    assert async_results == sync_results
+
+
+def test_aembed_files_with_debug_embeddings():
+    files: List[File] = [
+        FakeFile(name="file.pdf", id="1", docs=[Document(page_content="1")])
+    ]
+
+    folder_index = asyncio.run(
+        aembed_files(files, embedding="debug", vector_store="faiss")
+    )
+
+    assert [doc.page_content for doc in asyncio.run(folder_index.asearch("1"))] == ["1"]
+
+
+def test_asearch_does_not_block_the_event_loop():
+    files: List[File] = [
+        FakeFile(name="file.pdf", id="1", docs=[Document(page_content="1")])
+    ]
+    folder_index = FolderIndex.from_files(files, FakeEmbeddings(), FAISS)
+
+    # Hold the index lock as if documents were being added
+    held = threading.Event()
+
+    def add_documents():
+        with folder_index._lock:
+            held.set()
+            time.sleep(0.3)
+
+    thread = threading.Thread(target=add_documents)
+    thread.start()
+    held.wait()
+
+    async def search_and_tick():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.ensure_future(tick())
+        docs = await folder_index.asearch("1")
+        ticker.cancel()
+        return docs, ticks
+
+    docs, ticks = asyncio.run(search_and_tick())
+    thread.join()
+
+    assert [doc.page_content for doc in docs] == ["1"]
+    assert ticks > 5
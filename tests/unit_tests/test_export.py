@@ -0,0 +1,82 @@
+from typing import List
+
+import pyarrow.parquet as pq
+from langchain.docstore.document import Document
+from langchain.vectorstores.faiss import FAISS
+
+from knowledge_gpt.core.embedding import FolderIndex, SearchFilter
+from knowledge_gpt.core.export import export_index, import_index
+from knowledge_gpt.core.parsing import File, PdfFile
+from knowledge_gpt.core.qa import get_sources
+from .fake_file import FakeFile
+from .test_embedding import LookupEmbeddings
+
+EMBEDDINGS = LookupEmbeddings(
+    {
+        "query": [1.0, 0.0, 0.0],
+        "intro": [1.0, 0.1, 0.0],
+        "terms": [0.0, 1.0, 0.0],
+        "disclaimer": [0.0, 0.0, 1.0],
+    }
+)
+
+
+def make_index() -> FolderIndex:
+    files: List[File] = [
+        FakeFile(
+            name="a.pdf",
+            id="a",
+            docs=[
+                Document(
+                    page_content=text,
+                    metadata={"page": page, "chunk": 1, "source": f"{page}-1"},
+                )
+                for page, text in enumerate(["intro", "terms", "disclaimer"], 1)
+            ],
+        ),
+        FakeFile(
+            name="b.pdf",
+            id="b",
+            docs=[
+                Document(
+                    page_content="disclaimer",
+                    metadata={"page": 4, "chunk": 1, "source": "4-1", "token_count": 1},
+                )
+            ],
+        ),
+    ]
+    return FolderIndex.from_files(files, embeddings=EMBEDDINGS, vector_store=FAISS)
+
+
+def test_export_writes_row_groups(tmp_path):
+    path = str(tmp_path / "index.parquet")
+
+    export_index(make_index(), path, row_group_size=2)
+
+    parquet_file = pq.ParquetFile(path)
+    assert parquet_file.metadata.num_rows == 3
+    assert parquet_file.metadata.num_row_groups == 2
+    table = parquet_file.read()
+    assert table.column("text").to_pylist() == ["intro", "terms", "disclaimer"]
+    assert table.column("token_count").to_pylist() == [None, None, None]
+    assert table.column("embedding").to_pylist()[1] == [0.0, 1.0, 0.0]
+
+
+def test_import_round_trip(tmp_path):
+    path = str(tmp_path / "index.parquet")
+    folder_index = make_index()
+    export_index(folder_index, path, row_group_size=2)
+
+    imported = import_index(path, EMBEDDINGS)
+
+    assert imported.dedup_ratio == folder_index.dedup_ratio == 0.25
+    assert [file.id for file in imported.files] == ["a", "b"]
+    assert isinstance(imported.files[0], PdfFile)
+    assert [doc.page_content for doc in imported.search("query", k=3, min_k=3)] == [
+        doc.page_content for doc in folder_index.search("query", k=3, min_k=3)
+    ]
+    # The deduplicated chunk is still found in, and cited from, its file
+    docs = imported.search("query", search_filter=SearchFilter(file_ids=["b"]))
+    assert [doc.page_content for doc in docs] == ["disclaimer"]
+    sources = get_sources("Answer. SOURCES: 4-1", imported)
+    assert [doc.metadata["file_id"] for doc in sources] == ["b"]
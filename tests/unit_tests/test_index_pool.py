@@ -0,0 +1,84 @@
+from langchain.docstore.document import Document
+from langchain.vectorstores.faiss import FAISS
+
+from knowledge_gpt.core.debug import FakeVectorStore
+from knowledge_gpt.core.embedding import FolderIndex
+from knowledge_gpt.core.index_pool import IndexPool, index_size
+from .fake_file import FakeFile
+from .test_embedding import LookupEmbeddings
+
+
+def make_index(text: str) -> FolderIndex:
+    file = FakeFile(name="file", id=text, docs=[Document(page_content=text)])
+    return FolderIndex(files=[file], index=FakeVectorStore(texts=[text]))
+
+
+def test_pool_spills_least_recently_used(tmp_path):
+    indexes = {key: make_index(key * 1000) for key in "abc"}
+    budget = index_size(indexes["a"]) * 2 + 100
+    pool = IndexPool(max_bytes=budget, spill_dir=str(tmp_path))
+
+    pool.put("a", indexes["a"])
+    pool.put("b", indexes["b"])
+    assert pool.get("a") is indexes["a"]  # "b" is now least recently used
+    pool.put("c", indexes["c"])
+
+    assert pool.stats.spills == 1
+    assert (tmp_path / "b.pkl").exists()
+    assert pool.memory_usage <= budget
+    assert len(pool) == 3
+
+    reloaded = pool.get("b")
+    assert reloaded is not None
+    assert reloaded.index.texts == ["b" * 1000]  # type: ignore
+    assert pool.stats.reloads == 1
+    assert pool.stats.spills == 2  # "a" made room for "b"
+    assert pool.stats.hits == 1
+    # Spill files are deleted once loaded back, and when the pool is closed
+    assert not (tmp_path / "b.pkl").exists()
+    assert (tmp_path / "a.pkl").exists()
+    pool.close()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_spilled_index_does_not_contain_embeddings(tmp_path):
+    embeddings = LookupEmbeddings({"query": [1.0, 0.0], "a": [1.0, 0.0]})
+    embeddings.openai_api_key = "sk-secret"  # type: ignore
+    file = FakeFile(name="file", id="a", docs=[Document(page_content="a")])
+    folder_index = FolderIndex.from_files([file], embeddings, FAISS)
+    pool = IndexPool(max_bytes=1, spill_dir=str(tmp_path))
+
+    pool.put("a", folder_index)
+    pool.put("b", make_index("b"))
+
+    assert b"sk-secret" not in (tmp_path / "a.pkl").read_bytes()
+    reloaded = pool.get("a")
+    assert reloaded is not None
+    assert [doc.page_content for doc in reloaded.search("query", k=1)] == ["a"]
+
+
+def test_index_size_counts_vectors_and_text():
+    embeddings = LookupEmbeddings({"a": [1.0, 0.0, 0.0]})
+    file = FakeFile(name="file", id="a", docs=[Document(page_content="a")])
+    folder_index = FolderIndex.from_files([file], embeddings, FAISS)
+
+    # The text of the file and the docstore, and one float32 vector
+    assert index_size(folder_index) == 1 + 1 + 3 * 4
+
+
+def test_pool_get_or_create(tmp_path):
+    pool = IndexPool(max_bytes=1, spill_dir=str(tmp_path))
+    created = []
+
+    def create() -> FolderIndex:
+        created.append(make_index("a"))
+        return created[-1]
+
+    assert pool.get_or_create("a", create) is created[0]
+    assert pool.get_or_create("a", create) is created[0]
+
+    # The most recently used index is kept even if it exceeds the budget
+    assert len(created) == 1
+    assert pool.stats.misses == 1
+    assert pool.stats.hits == 1
+    assert pool.stats.spills == 0
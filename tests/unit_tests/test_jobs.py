@@ -0,0 +1,124 @@
+import threading
+from typing import List
+
+from langchain.docstore.document import Document
+
+from knowledge_gpt.core.debug import FakeVectorStore
+from knowledge_gpt.core.index_pool import IndexPool
+from knowledge_gpt.core.jobs import IndexingJob, IndexingJobManager
+from knowledge_gpt.core.parsing import File
+from knowledge_gpt.core.usage import UsageLedger
+from .fake_file import FakeFile
+
+
+def make_files() -> List[File]:
+    return [
+        FakeFile(
+            name="file1",
+            id="1",
+            docs=[Document(page_content=f"chunk {i}") for i in range(10)],
+        )
+    ]
+
+
+def test_job_indexes_in_batches():
+    job = IndexingJob(
+        make_files(),
+        embedding="debug",
+        vector_store="debug",
+        first_batch_size=2,
+        batch_size=3,
+    )
+    job.run()
+
+    assert job.finished
+    assert job.error is None
+    assert job.total == job.done == 10
+    assert job.progress == 1
+    assert job.folder_index is not None
+    assert isinstance(job.folder_index.index, FakeVectorStore)
+    assert job.folder_index.index.texts == [f"chunk {i}" for i in range(10)]
+
+
+def test_job_records_errors():
+    job = IndexingJob(make_files(), embedding="unknown", vector_store="debug")
+    job.run()
+
+    assert job.finished
+    assert isinstance(job.error, NotImplementedError)
+    assert job.folder_index is None
+
+
+def test_job_records_usage_of_embedded_documents():
+    ledger = UsageLedger()
+    files = make_files()
+    files[0].docs.extend(Document(page_content="chunk 0") for _ in range(5))
+    job = IndexingJob(files, "debug", "debug", usage_ledger=ledger)
+    job.run()
+
+    # Duplicates are not embedded, so they are not accounted either
+    assert ledger.by_file["1"].records == 1
+    assert ledger.by_file["1"].embedding_tokens == sum(
+        max(1, round(len(f"chunk {i}") / 4)) for i in range(10)
+    )
+
+    failed = IndexingJob(files, "unknown", "debug", usage_ledger=ledger)
+    failed.run()
+
+    assert ledger.by_file["1"].records == 1
+
+
+def test_manager_shares_jobs_and_hands_over_to_pool(tmp_path):
+    pool = IndexPool(max_bytes=2**20, spill_dir=str(tmp_path))
+    manager = IndexingJobManager(pool=pool, max_workers=1)
+
+    # Keep the only worker busy so that the job stays in progress
+    busy = threading.Event()
+    manager._executor.submit(busy.wait)
+
+    job = manager.submit("key", make_files(), "debug", "debug")
+    assert manager.submit("key", make_files(), "debug", "debug") is job
+    assert not job.finished
+    assert job.folder_index is None
+
+    busy.set()
+    # The index is handed over to the pool after the job is marked finished
+    manager._executor.shutdown(wait=True)
+    assert job.error is None
+    assert pool.get("key") is job.folder_index
+
+    finished = manager.submit("key", make_files(), "debug", "debug")
+    assert finished is not job
+    assert finished.finished
+    assert finished.folder_index is job.folder_index
+
+
+def test_manager_does_not_wait_for_the_pool(tmp_path):
+    class SlowPool(IndexPool):
+        """Pool whose puts block, as if they were spilling to disk"""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.putting = threading.Event()
+            self.release = threading.Event()
+
+        def put(self, key, folder_index):
+            self.putting.set()
+            self.release.wait()
+            super().put(key, folder_index)
+
+    pool = SlowPool(max_bytes=2**20, spill_dir=str(tmp_path))
+    manager = IndexingJobManager(pool=pool, max_workers=2)
+
+    job = manager.submit("key", make_files(), "debug", "debug")
+    assert pool.putting.wait(timeout=5)
+
+    # Until its index is in the pool, the finished job is still returned
+    assert manager.submit("key", make_files(), "debug", "debug") is job
+    other = manager.submit("other", make_files(), "debug", "debug")
+    assert other is not job
+
+    pool.release.set()
+    manager._executor.shutdown(wait=True)
+    assert pool.get("key") is job.folder_index
+    assert manager._jobs == {}
@@ -0,0 +1,31 @@
+import time
+
+from knowledge_gpt import loadtest
+from knowledge_gpt.core.debug import FakeChatModel
+
+
+def test_load_test_report(monkeypatch):
+    # Chunking needs the tiktoken encodings, the pages are small enough as is
+    monkeypatch.setattr(loadtest, "chunk_file", lambda file, **kwargs: file)
+    args = loadtest.parse_args(
+        ["--sessions", "4", "--documents", "2", "--questions", "2", "--pages", "2"]
+    )
+
+    report = loadtest.run_load_test(args)
+
+    assert report.errors == 0
+    assert report.latency["index"].count == 4
+    assert report.latency["query"].count == 8
+    assert report.throughput["query"] > 0
+    # Sessions uploading the same document share its indexing job
+    assert report.jobs_started == 2
+    assert "query" in report.format()
+
+
+def test_fake_chat_model_latency():
+    llm = FakeChatModel(latency=0.05)
+
+    start = time.perf_counter()
+    llm.predict("question")
+
+    assert time.perf_counter() - start >= 0.05
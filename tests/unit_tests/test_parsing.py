@@ -1,10 +1,21 @@
+import asyncio
+import mmap
 import pytest
+import zipfile
 from io import BytesIO
 
+from streamlit.runtime.uploaded_file_manager import UploadedFile, UploadedFileRec
+
+from knowledge_gpt.core import parsing
+from knowledge_gpt.core.caching import upload_hash_func
 from knowledge_gpt.core.parsing import (
     DocxFile,
     PdfFile,
     TxtFile,
+    Upload,
+    aread_file,
+    content_hash,
+    iter_text_pages,
     read_file,
     strip_consecutive_newlines,
 )
@@ -39,10 +50,76 @@ def test_docx_file_with_multiple_pages():
         docx_file = DocxFile.from_bytes(file)
 
     assert docx_file.name == "test.docx"
-    assert len(docx_file.docs) == 1
-    assert (
-        docx_file.docs[0].page_content == "Hello World 1\nHello World 2\nHello World 3"
+    assert len(docx_file.docs) == 3
+    assert docx_file.docs[0].page_content == "Hello World 1"
+    assert docx_file.docs[1].page_content == "Hello World 2"
+    assert docx_file.docs[2].page_content == "Hello World 3"
+
+    assert docx_file.docs[0].metadata["page"] == 1
+    assert docx_file.docs[2].metadata["page"] == 3
+    assert docx_file.docs[2].metadata["source"] == "p-3"
+
+
+def make_docx(body: str) -> BytesIO:
+    """Creates a minimal .docx file with the given document body"""
+    xml = (
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/'
+        f'wordprocessingml/2006/main"><w:body>{body}</w:body></w:document>'
+    )
+    file = BytesIO()
+    with zipfile.ZipFile(file, "w") as docx:
+        docx.writestr("word/document.xml", xml)
+    file.name = "test.docx"
+    file.seek(0)
+    return file
+
+
+def test_docx_file_with_headings_and_breaks():
+    file = make_docx(
+        '<w:p><w:pPr><w:pStyle w:val="Heading1"/></w:pPr>'
+        "<w:r><w:t>Intro</w:t></w:r></w:p>"
+        "<w:p><w:r><w:t>First</w:t><w:tab/><w:t>page</w:t></w:r></w:p>"
+        '<w:p><w:r><w:t>Before</w:t><w:br w:type="page"/><w:t>After</w:t></w:r></w:p>'
+        "<w:p><w:pPr><w:sectPr/></w:pPr><w:r><w:t>End of section</w:t></w:r></w:p>"
+        '<w:p><w:pPr><w:pStyle w:val="Heading2"/></w:pPr>'
+        "<w:r><w:t>Terms</w:t></w:r></w:p>"
+        "<w:tbl><w:tr><w:tc><w:p><w:r><w:t>Cell</w:t></w:r></w:p></w:tc></w:tr></w:tbl>"
     )
+    docx_file = DocxFile.from_bytes(file)
+
+    assert [doc.page_content for doc in docx_file.docs] == [
+        "Intro\nFirst\tpage\nBefore",
+        "After\nEnd of section",
+        "Terms\nCell",
+    ]
+    assert [doc.metadata["heading"] for doc in docx_file.docs] == [
+        "Intro",
+        "Intro",
+        "Terms",
+    ]
+    assert [doc.metadata["source"] for doc in docx_file.docs] == ["p-1", "p-2", "p-3"]
+
+
+def test_docx_page_break_and_rendered_break_end_one_page():
+    file = make_docx(
+        '<w:p><w:r><w:t>One</w:t><w:br w:type="page"/></w:r></w:p>'
+        "<w:p><w:r><w:lastRenderedPageBreak/><w:t>Two</w:t></w:r></w:p>"
+        '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+        "<w:p><w:r><w:lastRenderedPageBreak/><w:t>Three</w:t></w:r></w:p>"
+    )
+    docx_file = DocxFile.from_bytes(file)
+
+    assert [doc.page_content for doc in docx_file.docs] == ["One", "Two", "Three"]
+    assert [doc.metadata["page"] for doc in docx_file.docs] == [1, 2, 3]
+
+
+def test_docx_file_without_breaks_is_split_by_size(monkeypatch):
+    monkeypatch.setattr(DocxFile, "page_size", 10)
+    file = make_docx("<w:p><w:r><w:t>Hello World</w:t></w:r></w:p>" * 3)
+    docx_file = DocxFile.from_bytes(file)
+
+    assert len(docx_file.docs) == 3
+    assert docx_file.docs[2].page_content == "Hello World"
 
 
 def test_pdf_file_with_single_page():
@@ -161,3 +238,113 @@ def test_strip_consecutive_newlines():
     text = "\nHello\nWorld\n"
     expected = "\nHello\nWorld\n"
     assert strip_consecutive_newlines(text) == expected
+
+
+def test_txt_file_split_into_pages(monkeypatch):
+    monkeypatch.setattr(TxtFile, "block_size", 7)
+    monkeypatch.setattr(TxtFile, "page_size", 12)
+
+    file = BytesIO("Hello World 1\n \n\nHello World 2\nHéllo 3".encode("utf-8"))
+    file.name = "test.txt"
+    txt_file = TxtFile.from_bytes(file)
+
+    assert [doc.page_content for doc in txt_file.docs] == [
+        "Hello World",
+        "1",
+        "Hello World",
+        "2\nHéllo 3",
+    ]
+    assert txt_file.docs[1].metadata["page"] == 2
+    assert txt_file.docs[1].metadata["source"] == "p-2"
+
+
+def test_iter_text_pages_matches_whole_file_decoding():
+    text = "a \n\t\n b" * 50 + "ü\n\n" * 30 + "end"
+    data = text.encode("utf-8")
+    blocks = [data[i : i + 3] for i in range(0, len(data), 3)]
+
+    pages = list(iter_text_pages(iter(blocks), page_size=10_000))
+
+    assert pages == [strip_consecutive_newlines(text).strip()]
+
+
+def test_iter_text_pages_splits_on_newline_at_block_boundary():
+    # The first block is exactly one page long and ends mid-line
+    for blocks in [[b"Hello\nWorld!", b"abc def"], [b"Hello\nWorld!abc def"]]:
+        pages = list(iter_text_pages(iter(blocks), page_size=12))
+        assert pages == ["Hello", "World!abc", "def"]
+
+    pages = list(iter_text_pages(iter([b"Hello\nWorld!x", b"abc def"]), 12))
+    assert pages == ["Hello", "World!xabc", "def"]
+
+
+def test_txt_file_from_disk_is_memory_mapped(tmp_path):
+    path = tmp_path / "test.txt"
+    path.write_bytes(b"Hello\n\n\nWorld")
+    with open(path, "rb") as f:
+        txt_file = TxtFile.from_bytes(f)  # type: ignore
+
+    assert txt_file.docs[0].page_content == "Hello\nWorld"
+    assert txt_file.id == content_hash(b"Hello\n\n\nWorld")
+
+
+def test_upload_is_read_once_and_shared(monkeypatch):
+    with open(SAMPLE_ROOT / "test_hello.pdf", "rb") as f:
+        data = f.read()
+    # Streamlit 1.24 gives uploaded files int ids
+    file = UploadedFile(
+        UploadedFileRec(id=1, name="test_hello.pdf", type="application/pdf", data=data)
+    )
+    hashed = []
+    monkeypatch.setattr(
+        parsing, "content_hash", lambda data: hashed.append(data) or "hash"
+    )
+
+    upload = Upload.from_file(file)
+    file_hash = upload_hash_func(file)
+    pdf_file = read_file(file)
+
+    assert Upload.from_file(file) is upload
+    assert not hasattr(file, "_upload")
+    assert pdf_file.id == file_hash == upload.id == "hash"
+    assert len(hashed) == 1
+
+
+def test_memory_mapped_upload_is_closed(tmp_path):
+    path = tmp_path / "test.txt"
+    path.write_bytes(b"Hello World")
+
+    with open(path, "rb") as f:
+        with Upload.from_file(f) as upload:  # type: ignore
+            assert isinstance(upload.data, mmap.mmap)
+        assert upload.data.closed
+        # Parsing closes the map it reads, so the next call maps it again
+        txt_file = TxtFile.from_bytes(f)  # type: ignore
+        assert txt_file.docs[0].page_content == "Hello World"
+        assert Upload.from_file(f) is not upload  # type: ignore
+
+
+def test_file_id_does_not_depend_on_stream_position():
+    for ext in [".docx", ".pdf", ".txt"]:
+        with open(SAMPLE_ROOT / f"test_hello{ext}", "rb") as f:
+            data = f.read()
+
+        ids = []
+        for position in [0, len(data) // 2, len(data)]:
+            file = BytesIO(data)
+            file.name = f"test_hello{ext}"
+            file.seek(position)
+            ids.append(read_file(file).id)
+
+        assert ids == [content_hash(data)] * 3
+
+
+def test_aread_file():
+    with open(SAMPLE_ROOT / "test_hello.pdf", "rb") as f:
+        file = BytesIO(f.read())
+        file.name = "test_hello.pdf"
+
+    file_obj = asyncio.run(aread_file(file))
+
+    assert isinstance(file_obj, PdfFile)
+    assert file_obj.docs[0].page_content == "Hello World"
@@ -1,12 +1,26 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
 from langchain.docstore.document import Document
-from knowledge_gpt.core.qa import get_sources
+from langchain.chat_models.fake import FakeListChatModel
+from knowledge_gpt.core.qa import (
+    aextract_relevant_text,
+    aquery_folder,
+    extract_relevant_text,
+    get_sources,
+    query_folder,
+)
 from knowledge_gpt.core.embedding import FolderIndex
+from knowledge_gpt.core.usage import UsageLedger
 
 from typing import List
 from .fake_file import FakeFile
 from knowledge_gpt.core.parsing import File
 
-from knowledge_gpt.core.debug import FakeVectorStore
+from knowledge_gpt.core.debug import FakeVectorStore, FakeChatModel, FakeEmbeddings
+from langchain.vectorstores.faiss import FAISS
+from knowledge_gpt.core.coalescing import CoalescingEmbeddings
 
 
 def test_getting_sources_from_answer():
@@ -40,3 +54,297 @@ def test_getting_sources_from_answer():
     assert sources[1].metadata["source"] == "2"
     assert sources[2].metadata["source"] == "3"
     assert sources[3].metadata["source"] == "4"
+
+
+def test_extract_relevant_text_stops_with_enough_evidence():
+    """Test that no more groups are sent once enough evidence is found."""
+    docs = [
+        Document(page_content=str(i), metadata={"source": f"{i}-1"})
+        for i in range(1, 11)
+    ]
+    llm = FakeListChatModel(
+        responses=["Text A\nSOURCES: 1-1", "Text B\nSOURCES: 3-1, 9-9"]
+    )
+
+    extracts = extract_relevant_text(
+        "test", docs, llm, group_size=2, max_concurrency=1, enough_evidence=2
+    )
+
+    assert llm.i == 2
+    assert [doc.page_content for doc in extracts] == ["Text A", "Text B"]
+    assert extracts[0].metadata["source"] == "1-1"
+    assert extracts[1].metadata["source"] == "3-1"
+
+
+def test_extract_relevant_text_skips_irrelevant_groups():
+    docs = [Document(page_content="1", metadata={"source": "1-1"})] * 8
+    llm = FakeListChatModel(responses=["NONE"] * 4)
+
+    extracts = extract_relevant_text("test", docs, llm, group_size=2)
+
+    assert llm.i == 4
+    assert extracts == []
+
+
+def test_query_folder_map_reduce():
+    files: List[File] = [
+        FakeFile(
+            name="file1",
+            id="1",
+            docs=[
+                Document(page_content=str(i), metadata={"source": str(i)})
+                for i in range(1, 5)
+            ],
+        )
+    ]
+    folder_index = FolderIndex(
+        files=files, index=FakeVectorStore(texts=["1", "2", "3", "4"])
+    )
+
+    result = query_folder(
+        "test", folder_index, FakeChatModel(), chain_type="map_reduce"
+    )
+
+    assert result.answer == "The answer is 42. "
+    assert [doc.metadata["source"] for doc in result.sources] == ["1", "2", "3", "4"]
+
+
+def test_query_folder_accounts_usage():
+    files: List[File] = [
+        FakeFile(
+            name="file1",
+            id="1",
+            docs=[
+                Document(
+                    page_content=str(i), metadata={"source": str(i), "token_count": 1}
+                )
+                for i in range(1, 5)
+            ],
+        )
+    ]
+    folder_index = FolderIndex(
+        files=files, index=FakeVectorStore(texts=["1", "2", "3", "4"])
+    )
+
+    map_reduce = query_folder(
+        "test", folder_index, FakeChatModel(), chain_type="map_reduce"
+    ).usage
+    stuff = query_folder("test", folder_index, FakeChatModel()).usage
+
+    assert stuff is not None and map_reduce is not None
+    assert stuff.kind == "query"
+    assert stuff.model == "FakeChatModel"
+    assert 0 < stuff.prompt_tokens < map_reduce.prompt_tokens
+    assert 0 < stuff.completion_tokens < map_reduce.completion_tokens
+    # No prices are known for the fake models
+    assert stuff.cost == 0
+
+
+def test_cached_query_embeddings_are_not_charged():
+    embeddings = CoalescingEmbeddings(FakeEmbeddings(), window=0)
+    folder_index = FolderIndex.from_files(
+        [
+            FakeFile(
+                name="file1",
+                id="1",
+                docs=[Document(page_content="It rains.", metadata={"source": "1"})],
+            )
+        ],
+        embeddings=embeddings,
+        vector_store=FAISS,
+    )
+
+    first = query_folder("What is the fee?", folder_index, FakeChatModel()).usage
+    second = query_folder("What is the fee?", folder_index, FakeChatModel()).usage
+
+    assert first is not None and second is not None
+    assert first.embedding_tokens > 0
+    # The vector of the repeated query came from the cache
+    assert second.embedding_tokens == 0
+    assert second.prompt_tokens == first.prompt_tokens
+
+
+def test_identical_concurrent_queries_answered_once():
+    files: List[File] = [
+        FakeFile(
+            name="file1",
+            id="1",
+            docs=[Document(page_content="1", metadata={"source": "1"})],
+        )
+    ]
+    folder_index = FolderIndex(files=files, index=FakeVectorStore(texts=["1"]))
+    llm = FakeChatModel(latency=0.2)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [
+            executor.submit(query_folder, query, folder_index, llm)
+            for query in ["What is it?", "what  is it?", "What is it? "]
+        ]
+        results = [future.result() for future in futures]
+
+    assert llm.i == 1
+    assert all(result.answer == "The answer is 42. " for result in results)
+
+
+def test_shared_answer_usage_is_recorded_once():
+    files: List[File] = [
+        FakeFile(
+            name="file1",
+            id="1",
+            docs=[Document(page_content="1", metadata={"source": "1", "file_id": "1"})],
+        )
+    ]
+    folder_index = FolderIndex(files=files, index=FakeVectorStore(texts=["1"]))
+    llm = FakeChatModel(latency=0.2)
+    ledger = UsageLedger()
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [
+            executor.submit(
+                query_folder,
+                "What is it?",
+                folder_index,
+                llm,
+                usage_ledger=ledger,
+                session_id=session_id,
+            )
+            for session_id in ["a", "b", "c"]
+        ]
+        results = [future.result() for future in futures]
+
+    assert llm.i == 1
+    assert ledger.by_model["FakeChatModel"].records == 1
+    assert sum(totals.records for totals in ledger.by_session.values()) == 1
+    assert all(result.usage == results[0].usage for result in results)
+
+
+def test_query_folder_with_compression():
+    files: List[File] = [
+        FakeFile(
+            name="file1",
+            id="1",
+            docs=[Document(page_content="1", metadata={"source": "1"})],
+        )
+    ]
+    folder_index = FolderIndex(
+        files=files, index=FakeVectorStore(texts=["The fee is 5. It rains."])
+    )
+
+    result = query_folder(
+        "What is the fee?",
+        folder_index,
+        FakeChatModel(),
+        compression="lexical",
+        short_prompt=True,
+    )
+
+    assert result.answer == "The answer is 42. "
+    with pytest.raises(ValueError):
+        query_folder("test", folder_index, FakeChatModel(), compression="embedding")
+
+
+class CountingEmbeddings(FakeEmbeddings):
+    """Fake embeddings remembering the queries they embedded"""
+
+    queries: List[str] = []
+
+    def embed_query(self, text: str) -> List[float]:
+        self.queries.append(text)
+        return super().embed_query(text)
+
+
+def test_embedding_compression_uses_the_index_embeddings():
+    embeddings = CountingEmbeddings(queries=[])
+    folder_index = FolderIndex.from_files(
+        [
+            FakeFile(
+                name="file1",
+                id="1",
+                docs=[Document(page_content="It rains.", metadata={"source": "1"})],
+            )
+        ],
+        embeddings=embeddings,
+        vector_store=FAISS,
+    )
+
+    result = query_folder(
+        "What is the fee?", folder_index, FakeChatModel(), compression="embedding"
+    )
+
+    assert result.answer == "The answer is 42. "
+    # The vector of the search is reused for the compression
+    assert embeddings.queries == ["What is the fee?"]
+
+
+def make_folder_index() -> FolderIndex:
+    files: List[File] = [
+        FakeFile(
+            name="file1",
+            id="1",
+            docs=[
+                Document(page_content=str(i), metadata={"source": str(i)})
+                for i in range(1, 5)
+            ],
+        )
+    ]
+    return FolderIndex(files=files, index=FakeVectorStore(texts=["1", "2", "3", "4"]))
+
+
+def test_aquery_folder_serves_concurrent_queries_on_one_loop():
+    folder_index = make_folder_index()
+    llm = FakeChatModel(latency=0.2)
+
+    async def main():
+        return await asyncio.gather(
+            *(
+                aquery_folder(f"Question {i}", folder_index, llm, chain_type=chain)
+                for i in range(10)
+                for chain in ["stuff", "map_reduce"]
+            )
+        )
+
+    start = time.perf_counter()
+    results = asyncio.run(main())
+
+    # The model calls wait concurrently, not one after the other
+    assert time.perf_counter() - start < 2
+    assert all(result.answer == "The answer is 42. " for result in results)
+    assert [doc.metadata["source"] for doc in results[0].sources] == [
+        "1",
+        "2",
+        "3",
+        "4",
+    ]
+
+
+def test_aquery_folder_timeout_cancels_the_query():
+    folder_index = make_folder_index()
+    llm = FakeChatModel(latency=10)
+
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await aquery_folder("test", folder_index, llm, timeout=0.1)
+        await asyncio.sleep(0)
+        return [task for task in asyncio.all_tasks() if not task.done()]
+
+    assert len(asyncio.run(main())) == 1  # only main itself
+
+
+def test_aextract_relevant_text_matches_sync_version():
+    docs = [
+        Document(page_content=str(i), metadata={"source": f"{i}-1"})
+        for i in range(1, 11)
+    ]
+    responses = ["Text A\nSOURCES: 1-1", "NONE", "Text C\nSOURCES: 9-1"]
+
+    sync_extracts = extract_relevant_text(
+        "test", docs, FakeListChatModel(responses=responses), max_concurrency=1
+    )
+    async_extracts = asyncio.run(
+        aextract_relevant_text(
+            "test", docs, FakeListChatModel(responses=responses), max_concurrency=1
+        )
+    )
+
+    assert async_extracts == sync_extracts
+    assert [doc.metadata["source"] for doc in async_extracts] == ["1-1", "9-1"]
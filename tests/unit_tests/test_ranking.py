@@ -0,0 +1,36 @@
+import numpy as np
+
+from knowledge_gpt.core.ranking import adaptive_k, maximal_marginal_relevance
+
+
+def test_mmr_skips_near_duplicates():
+    query = np.array([1.0, 0.0])
+    vectors = np.array(
+        [
+            [1.0, 0.05],  # most relevant
+            [1.0, 0.06],  # near duplicate of the first
+            [0.8, -0.6],  # less relevant but different
+        ]
+    )
+
+    assert maximal_marginal_relevance(query, vectors, k=2, lambda_mult=0.5) == [0, 2]
+
+
+def test_mmr_without_diversity_ranks_by_relevance():
+    query = np.array([1.0, 0.0])
+    vectors = np.array([[0.0, 1.0], [1.0, 0.1], [1.0, 1.0]])
+
+    assert maximal_marginal_relevance(query, vectors, k=5, lambda_mult=1) == [1, 2, 0]
+
+
+def test_mmr_no_vectors():
+    assert maximal_marginal_relevance(np.ones(2), np.empty((0, 2)), k=3) == []
+
+
+def test_adaptive_k():
+    relevance = np.array([0.9, 0.85, 0.5, 0.88])
+
+    assert adaptive_k(relevance, min_k=1, relevance_ratio=0.9) == 2
+    assert adaptive_k(relevance, min_k=3, relevance_ratio=0.9) == 3
+    assert adaptive_k(relevance, min_k=1, relevance_ratio=0.5) == 4
+    assert adaptive_k(np.array([]), min_k=2) == 0
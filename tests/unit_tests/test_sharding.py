@@ -0,0 +1,177 @@
+import pickle
+from typing import List
+
+import pytest
+from langchain.docstore.document import Document
+from langchain.vectorstores.faiss import FAISS
+
+from knowledge_gpt.core.embedding import FolderIndex, SearchFilter
+from knowledge_gpt.core.parsing import File
+from knowledge_gpt.core.index_pool import IndexPool
+from knowledge_gpt.core.sharding import ShardLostError, ShardedVectorStore, get_workers
+from .fake_file import FakeFile
+from .test_embedding import LookupEmbeddings
+
+VECTORS = {
+    "query": [1.0, 0.0],
+    "a1": [1.0, 0.0],
+    "a2": [0.0, 1.0],
+    "b1": [0.9, 0.1],
+    "b2": [0.5, 0.5],
+    "c1": [1.0, 0.05],
+}
+
+
+def make_files() -> List[File]:
+    return [
+        FakeFile(
+            name=f"{name}.pdf",
+            id=name,
+            docs=[
+                Document(page_content=f"{name}1", metadata={"page": 1}),
+                Document(page_content=f"{name}2", metadata={"page": 2}),
+            ][: 1 if name == "c" else 2],
+        )
+        for name in ["a", "b", "c"]
+    ]
+
+
+@pytest.fixture(scope="module")
+def sharded_index():
+    folder_index = FolderIndex.from_files(
+        make_files(),
+        embeddings=LookupEmbeddings(VECTORS),
+        vector_store=ShardedVectorStore,
+        deduplicate=False,
+    )
+    yield folder_index
+    folder_index.index.close()  # type: ignore
+
+
+def search(folder_index: FolderIndex, **kwargs) -> List[str]:
+    docs = folder_index.search("query", k=5, min_k=5, **kwargs)
+    return [doc.page_content for doc in docs]
+
+
+def test_files_partitioned_across_shards(sharded_index: FolderIndex):
+    store: ShardedVectorStore = sharded_index.index  # type: ignore
+
+    assert len(store) == 4
+    assert len(set(store.file_shards.values())) == 3
+    assert sorted(store.num_docs) == [0, 1, 2, 2]
+
+
+def test_stores_share_workers(sharded_index: FolderIndex):
+    other = ShardedVectorStore.from_texts(
+        ["a1"], LookupEmbeddings(VECTORS), metadatas=[{"file_id": "a"}]
+    )
+
+    try:
+        assert other.shards == sharded_index.index.shards  # type: ignore
+        assert len(get_workers(1)) == 1
+        assert search(sharded_index) == ["a1", "c1", "b1", "b2", "a2"]
+    finally:
+        other.close()
+
+
+def test_filtered_search_finds_chunks_kept_for_duplicates():
+    files = make_files()
+    files.append(
+        FakeFile(
+            name="d.pdf",
+            id="d",
+            docs=[Document(page_content="b1", metadata={"page": 1})],
+        )
+    )
+    folder_index = FolderIndex.from_files(
+        files,
+        embeddings=LookupEmbeddings(VECTORS),
+        vector_store=ShardedVectorStore,
+        deduplicate=True,
+    )
+
+    try:
+        # The chunk of d is stored under the id of b, in the shard of b
+        assert "d" not in folder_index.index.file_shards  # type: ignore
+        assert search(folder_index, search_filter=SearchFilter(file_ids=["d"])) == [
+            "b1"
+        ]
+    finally:
+        folder_index.index.close()  # type: ignore
+
+
+def test_sharded_search_matches_single_index(sharded_index: FolderIndex):
+    single_index = FolderIndex.from_files(
+        make_files(),
+        embeddings=LookupEmbeddings(VECTORS),
+        vector_store=FAISS,
+        deduplicate=False,
+    )
+
+    assert search(sharded_index) == search(single_index)
+    assert search(sharded_index, search_filter=SearchFilter(pages=(2, 2))) == [
+        "b2",
+        "a2",
+    ]
+    assert search(sharded_index, search_filter=SearchFilter(file_ids=["b"])) == [
+        "b1",
+        "b2",
+    ]
+    assert search(sharded_index, search_filter=SearchFilter(file_ids=["x"])) == []
+
+
+def test_add_documents_routes_by_file(sharded_index: FolderIndex):
+    store: ShardedVectorStore = sharded_index.index  # type: ignore
+    doc = Document(page_content="c1", metadata={"file_id": "c", "page": 3})
+
+    sharded_index.add_documents([doc], LookupEmbeddings(VECTORS))
+
+    assert store.num_docs[store.file_shards["c"]] == 2
+    assert search(
+        sharded_index, search_filter=SearchFilter(file_ids=["c"], pages=(3, 3))
+    ) == ["c1"]
+
+
+def test_pickle_restarts_shards(sharded_index: FolderIndex):
+    loaded = pickle.loads(pickle.dumps(sharded_index))
+    loaded.attach_embeddings(LookupEmbeddings(VECTORS))
+
+    try:
+        assert search(loaded) == search(sharded_index)
+    finally:
+        loaded.index.close()
+
+
+def test_dead_workers_are_replaced_and_losses_surfaced(tmp_path):
+    # Runs last, since it kills a worker that the other tests share
+    folder_index = FolderIndex.from_files(
+        make_files(),
+        embeddings=LookupEmbeddings(VECTORS),
+        vector_store=ShardedVectorStore,
+        deduplicate=False,
+    )
+    store: ShardedVectorStore = folder_index.index  # type: ignore
+    pool = IndexPool(max_bytes=2**20, spill_dir=str(tmp_path))
+    pool.put("key", folder_index)
+
+    lost = store.file_shards["a"]
+    dead = store.shards[lost]
+    dead.process.kill()
+    dead.process.join()
+
+    assert store.lost_shards == [lost]
+    assert store.shards[lost] is not dead
+    with pytest.raises(ShardLostError):
+        search(folder_index)
+    assert pool.get("key") is None
+
+    # Stores created since are not affected
+    other = ShardedVectorStore.from_texts(
+        ["a1"], LookupEmbeddings(VECTORS), metadatas=[{"file_id": "a"}]
+    )
+    try:
+        assert other.lost_shards == []
+        assert other.similarity_search("query", k=1)[0].page_content == "a1"
+    finally:
+        other.close()
+        store.close()
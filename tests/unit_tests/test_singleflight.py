@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from knowledge_gpt.core.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_result():
+    flight = SingleFlight()
+    calls = []
+    started = threading.Event()
+
+    def slow(value: int) -> int:
+        calls.append(value)
+        started.set()
+        time.sleep(0.2)
+        return value
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        first = executor.submit(flight.do, "key", slow, 1)
+        started.wait()
+        others = [executor.submit(flight.do, "key", slow, 2) for _ in range(2)]
+        results = [first.result()] + [future.result() for future in others]
+
+    assert calls == [1]
+    assert results == [1, 1, 1]
+    assert flight.in_flight() == 0
+    # Finished calls are not cached
+    assert flight.do("key", lambda: 3) == 3
+
+
+def test_errors_propagate_to_waiting_callers():
+    flight = SingleFlight()
+    started = threading.Event()
+
+    def fail():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError("no answer")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(flight.do, "key", fail)
+        started.wait()
+        second = executor.submit(flight.do, "key", fail)
+        for future in [first, second]:
+            with pytest.raises(ValueError):
+                future.result()
+
+
+def test_async_calls_share_result():
+    flight = SingleFlight()
+    calls = []
+
+    async def slow(value: int) -> int:
+        calls.append(value)
+        await asyncio.sleep(0.05)
+        return value
+
+    async def main():
+        return await asyncio.gather(*(flight.ado("key", slow, i) for i in range(3)))
+
+    assert asyncio.run(main()) == [0, 0, 0]
+    assert calls == [0]
+
+
+def test_cancelled_caller_does_not_cancel_others():
+    flight = SingleFlight()
+
+    async def slow() -> str:
+        await asyncio.sleep(0.1)
+        return "answer"
+
+    async def main():
+        first = asyncio.ensure_future(flight.ado("key", slow))
+        second = asyncio.ensure_future(flight.ado("key", slow))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == "answer"
+
+
+def test_call_cancelled_when_all_callers_are():
+    flight = SingleFlight()
+
+    async def main():
+        done = asyncio.Event()
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                done.set()
+                raise
+
+        callers = [asyncio.ensure_future(flight.ado("key", slow)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.wait_for(done.wait(), timeout=1)
+        await asyncio.sleep(0)
+        return flight.in_flight()
+
+    assert asyncio.run(main()) == 0
@@ -0,0 +1,79 @@
+import json
+import time
+
+from langchain.docstore.document import Document
+
+from knowledge_gpt.core.usage import (
+    UsageLedger,
+    UsageRecord,
+    count_tokens,
+    estimate_cost,
+    estimate_tokens,
+    upload_usage,
+)
+from .fake_file import FakeFile
+
+
+def make_record(**kwargs) -> UsageRecord:
+    fields = dict(kind="query", model="gpt-4", file_ids=["1"], prompt_tokens=100)
+    fields.update(kwargs)
+    return UsageRecord(**fields)
+
+
+def test_unknown_models_are_estimated():
+    assert count_tokens("a" * 40, model="debug") == estimate_tokens("a" * 40) == 10
+
+
+def test_estimate_cost():
+    assert estimate_cost("gpt-4", 1000, 500) == 0.03 + 0.03
+    assert estimate_cost("debug", 1000, 500) == 0
+
+
+def test_upload_usage_uses_stored_token_counts():
+    docs = [
+        Document(page_content="a", metadata={"token_count": 300}),
+        Document(page_content="b", metadata={"token_count": 200}),
+    ]
+    file = FakeFile(name="test.txt", id="1", docs=docs)
+
+    usage = upload_usage(file)
+
+    assert usage.file_ids == ["1"]
+    assert usage.embedding_tokens == 500
+    assert usage.cost == estimate_cost("text-embedding-ada-002", 500)
+
+
+def test_ledger_rolls_up_per_file_session_and_model():
+    ledger = UsageLedger()
+
+    ledger.record(make_record(file_ids=["1", "2"]), session_id="a")
+    ledger.record(make_record(model="gpt-3.5-turbo"), session_id="a")
+    ledger.record(make_record(), session_id="b")
+
+    assert ledger.by_file["1"].records == 3
+    assert ledger.by_file["2"].prompt_tokens == 100
+    assert ledger.by_session["a"].prompt_tokens == 200
+    assert ledger.by_session["b"].records == 1
+    assert ledger.by_model["gpt-4"].records == 2
+    assert ledger.by_model["gpt-3.5-turbo"].records == 1
+
+
+def test_ledger_flushes_periodically(tmp_path):
+    path = tmp_path / "usage.jsonl"
+    ledger = UsageLedger(path=str(path), flush_interval=0.05)
+
+    ledger.record(make_record(), session_id="a")
+    ledger.record(make_record(), session_id="b")
+    # Flushed without waiting for another record
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        lines = path.read_text().splitlines() if path.exists() else []
+        if len(lines) == 2:
+            break
+        time.sleep(0.01)
+    records = [json.loads(line) for line in lines]
+    assert [record["session_id"] for record in records] == ["a", "b"]
+
+    ledger.record(make_record(), session_id="c")
+    ledger.close()
+    assert len(path.read_text().splitlines()) == 3
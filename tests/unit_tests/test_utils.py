@@ -1,3 +1,6 @@
+from types import SimpleNamespace
+from typing import List
+
 from knowledge_gpt.core.utils import pop_docs_upto_limit
 from langchain.docstore.document import Document
 from knowledge_gpt.core.debug import FakeChatModel
@@ -39,3 +42,52 @@ def test_all_docs_popped():
     )
 
     assert len(filtered_docs) == 0
+
+
+class CountingChain:
+    """Chain whose prompts have 100 tokens plus 1000 per document"""
+
+    def __init__(self):
+        self.llm_chain = SimpleNamespace(llm=FakeChatModel())
+        self.prompt_lengths: List[int] = []
+
+    def prompt_length(self, docs: List[Document], **kwargs) -> int:
+        self.prompt_lengths.append(len(docs))
+        return 100 + 1000 * len(docs)
+
+
+def test_stored_token_counts_are_not_retokenized():
+    """Test that documents with stored token counts are popped without
+    computing the prompt length with them."""
+
+    docs = [
+        Document(
+            page_content="Hello " * 500, metadata={"source": "1", "token_count": 500}
+        )
+    ] * 3
+    chain = CountingChain()
+    filtered_docs = pop_docs_upto_limit(
+        query="test", chain=chain, docs=docs, max_len=1200  # type: ignore
+    )
+
+    assert len(filtered_docs) == 2
+    assert chain.prompt_lengths == [0]
+
+
+def test_estimated_prompt_length_close_to_limit_is_checked():
+    """Test that the prompt length is computed exactly when the estimate
+    from stored token counts is close to the max length."""
+
+    docs = [
+        Document(
+            page_content="Hello " * 500, metadata={"source": "1", "token_count": 500}
+        )
+    ] * 3
+    chain = CountingChain()
+    filtered_docs = pop_docs_upto_limit(
+        query="test", chain=chain, docs=docs, max_len=1150  # type: ignore
+    )
+
+    # The estimate with 2 documents is just below 1150, but the prompt is not
+    assert len(filtered_docs) == 1
+    assert chain.prompt_lengths == [0, 2, 1]